@@ -167,14 +167,13 @@ class Beluga(object):
         # print("Computing the necessary conditions of optimality")
         logging.info("Computing the necessary conditions of optimality")
 
-        self.nec_cond = NecessaryConditions()
-
-        # Try loading cached BVP from disk
-        # bvp = self.nec_cond.load_bvp(self.problem)
-        # if bvp is None:
-        #     # Create corresponding boundary value problem
-        #     bvp = self.nec_cond.get_bvp(self.problem)
-        #     self.nec_cond.cache_bvp(self.problem)
+        # Generated code is kept in the cache directory set up by run(). The backend of
+        # the generated functions is chosen by the solver, unless the problem sets one.
+        self.nec_cond = NecessaryConditions(cache_dir=getattr(self.problem.bvp_solver, 'cache_dir', None),
+                                            backend=getattr(self.problem.bvp_solver, 'backend', 'python'))
+
+        # Create corresponding boundary value problem, reusing the problem data
+        # derived by an earlier run of the same problem if there is one
         bvp = self.nec_cond.get_bvp(self.problem)
 
         # TODO: Implement other types of initial guess depending on data type
@@ -259,6 +258,8 @@ class Beluga(object):
 
                     # sol is just a reference to bvp.solution
                     sol = self.problem.bvp_solver.solve(bvp)
+                    # Integrator statistics of all Newton iterations of the case
+                    integration = IntegratorStats.total(sol.integrator_stats)
 
                     s.unscale(bvp)
                     if sol.converged:
@@ -268,16 +269,27 @@ class Beluga(object):
                         sol.ctrl_expr = self.nec_cond.problem_data['control_options']
                         sol.ctrl_vars = self.nec_cond.problem_data['control_list']
 
-                        #TODO: Make control computation more efficient
                         if self.problem.mode == 'dae':
                             ## DAE mode
                             sol.u = sol.y[self.nec_cond.problem_data['num_states']:,:]
                         else:
-                            # Compute control history
-                            sol.u = np.zeros((len(self.nec_cond.problem_data['control_list']),len(sol.x)))
-                            for i in range(len(sol.x)):
-                                _u = bvp.control_func(sol.x[i],sol.y[:,i],sol.parameters,sol.aux)
-                                sol.u[:,i] = np.real(_u) #Take real part incase control bound is saturated
+                            sol.u = None
+                            if self.nec_cond.problem_data['control_options'] and getattr(bvp, 'control_func_vec', None) is not None:
+                                # Compute control history at all mesh points in one call. Only done
+                                # for closed-form control laws, the vectorized solver of implicit
+                                # ones has no warm start and may find a different stationary point.
+                                try:
+                                    _u = bvp.control_func_vec(sol.x,sol.y,sol.parameters,sol.aux)
+                                    sol.u = np.real(_u).reshape((len(self.nec_cond.problem_data['control_list']),len(sol.x)))
+                                except (TypeError, ValueError, ArithmeticError) as e:
+                                    # Scalar-only functions in the control law, or a result of the wrong shape
+                                    logging.warning('Vectorized control history failed, computing it point by point: '+str(e))
+                            if sol.u is None:
+                                # Compute control history
+                                sol.u = np.zeros((len(self.nec_cond.problem_data['control_list']),len(sol.x)))
+                                for i in range(len(sol.x)):
+                                    _u = bvp.control_func(sol.x[i],sol.y[:,i],sol.parameters,sol.aux)
+                                    sol.u[:,i] = np.real(_u) #Take real part incase control bound is saturated
 
                         # f = lambda _t, _X: bvp.control_func(_t,_X,sol.parameters,sol.aux)
                         # sol.u = np.array(list(map(f, sol.x, list(sol.y.T)))).T
@@ -286,10 +298,12 @@ class Beluga(object):
                         solution_set[step_idx].append(copy.deepcopy(bvp.solution))
 
                         elapsed_time = toc()
+                        logging.info('Integrator: '+str(integration))
                         logging.info('Iteration %d/%d converged in %0.4f seconds\n' % (step.ctr, step.num_cases(), elapsed_time))
                     else:
                         # solution_set[step_idx].append(copy.deepcopy(bvp.solution)) #Append failed solution objects as well
                         elapsed_time = toc()
+                        logging.info('Integrator: '+str(integration))
                         logging.info('Iteration %d/%d failed to converge!\n' % (step.ctr, step.num_cases()))
         except Exception as e:
             import traceback
@@ -1,3 +1,4 @@
+import numpy as np
 import abc
 class Algorithm(object):
     # Define class as abstract class
@@ -7,3 +8,74 @@ class Algorithm(object):
     @abc.abstractmethod
     def solve(self,bvp):
         """Method to solve the bvp with given arguments"""
+
+class RejectOutsideDomain(object):
+    """
+    Wraps the ODE function of a real-only variant (see BVP.real_variant), whose
+    math functions raise ValueError('math domain error') outside of their real
+    domain, so that such calls give NaN rates instead. The propagators reject trial
+    steps with non-finite values and retry them with smaller steps. Other errors
+    are raised as usual.
+
+    With 'jacobian' set, 'func' is a Jacobian function of the states followed by
+    their STM, as used by rosenbrock, and the result is an (n, n) NaN matrix.
+
+    A class instead of a closure, so that it can be sent to propagator processes.
+    """
+    def __init__(self, func, jacobian=False):
+        self.func = func
+        self.jacobian = jacobian
+
+    def __call__(self, t, y, *args, **kwargs):
+        try:
+            return self.func(t, y, *args, **kwargs)
+        except ValueError as e:
+            if str(e) != 'math domain error':
+                raise
+            if self.jacobian:
+                nOdes = int(0.5*(np.sqrt(4*np.size(y)+1)-1))
+                return np.full((nOdes, nOdes), np.nan)
+            return np.full(np.shape(y), np.nan)
+
+def stmode_vec_fd(x, Y, odefn, parameters, aux, StepSize=1e-6):
+    """
+    Finite difference version of the state transition matrix rates for one column of
+    states and STM per point, e.g. per arc or per Chebyshev node. 'odefn' is a
+    vectorized ODE function such as 'deriv_func_vec' of a BVP.
+    """
+    N = Y.shape[0]
+    nOdes = int(0.5*(np.sqrt(4*N+1)-1))
+
+    phi = Y[nOdes:].reshape((nOdes, nOdes, -1)) # STM of each point on the last axis
+
+    # Jacobian matrices of all points, one state perturbed at a time
+    X = np.array(Y[0:nOdes])
+    fx = np.real(odefn(x, X, parameters, aux))
+    F = np.zeros((nOdes, nOdes, Y.shape[1]))
+    for i in range(nOdes):
+        X[i] += StepSize
+        F[:, i] = (np.real(odefn(x, X, parameters, aux)) - fx)/StepSize
+        X[i] -= StepSize
+
+    phiDot = np.einsum('ijk,jlk->ilk', F, phi)
+    return np.concatenate((fx, np.reshape(phiDot, (nOdes*nOdes, -1))))
+
+def stmode_vec_csd(x, Y, odefn, parameters, aux, StepSize=1e-100):
+    """
+    Complex step version of stmode_vec_fd
+    """
+    N = Y.shape[0]
+    nOdes = int(0.5*(np.sqrt(4*N+1)-1))
+
+    phi = Y[nOdes:].reshape((nOdes, nOdes, -1)) # STM of each point on the last axis
+
+    # Jacobian matrices of all points using complex step derivative
+    X = np.array(Y[0:nOdes], dtype=complex)
+    F = np.zeros((nOdes, nOdes, Y.shape[1]))
+    for i in range(nOdes):
+        X[i] += StepSize*1.j
+        F[:, i] = np.imag(odefn(x, X, parameters, aux))/StepSize
+        X[i] -= StepSize*1.j
+
+    phiDot = np.einsum('ijk,jlk->ilk', F, phi)
+    return np.concatenate((odefn(x, Y[0:nOdes], parameters, aux), np.reshape(phiDot, (nOdes*nOdes, -1))))
@@ -1,13 +1,107 @@
+import copy
+import numpy as np
 from .Solution import Solution
 class BVP(object):
     """
     Defines a boundary value problem
+
+    The optional vectorized functions 'deriv_func_vec' and 'bc_func_vec' take the
+    same arguments as 'deriv_func' and 'bc_func', but with one column of states per
+    point, i.e. arrays of shape (n_states, n_points), and return one column per point.
+
+    The optional 'deriv_jac_func' takes the arguments of 'deriv_func' and returns the
+    Jacobians of the derivatives with respect to the states and the parameters as a
+    tuple (df/dX, df/dp). Likewise, the optional 'bc_jac_func' takes the arguments of
+    'bc_func' and returns (dBC/dya, dBC/dyb, dBC/dp). The solvers use them instead of
+    numerical derivatives.
+
+    The optional 'bc_func_left' and 'bc_func_right' evaluate the two halves of the
+    residual of 'bc_func' on their own, as bc_func_left(ya, p, aux) and
+    bc_func_right(yb, p, aux). Numerical BC Jacobians use them to evaluate only the
+    side whose boundary state is perturbed.
+
+    The optional 'deriv_stm_func' is a drop-in replacement for the state transition
+    matrix functions of the shooting solvers. It takes (t, Y, deriv_func, p, aux),
+    with the flattened STM after the states in Y, and returns the rates of both.
+
+    The optional 'flat_funcs' and 'real_funcs' map attribute names (e.g. 'deriv_func')
+    to variants of the functions that take the aux values as one flat tuple, ordered
+    as the (type, name) pairs in 'aux_index', instead of the aux dictionary. The
+    'real_funcs' are faster but do not accept complex numbers. See flat_variant(),
+    real_variant() and pack_aux().
+
+    The optional 'prepare_aux' takes the aux dictionary and returns the values that
+    the flat variants expect after the ones in 'aux_index', e.g. products of constants
+    that are evaluated once per solve instead of on every call.
     """
-    def __init__(self, deriv_func, bc_func, dae_func_gen=None, dae_num_states=0, initial_bc = None, terminal_bc = None, const = [], constraint = [], parameters = []):
+    def __init__(self, deriv_func, bc_func, dae_func_gen=None, dae_num_states=0, initial_bc = None, terminal_bc = None, const = [], constraint = [], parameters = [],
+                 deriv_func_vec=None, bc_func_vec=None, deriv_jac_func=None, bc_jac_func=None, deriv_stm_func=None,
+                 flat_funcs=None, real_funcs=None, aux_index=None, prepare_aux=None, bc_func_left=None,
+                 bc_func_right=None):
         self.deriv_func  = deriv_func
         self.bc_func = bc_func
+        self.deriv_func_vec = deriv_func_vec
+        self.bc_func_vec = bc_func_vec
+        self.deriv_jac_func = deriv_jac_func
+        self.bc_jac_func = bc_jac_func
+        self.bc_func_left = bc_func_left
+        self.bc_func_right = bc_func_right
+        self.deriv_stm_func = deriv_stm_func
+        self.flat_funcs = flat_funcs or {}
+        self.real_funcs = real_funcs or {}
+        self.aux_index = aux_index
+        self.prepare_aux = prepare_aux
+        # Whether the functions take the flat aux tuple
+        self.flat_aux = False
         self.dae_func_gen = dae_func_gen
         self.dae_num_states = dae_num_states
         self.solution = Solution()
         self.solution.aux = {"initial": initial_bc, "terminal": terminal_bc, "const": const, "constraint":constraint, "parameters":parameters}
         self.solution.converged = False
+
+    def flat_variant(self):
+        """
+        Returns a copy of the BVP that uses the complex-safe functions from 'flat_funcs'.
+        The copy shares the solution with this BVP.
+        """
+        return self.__variant(getattr(self, 'flat_funcs', None))
+
+    def real_variant(self):
+        """
+        Returns a copy of the BVP that uses the real-only functions from 'real_funcs',
+        for solvers that never pass complex numbers (finite-difference derivatives).
+        The copy shares the solution with this BVP.
+        """
+        return self.__variant(getattr(self, 'real_funcs', None))
+
+    def __variant(self, funcs):
+        if not funcs:
+            return self
+        bvp = copy.copy(self)
+        bvp.__dict__.update(funcs)
+        bvp.flat_aux = True
+        return bvp
+
+    def pack_aux(self, aux):
+        """
+        Returns the aux values in the form the functions of this BVP take: the aux
+        dictionary itself, or a flat tuple ordered as 'aux_index' for the variants.
+        Packing once per solve saves the dictionary lookups in every function call.
+
+        Raises KeyError for a (type, name) pair of 'aux_index' that is missing in aux,
+        as the dictionary functions would.
+        """
+        if not getattr(self, 'flat_aux', False):
+            return aux
+        packed = []
+        for (aux_type, name) in self.aux_index:
+            values = aux.get(aux_type) or {}
+            if name not in values:
+                raise KeyError('Missing aux value %s' % str((aux_type, name)))
+            value = values[name]
+            # Python floats are faster than NumPy scalars in the generated code
+            packed.append(value.item() if isinstance(value, np.generic) else value)
+        if getattr(self, 'prepare_aux', None) is not None:
+            packed += [value.item() if isinstance(value, np.generic) else value
+                       for value in self.prepare_aux(aux)]
+        return tuple(packed)
@@ -8,8 +8,13 @@ class Solution(object):
     y = None
     p = None
     nOdes = 0
-    def __init__(self, x=None, y=None, parameters=None, aux=None, state_list=None):
-        "x,y and parameters should be vectors"
+    dense = None
+    def __init__(self, x=None, y=None, parameters=None, aux=None, state_list=None, dense=None):
+        """
+        x,y and parameters should be vectors
+
+        dense: Continuous extension of the states from the propagator (DenseOutput)
+        """
         if x is not None and y is not None:
             self.x = np.array(x)
             self.y = np.array(y)
@@ -21,22 +26,28 @@ class Solution(object):
             self.parameters = None
 
         self.y_splines = self.u_splines = None
+        self.dense = dense
 
         self.aux = aux
         self.state_list = state_list
         self.var_dict = None
         self.converged = False
+        # IntegratorStats of each Newton iteration of the solver
+        self.integrator_stats = []
 
     # TODO: Write test for interpolation system
     def init_interpolate(self):
         """
         Fits splines to all states in the solution data
+
+        States are not fitted if the solution has a continuous extension
         """
         self.y_splines = []
         self.u_splines = []
-        for i,row in enumerate(self.y):
-            spline = InterpolatedUnivariateSpline(self.x, row)
-            self.y_splines.append(spline)
+        if self.dense is None:
+            for i,row in enumerate(self.y):
+                spline = InterpolatedUnivariateSpline(self.x, row)
+                self.y_splines.append(spline)
 
         if len(self.u.shape) ==1 :
             spline = InterpolatedUnivariateSpline(self.x, self.u)
@@ -58,7 +69,10 @@ class Solution(object):
             or self.y_splines is None or self.u_splines is None:
             self.init_interpolate()
 
-        new_y = np.array([spline(new_x) for spline in self.y_splines])
+        if self.dense is not None:
+            new_y = self.dense(new_x).T
+        else:
+            new_y = np.array([spline(new_x) for spline in self.y_splines])
         new_u = np.array([spline(new_x) for spline in self.u_splines])
         if overwrite:
             self.x = new_x
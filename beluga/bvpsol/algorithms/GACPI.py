@@ -1,85 +1,185 @@
 # from autodiff import Function, Gradient
 import numpy as np
+from numpy.polynomial import chebyshev
+from functools import partial
+import logging
 
 from beluga.bvpsol import Solution, BVP, Algorithm
-from beluga.utils.propagators import ode45, mcpi
-from beluga.utils import keyboard
+from beluga.bvpsol.Algorithm import stmode_vec_fd
+from beluga.utils.propagators import mcpi
+from beluga.utils.propagators.mcpi import _chebyshev_operators
+from beluga.utils.propagators.dopri5_batch import columnwise
 
 from math import *
 
-from beluga.utils.joblib import Memory
-
 class GACPI(Algorithm):
     """
     Class that implements the Generalized Adaptive Chebyshev-Picard Iteration
        method in Python
+
+    The states and their state transition matrix are approximated by Chebyshev
+    polynomials over the whole time span. Newton iterations on the initial states
+    and parameters drive the boundary conditions to zero. Every propagation runs
+    Picard iterations on all Chebyshev nodes at once, starting from the trajectory
+    of the last Newton iteration, so the ODE function is called once per Picard
+    iteration with all nodes. It is the vectorized 'deriv_func_vec' of the BVP if
+    it has one.
     """
+    def __init__(self, tolerance=1e-6, max_iterations=100, max_picard=100, max_order=256, verbose=False):
+        self.tolerance = tolerance
+        self.max_iterations = max_iterations
+        # Picard iterations per propagation
+        self.max_picard = max_picard
+        # Highest order of the Chebyshev polynomials
+        self.max_order = max_order
+        self.verbose = verbose
+
     def solve(self,bvp):
         """Solves the given BVP"""
-        tol = 1e-4
-        N = 40;
-        ode = bvp.deriv_func
-        bc  = bvp.bc_func
-        tSpan = bvp.solution.x
-        x_guess = bvp.solution.y.T   # Following bvp4c convention for input/output
-
-        params = bvp.solution.parameters
-        aux  =  bvp.solution.aux
-        [tau_1,x_guess,Beta_k] = mcpi(ode,tSpan,x_guess,params,aux,N = N,tol = tol,return_Beta = True)
-
-        [Beta_lim,_] = np.where(Beta_k > tol/10); # We are only interested in row index
-        Beta_idx = Beta_lim[-1]                   # Get last row index
-        N = Beta_idx + 3;                         # Use polynomials three orders higher
-        tSpan = np.linspace(tSpan[0],tSpan[-1],x_guess.shape[0])    # Resize tSpan
-        [tau,x_guess] = mcpi(ode,tSpan,x_guess,params,aux,N = N,tol = tol)
-
-        #
-        # tau = np.cos(np.linspace(N,0,N+1)*pi/N)
-        omega1 = (tSpan[-1]+tSpan[0])/2
-        omega2 = (tSpan[-1]-tSpan[0])/2
-
-        vec_1_Nt = matlab_colon(1,N).T # (1:N)'
-        vec_0_Np1t = matlab_colon(0,N+1).T # (0:N+1)'
-        vec_0_N  = matlab_colon(0,N)    # 0:N
-        vec_1_Np1 = matlab_colon(1,N+1) # 1:N+1
-
-        T = chebypoly(vec_0_Np1t,tau);
-        V = np.ones_like(tau)/N
-        V[1:-1] *= 2
+        solinit = bvp.solution
+        bc = bvp.bc_func
+        aux = solinit.aux
+        tol = self.tolerance
+
+        # Vectorized ODE function with one column of states per node
+        ode_vec = getattr(bvp, 'deriv_func_vec', None)
+        if ode_vec is None:
+            ode_vec = columnwise(bvp.deriv_func)
+
+        # Use the generated Jacobian of the BCs when the problem has one
+        bc_jac_func = getattr(bvp, 'bc_jac_func', None)
+        if bc_jac_func is None:
+            # Perturbing one boundary state only changes the residual of its side
+            bc_sides = None
+            if getattr(bvp, 'bc_func_left', None) is not None and getattr(bvp, 'bc_func_right', None) is not None:
+                bc_sides = (bvp.bc_func_left, bvp.bc_func_right)
+            bcjac_func = partial(self.__bcjac_fd, bc_sides=bc_sides)
+        else:
+            bcjac_func = partial(self.__bcjac_generated, bc_jac_func=bc_jac_func)
 
-        TV1 = T[0:N,:]*V
-        TV2 = T[2:N+2,:]*V;
-        TV = (TV1-TV2)/(2*vec_1_Nt)
-        TV[-1,:] = TV1[-1,:]/(2*N)
-        S = 2*((-1)**(vec_1_Nt.T+1))     # S = 2.*((-1).^((1:N)+1));
+        params = solinit.parameters
+        if params is not None:
+            params = np.array(params, dtype=float, ndmin=1)
 
-        Cx = T[0:N+1,0:N+1].T   # Cx = T(1:N+1,1:N+1)';
-        Cx[:,0] /= 2
+        tSpan = solinit.x
+        x_guess = solinit.y.T   # Following bvp4c convention for input/output
+        nOdes = x_guess.shape[1]
 
-        k = matlab_colon(1,N)
-        K1_S = -1**k
-        K2_S = np.ones_like(k)
-        K1_S[0,0] = K2_S[0,0] = 0 # Ignore Beta1 in the sum
+        [_,_,Beta_set] = mcpi(ode_vec,tSpan,x_guess,params,aux,tol = tol/10,vectorized = True,return_Beta = True)
 
-        err1 = err2 = np.inf
-        ctr = 0
-        max_iter = 100
+        # mcpi returns the coefficients of each segment, keep the highest significant order
+        N = 0
+        for Beta_k in Beta_set:
+            [Beta_lim,_] = np.where(abs(Beta_k) > tol/10); # We are only interested in row index
+            Beta_idx = Beta_lim[-1]                   # Get last row index
+            N = max(N, Beta_idx + 3);                 # Use polynomials three orders higher
+        N = min(N, self.max_order)
 
-        vode = wrap_params(vectorize_ode(ode))
+        omega1 = (tSpan[-1]+tSpan[0])/2
+        omega2 = (tSpan[-1]-tSpan[0])/2
+        tau, C, Tn = _chebyshev_operators(N)
         s_tau = tau*omega2 + omega1  # Scaled tau
-        x_new = np.empty_like(x_guess)
 
-        while ((tol < err1 or tol < err2) and (ctr < max_iter)):
-            ctr = ctr + 1
-            F = vode(s_tau,x_guess,params,aux)*omega2
-            Beta_r = np.dot(TV,F)
-            Beta_k = np.r_[np.dot(S,Beta_r) + 2*x_guess[0,:],Beta_r]    # [2*x0+S*Beta_r; Beta_r]
-            x_new = np.dot(Cx,Beta_k)
-            err2 = err1;
-            err1 = np.amax(abs(x_new - x_guess))
-            x_guess = x_new
+        # States at the Chebyshev nodes of the whole time span, the STM starts as identity
+        [_,x_nodes] = mcpi(ode_vec,s_tau,x_guess[0],params,aux,tol = tol/10,vectorized = True)
+        X = np.c_[x_nodes, np.tile(np.eye(nOdes).reshape(nOdes*nOdes), (N+1,1))]
+
+        def vode(t, X):
+            return stmode_vec_fd(t, X.T, ode_vec, params, aux).T
+
+        y0 = np.array(x_guess[0], dtype=float)
+        converged = False
+        iter = 1
+        try:
+            while True:
+                if iter > self.max_iterations:
+                    logging.warn("Maximum iterations exceeded!")
+                    break
+                X[0] = np.r_[y0, np.eye(nOdes).reshape(nOdes*nOdes)]
+                X, beta = self.__picard(vode, s_tau, omega2, X, C, Tn)
+
+                # Raise the order while the trailing coefficients of the states are significant
+                scale = max(np.max(np.abs(X[:, :nOdes])), 1.0)
+                if np.max(np.abs(beta[-2:, :nOdes])) > tol/10*scale and N < self.max_order:
+                    N = min(2*N, self.max_order)
+                    tau, C, Tn = _chebyshev_operators(N)
+                    s_tau = tau*omega2 + omega1
+                    X = chebyshev.chebval(tau, beta).T
+                    continue
+
+                ya = X[0, :nOdes]
+                yb = X[-1, :nOdes]
+                phi = X[-1, nOdes:].reshape((nOdes, nOdes))
+                res = bc(ya, yb, params, aux)
+                if self.verbose:
+                    logging.debug('Residue: '+str(np.linalg.norm(res)))
+
+                if max(abs(res)) < tol:
+                    if self.verbose:
+                        logging.info("Converged in "+str(iter)+" iterations.")
+                    converged = True
+                    break
+
+                J = bcjac_func(bc, ya, yb, phi, params, aux)
+                dy0 = np.linalg.solve(J, -res)
+                y0 = y0 + dy0[:nOdes]
+                if params is not None:
+                    params = params + dy0[nOdes:]
+                iter = iter + 1
+        except Exception as e:
+            logging.warn(e)
+
+        if converged:
+            sol = Solution(s_tau, X[:, :nOdes].T, params, aux)
+        else:
+            # Return initial guess if it failed to converge
+            sol = solinit
+        sol.converged = converged
+        bvp.solution = sol
+        return sol
+
+    def __picard(self, vode, s_tau, omega2, X, C, Tn):
+        """
+        Picard iterations on all Chebyshev nodes, starting from the trajectory X with
+        the initial states in its first row. Returns the converged trajectory and its
+        Chebyshev coefficients.
+        """
+        for _ in range(self.max_picard):
+            F = vode(s_tau, X)
+            beta = omega2*np.dot(C, F)
+            beta[0] += X[0]
+            X_new = np.dot(Tn, beta)
+            err = np.max(np.abs(X_new - X))/max(np.max(np.abs(X_new)), 1.0)
+            X = X_new
+            if err < self.tolerance/10:
+                return X, beta
+        raise RuntimeError('Picard iterations did not converge')
+
+    @staticmethod
+    def __bc_perturbed(bc_func, ya, yb, p, aux, bc_sides=None):
+        """
+        Returns the BC residual at ya and yb, and the residual as functions of ya and
+        of yb alone with the other arguments fixed. With the two sides of bc_func
+        given as 'bc_sides', the residual of the unperturbed side is not evaluated again.
+        """
+        if bc_sides is None:
+            return bc_func(ya,yb,p,aux), (lambda ya: bc_func(ya,yb,p,aux)), (lambda yb: bc_func(ya,yb,p,aux))
+        bc_func_left, bc_func_right = bc_sides
+        res_left = bc_func_left(ya,p,aux)
+        res_right = bc_func_right(yb,p,aux)
+        return (np.concatenate((res_left, res_right)),
+                (lambda ya: np.concatenate((bc_func_left(ya,p,aux), res_right))),
+                (lambda yb: np.concatenate((res_left, bc_func_right(yb,p,aux)))))
+
+    def __bcjac_generated(self, bc_func, ya, yb, phi, parameters, aux, bc_jac_func=None):
+        "Jacobian of the boundary conditions from the generated bc_jac_func"
+        M, N, P = bc_jac_func(ya, yb, parameters, aux)
+        J = M+np.dot(N,phi)
+        if parameters is not None:
+            J = np.hstack((J,P))
+        return J
 
-    def __bcjac_fd(self, bc_func, ya, yb, phi, parameters, aux, StepSize=1e-7):
+    def __bcjac_fd(self, bc_func, ya, yb, phi, parameters, aux, StepSize=1e-7, bc_sides=None):
 
         ya = np.array(ya, ndmin=1)
         yb = np.array(yb, ndmin=1)
@@ -93,25 +193,18 @@ class GACPI(Algorithm):
         if parameters is not None:
             nBCs += parameters.size
 
-        fx = bc_func(ya,yb,p,aux)
+        fx, bc_left, bc_right = self.__bc_perturbed(bc_func, ya, yb, p, aux, bc_sides)
 
         M = np.zeros((nBCs, nOdes))
         N = np.zeros((nBCs, nOdes))
         for i in range(nOdes):
             ya[i] = ya[i] + h
-            # if parameters is not None:
-            f = bc_func(ya,yb,p,aux)
-            # else:
-            #     f = bc_func(ya,yb)
-
+            f = bc_left(ya)
             M[:,i] = (f-fx)/h
             ya[i] = ya[i] - h
-        # for i in range(nOdes):
+
             yb[i] = yb[i] + h
-            # if parameters is not None:
-            f = bc_func(ya,yb,p,aux)
-            # else:
-            #     f = bc_func(ya,yb)
+            f = bc_right(yb)
             N[:,i] = (f-fx)/h
             yb[i] = yb[i] - h
 
@@ -127,38 +220,6 @@ class GACPI(Algorithm):
             J = M+np.dot(N,phi)
         return J
 
-def chebypoly(k, tau):
-    # Computes T_k(x) for all points in tau for all k
-    return np.cos(k*np.arccos(tau));
-
-def vectorize_ode(ode):
-    """
-    Vectorizes the ode function to be evaluated over entire trajectory space
-        Input is assumed to be matrix with one row per "timestep" with columns
-        making up each state
-    """
-    def wrapper(t, x, *args,**vargs):
-        """
-        Wrapper that evaluates the ODE for entire trajectory space
-        """
-        out = np.empty_like(x)
-        out[:] = np.NaN
-        for index in range(len(t)):
-            out[index,:] = ode(t[index],x[index,:],*args,**vargs)
-        return out
-    return wrapper
-
-def wrap_params(ode):
-    def param_wrapper(t, x, p, aux):
-        dxdt = ode(t,x,p,aux)
-        return np.r_[dxdt, np.zeros((dxdt.shape[0],len(p)))]
-    return param_wrapper
-
-def matlab_colon(a,b):
-    # Returns the same result as (a:b) in matlab
-    #   Converts the result to a row-vector
-    return np.linspace(a,b,b-a+1,dtype=int)[np.newaxis,:]
-
 if __name__ == '__main__':
     solver = GACPI()
     def odefn(t,X,p,aux):
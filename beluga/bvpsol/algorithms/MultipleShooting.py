@@ -1,13 +1,15 @@
 # from autodiff import Function, Gradient
 import numpy as np
+from functools import partial
 
 from .. import Solution
-from ..Algorithm import Algorithm
+from ..Algorithm import Algorithm, RejectOutsideDomain, stmode_vec_fd, stmode_vec_csd
 from .SingleShooting import SingleShooting
 from math import *
 from beluga.utils import *
-from beluga.utils import Propagator
+from beluga.utils import Propagator, DenseOutput, IntegratorStats
 from beluga.utils.Worker import Worker
+from beluga.utils.propagators.dopri5_batch import columnwise
 import logging, sys, os
 
 
@@ -18,13 +20,13 @@ except ImportError:
     HPCSUPPORTED = 0
 
 class MultipleShooting(Algorithm):
-    def __new__(cls, tolerance=1e-6, max_iterations=100, max_error=100, derivative_method='fd', cache_dir = None,verbose=False,cached=True,number_arcs=-1):
+    def __new__(cls, tolerance=1e-6, max_iterations=100, max_error=100, derivative_method='fd', cache_dir = None,verbose=False,cached=True,number_arcs=-1,propagator='dopri5',state_bound=1e6,replay_tolerance=None,stm_error_control=False,batched=False,backend='python'):
         obj = super(MultipleShooting, cls).__new__(cls)
         if number_arcs == 1:
-            return SingleShooting(tolerance=tolerance, max_iterations=max_iterations, max_error=max_error, derivative_method=derivative_method, cache_dir=cache_dir, verbose=verbose, cached=cached)
+            return SingleShooting(tolerance=tolerance, max_iterations=max_iterations, max_error=max_error, derivative_method=derivative_method, cache_dir=cache_dir, verbose=verbose, cached=cached, propagator=propagator, state_bound=state_bound, replay_tolerance=replay_tolerance, stm_error_control=stm_error_control, backend=backend)
         return obj
 
-    def __init__(self, tolerance=1e-6, max_iterations=100, max_error=100, derivative_method='fd', cache_dir = None,verbose=False,cached=True,number_arcs=-1):
+    def __init__(self, tolerance=1e-6, max_iterations=100, max_error=100, derivative_method='fd', cache_dir = None,verbose=False,cached=True,number_arcs=-1,propagator='dopri5',state_bound=1e6,replay_tolerance=None,stm_error_control=False,batched=False,backend='python'):
         self.tolerance = tolerance
         self.max_iterations = max_iterations
         self.verbose = verbose
@@ -32,12 +34,38 @@ class MultipleShooting(Algorithm):
         self.derivative_method = derivative_method
         if derivative_method == 'csd':
             self.stm_ode_func = self.__stmode_csd
+            self.stm_ode_func_vec = stmode_vec_csd
             self.bc_jac_func  = self.__bcjac_fd
+            self.jac_func     = self.__jac_csd
         elif derivative_method == 'fd':
             self.stm_ode_func = self.__stmode_fd
+            self.stm_ode_func_vec = stmode_vec_fd
             self.bc_jac_func  = self.__bcjac_fd
+            self.jac_func     = self.__jac_fd
         else:
             raise ValueError("Invalid derivative method specified. Valid options are 'csd' and 'fd'.")
+        # Backend of the real-only problem functions that 'fd' derivatives use, passed
+        # on to NecessaryConditions by Beluga.solve ('python' or 'numba')
+        if backend not in ('python', 'numba'):
+            raise ValueError("Invalid backend specified. Valid options are 'python' and 'numba'.")
+        self.backend = backend
+        # Name of the propagator, use 'rosenbrock' for stiff problems
+        self.propagator = propagator
+        # Propagate all arcs together in one vectorized dopri5 loop, with the
+        # vectorized ODE function of the BVP if it has one
+        if batched and propagator != 'dopri5':
+            raise ValueError("Batched propagation is only implemented for the 'dopri5' propagator.")
+        self.batched = batched
+        # Propagations are aborted once a state grows beyond state_bound times
+        # the largest magnitude in the initial guess (None to disable)
+        self.state_bound = state_bound
+        # Newton corrections smaller than replay_tolerance (relative to the guess)
+        # reuse the steps of the last adaptive propagation while their error
+        # estimates stay within the tolerances (None, the default, disables it)
+        self.replay_tolerance = replay_tolerance
+        # Step size control only looks at the states, unless the STM is included
+        # or the Newton residual grows
+        self.stm_error_control = stm_error_control
         self.cached = cached
         if cached and cache_dir is not None:
             self.set_cache_dir(cache_dir)
@@ -100,7 +128,7 @@ class MultipleShooting(Algorithm):
         J = np.hstack(J)
         return J
 
-    def __bcjac_fd(self, bc_func, ya, yb, phi, parameters, aux, StepSize=1e-6):
+    def __bcjac_fd(self, bc_func, ya, yb, phi, parameters, aux, StepSize=1e-6, bc_sides=None):
         # if parameters is not None:
         p  = np.array(parameters)
         h = StepSize
@@ -110,7 +138,20 @@ class MultipleShooting(Algorithm):
         if parameters is not None:
             nBCs += parameters.size
 
-        fx = bc_func(ya,yb,parameters,aux)
+        if bc_sides is None:
+            fx = bc_func(ya,yb,p,aux)
+            bc_perturbed = lambda left, right: bc_func(ya,yb,p,aux)
+        else:
+            # Only ya of the first arc and yb of the last arc change the residuals of
+            # the two sides of bc_func, the other boundary states only enter the
+            # continuity conditions
+            bc_func_left, bc_func_right = bc_sides
+            res_left = bc_func_left(ya[0],p,aux)
+            res_right = bc_func_right(yb[-1],p,aux)
+            fx = self.get_bc_sides(ya, yb, res_left, res_right)
+            bc_perturbed = lambda left, right: self.get_bc_sides(ya, yb,
+                                                                 bc_func_left(ya[0],p,aux) if left else res_left,
+                                                                 bc_func_right(yb[-1],p,aux) if right else res_right)
 
         M = [np.zeros((nBCs, nOdes)) for _ in range(self.number_arcs)]
         N = [np.zeros((nBCs, nOdes)) for _ in range(self.number_arcs)]
@@ -118,12 +159,12 @@ class MultipleShooting(Algorithm):
         for arc in range(self.number_arcs):
             for i in range(nOdes):
                 ya[arc][i] += h
-                f = bc_func(ya,yb,p,aux)
+                f = bc_perturbed(arc == 0, False)
                 M[arc][:,i] = (f-fx)/h
                 ya[arc][i] -= h
 
                 yb[arc][i] += h
-                f = bc_func(ya,yb,p,aux)
+                f = bc_perturbed(False, arc == self.number_arcs-1)
                 N[arc][:,i] = (f-fx)/h
                 yb[arc][i] -= h
             J[arc] = M[arc]+np.dot(N[arc],phi[arc])
@@ -140,21 +181,44 @@ class MultipleShooting(Algorithm):
         J = np.hstack(J)
         return J
 
-    def __stmode_fd(self, x, y, odefn, parameters, aux, nOdes = 0, StepSize=1e-6):
-        "Finite difference version of state transition matrix"
+    def __jac_fd(self, x, y, odefn, parameters, aux, fx=None, StepSize=1e-6):
+        "Finite difference Jacobian of the ODE function with respect to the states (without STM terms)"
         N = y.shape[0]
         nOdes = int(0.5*(sqrt(4*N+1)-1))
 
-        phi = y[nOdes:].reshape((nOdes, nOdes)) # Convert STM terms to matrix form
         Y = np.array(y[0:nOdes])  # Just states
         F = np.zeros((nOdes, nOdes))
-
-        # Compute Jacobian matrix, F using finite difference
-        fx = (odefn(x, Y, parameters, aux)).real
+        if fx is None:
+            fx = (odefn(x, Y, parameters, aux)).real
         for i in range(nOdes):
             Y[i] += StepSize
             F[:, i] = (odefn(x, Y, parameters, aux) - fx).real/StepSize
             Y[i] -= StepSize
+        return F
+
+    def __jac_csd(self, x, y, odefn, parameters, aux, StepSize=1e-100):
+        "Complex step Jacobian of the ODE function with respect to the states (without STM terms)"
+        N = y.shape[0]
+        nOdes = int(0.5 * (sqrt(4 * N + 1) - 1))
+
+        Y = np.array(y[0:nOdes], dtype=complex)  # Just states
+        F = np.zeros((nOdes, nOdes))
+        for i in range(nOdes):
+            Y[i] += StepSize * 1.j
+            F[:, i] = np.imag(odefn(x, Y, parameters, aux)) / StepSize
+            Y[i] -= StepSize * 1.j
+        return F
+
+    def __stmode_fd(self, x, y, odefn, parameters, aux, nOdes = 0, StepSize=1e-6):
+        "Finite difference version of state transition matrix"
+        N = y.shape[0]
+        nOdes = int(0.5*(sqrt(4*N+1)-1))
+
+        phi = y[nOdes:].reshape((nOdes, nOdes)) # Convert STM terms to matrix form
+
+        # Compute Jacobian matrix, F using finite difference
+        fx = (odefn(x, y[0:nOdes], parameters, aux)).real
+        F = self.__jac_fd(x, y, odefn, parameters, aux, fx=fx, StepSize=StepSize)
 
         phiDot = np.dot(F, phi)
         return np.concatenate((fx, np.reshape(phiDot, (nOdes*nOdes))))
@@ -165,19 +229,53 @@ class MultipleShooting(Algorithm):
         nOdes = int(0.5 * (sqrt(4 * N + 1) - 1))
 
         phi = y[nOdes:].reshape((nOdes, nOdes))  # Convert STM terms to matrix form
-        Y = np.array(y[0:nOdes], dtype=complex)  # Just states
-        F = np.zeros((nOdes, nOdes))
 
-        # Compute Jacobian matrix, F using finite difference
-        for i in range(nOdes):
-            Y[i] += StepSize * 1.j
-            F[:, i] = np.imag(odefn(x, Y, parameters, aux)) / StepSize
-            Y[i] -= StepSize * 1.j
+        # Compute Jacobian matrix using complex step derivative
+        F = self.__jac_csd(x, y, odefn, parameters, aux, StepSize=StepSize)
 
         # Phidot = F*Phi (matrix product)
         phiDot = np.dot(F, phi)
         return np.concatenate((odefn(x, y, parameters, aux), np.reshape(phiDot, (nOdes * nOdes))))
 
+
+    def __bcjac_generated(self, bc_func, ya, yb, phi, parameters, aux, bc_jac_func=None):
+        "Jacobian of get_bc from the generated bc_jac_func"
+        nOdes = ya[0].shape[0]
+        M, N, P = bc_jac_func(ya[0], yb[-1], parameters, aux)
+        nBCs = M.shape[0]
+
+        J = np.zeros((nBCs + nOdes*(self.number_arcs - 1), nOdes*self.number_arcs))
+        # Boundary conditions on the first and last arcs
+        J[:nBCs, :nOdes] += M
+        J[:nBCs, -nOdes:] += np.dot(N, phi[-1])
+        # Continuity conditions yb[arc] - ya[arc+1]
+        for arc in range(self.number_arcs - 1):
+            rows = slice(nBCs + arc*nOdes, nBCs + (arc+1)*nOdes)
+            J[rows, arc*nOdes:(arc+1)*nOdes] = phi[arc]
+            J[rows, (arc+1)*nOdes:(arc+2)*nOdes] = -np.eye(nOdes)
+
+        if parameters is not None:
+            J = np.hstack((J, np.vstack((P, np.zeros((nOdes*(self.number_arcs - 1), P.shape[1]))))))
+        return J
+
+    def __jac_generated(self, x, y, odefn, parameters, aux, deriv_jac_func=None):
+        "Jacobian of the ODE function with respect to the states from the generated deriv_jac_func"
+        N = y.shape[0]
+        nOdes = int(0.5*(sqrt(4*N+1)-1))
+        return deriv_jac_func(x, y[0:nOdes], parameters, aux)[0]
+
+    def __stmode_generated(self, x, y, odefn, parameters, aux, deriv_jac_func=None):
+        "State transition matrix from the generated deriv_jac_func"
+        N = y.shape[0]
+        nOdes = int(0.5*(sqrt(4*N+1)-1))
+
+        phi = y[nOdes:].reshape((nOdes, nOdes)) # Convert STM terms to matrix form
+
+        F = deriv_jac_func(x, y[0:nOdes], parameters, aux)[0]
+
+        phiDot = np.dot(F, phi)
+        return np.concatenate((odefn(x, y[0:nOdes], parameters, aux), np.reshape(phiDot, (nOdes*nOdes))))
+
     # def __stmode_ad(self, x, y, odefn, parameters, aux, nOdes = 0, StepSize=1e-50):
     #     "Automatic differentiation version of State Transition Matrix"
     #     phi = y[nOdes:].reshape((nOdes, nOdes)) # Convert STM terms to matrix form
@@ -211,10 +309,24 @@ class MultipleShooting(Algorithm):
             f1 = np.concatenate((f1,nextbc)).astype(np.float64)
         return f1
 
+    def get_bc_sides(self,ya,yb,res_left,res_right):
+        """get_bc from the residuals of the two sides of bc_func"""
+        f1 = np.concatenate((res_left,res_right))
+        for i in range(self.number_arcs-1):
+            nextbc = yb[i]-ya[i+1]
+            f1 = np.concatenate((f1,nextbc)).astype(np.float64)
+        return f1
+
     def solve(self,bvp):
         """Solve a two-point boundary value problem
             using the multiple shooting method
 
+        With derivative_method 'fd', the real-only functions of the BVP are used
+        (see BVP.real_variant). Their math functions raise ValueError for arguments
+        outside of the real domain, e.g. sqrt(-1). In the ODE function this rejects
+        the trial step like a non-finite value, but in the boundary conditions it
+        ends the solve, which returns an unconverged solution.
+
         Args:
             deriv_func: the ODE function
             bc_func: the boundary conditions function
@@ -225,11 +337,14 @@ class MultipleShooting(Algorithm):
         """
         guess = bvp.solution
 
-        if self.worker is not None:
+        if self.batched:
+            # All arcs in one vectorized loop instead of a process pool
+            ode45 = Propagator(solver=self.propagator,batched=True)
+        elif self.worker is not None:
             ode45 = self.worker.Propagator
         else:
             # Start local pool
-            ode45 = Propagator(solver='ode45',process_count=self.number_arcs)
+            ode45 = Propagator(solver=self.propagator,process_count=self.number_arcs)
             ode45.startPool()
 
         # Decrease time step if the number of arcs is greater than the number of indices
@@ -244,9 +359,51 @@ class MultipleShooting(Algorithm):
         y0g = [solinit.y[:,int(np.floor(i/self.number_arcs*x.shape[0]))] for i in range(self.number_arcs)]
         paramGuess = solinit.parameters
 
-        deriv_func = bvp.deriv_func
-        self.bc_func = bvp.bc_func
+        # Finite differences never pass complex numbers, so they can use the faster
+        # real-only functions. Complex-step derivatives need the complex-safe ones.
+        # Both variants of the generated functions take the aux values as one flat tuple.
+        funcs = bvp.real_variant() if self.derivative_method == 'fd' else bvp.flat_variant()
+
+        deriv_func = funcs.deriv_func
+        self.bc_func = funcs.bc_func
+
+        # Use the generated Jacobians of the ODE and BC functions when the problem has them,
+        # custom functions fall back to numerical derivatives
+        deriv_jac_func = getattr(funcs, 'deriv_jac_func', None)
+        if deriv_jac_func is None:
+            stm_ode_func = self.stm_ode_func
+            jac_func = self.jac_func
+        else:
+            stm_ode_func = partial(self.__stmode_generated, deriv_jac_func=deriv_jac_func)
+            jac_func = partial(self.__jac_generated, deriv_jac_func=deriv_jac_func)
+        # The fused function evaluates the states and the STM without a wrapper
+        if getattr(funcs, 'deriv_stm_func', None) is not None:
+            stm_ode_func = funcs.deriv_stm_func
+        if funcs is not bvp and self.derivative_method == 'fd':
+            # Out-of-domain arguments of the real-only math functions reject the trial step
+            stm_ode_func = RejectOutsideDomain(stm_ode_func)
+            jac_func = RejectOutsideDomain(jac_func, jacobian=True)
+
+        bc_jac_func = getattr(funcs, 'bc_jac_func', None)
+        if bc_jac_func is None:
+            # Perturbing one boundary state only changes the residual of its side
+            bc_sides = None
+            if getattr(funcs, 'bc_func_left', None) is not None and getattr(funcs, 'bc_func_right', None) is not None:
+                bc_sides = (funcs.bc_func_left, funcs.bc_func_right)
+            bcjac_func = partial(self.bc_jac_func, bc_sides=bc_sides)
+        else:
+            bcjac_func = partial(self.__bcjac_generated, bc_jac_func=bc_jac_func)
         aux = bvp.solution.aux
+        aux_args = funcs.pack_aux(aux)
+
+        # Batched propagation evaluates all arcs at once with the vectorized ODE function,
+        # which takes the aux dictionary. Without one, the arcs are evaluated one by one.
+        if not self.batched:
+            prop_func, prop_deriv_func, prop_aux = stm_ode_func, deriv_func, aux_args
+        elif getattr(bvp, 'deriv_func_vec', None) is not None:
+            prop_func, prop_deriv_func, prop_aux = self.stm_ode_func_vec, bvp.deriv_func_vec, aux
+        else:
+            prop_func, prop_deriv_func, prop_aux = columnwise(stm_ode_func), deriv_func, aux_args
         # Only the start and end times are required for ode45
         t0 = x[0]
         tf = x[-1]
@@ -258,6 +415,16 @@ class MultipleShooting(Algorithm):
         # Initial state of STM is an identity matrix
         stm0 = np.eye(nOdes).reshape(nOdes*nOdes)
 
+        # Step size control on the states only, the STM follows their steps
+        errorsel = None if self.stm_error_control else slice(0, nOdes)
+
+        # Bounding box for the states, the STM is not bounded
+        if self.state_bound is None:
+            maxstate = None
+        else:
+            maxstate = np.concatenate((self.state_bound*max(1.0, np.max(np.abs(solinit.y)))*np.ones(nOdes),
+                                       np.inf*np.ones(nOdes*nOdes)))
+
         if solinit.parameters is None:
             nParams = 0
         else:
@@ -274,6 +441,16 @@ class MultipleShooting(Algorithm):
         phiset = [np.eye(nOdes) for i in range(self.number_arcs)]
         tspanset = [np.empty(t.shape[0]) for i in range(self.number_arcs)]
 
+        # Accepted steps of the last adaptive propagation of each arc and whether to replay them
+        step_grids = None
+        replay = False
+
+        # Integrator statistics of each Newton iteration, summed over the arcs
+        iteration_stats = []
+
+        # Iterative propagators (mcpi) start from the last propagated trajectory
+        denseset = None
+
         tspan = [t0,tf]
 
         try:
@@ -283,6 +460,7 @@ class MultipleShooting(Algorithm):
                     break
 
                 y0set = [np.concatenate( (y0g[i], stm0) ) for i in range(self.number_arcs)]
+                stats = IntegratorStats()
 
                 for i in range(self.number_arcs):
                     left = int(np.floor(i/self.number_arcs*t.shape[0]))
@@ -292,14 +470,48 @@ class MultipleShooting(Algorithm):
                     tspanset[i] = [t[left],t[right]]
                     #tspanset[i] = np.linspace(t[left],t[right],np.ceil(5000/self.number_arcs))
 
-                # Propagate STM and original system together
-                tset,yySTM = ode45(self.stm_ode_func, tspanset, y0set, deriv_func, paramGuess, aux, abstol=self.tolerance/10, reltol=1e-5)
+                guess = None if denseset is None else DenseOutput.concatenate(denseset)
+                while True:
+                    # Propagate STM and original system together
+                    # Time spans with more than two entries give fixed steps, which
+                    # are aborted if their error estimate exceeds the tolerances
+                    try:
+                        tset,yySTM,denseset,statsset = ode45(prop_func, step_grids if replay else tspanset, y0set, prop_deriv_func, paramGuess, prop_aux, abstol=self.tolerance/10, reltol=1e-5, dense_output=True,
+                                                    jacobian=jac_func, stm=nOdes, maxstate=maxstate, errorsel=errorsel, return_stats=True, guess=guess, gridcheck=True)
+                    except RuntimeError as e:
+                        if not replay:
+                            raise
+                        # Count the aborted attempt before propagating adaptively
+                        stats = stats + getattr(e, 'stats', IntegratorStats())
+                        replay = False
+                        continue
+                    stats = stats + IntegratorStats.total(statsset)
+
+                    # Obtain just last timestep for use with correction
+                    yf = [yySTM[i][-1] for i in range(self.number_arcs)]
+                    # Extract states and STM from ode45 output
+                    yb = [yf[i][:nOdes] for i in range(self.number_arcs)]  # States
+                    phiset = [np.reshape(yf[i][nOdes:],(nOdes, nOdes)) for i in range(self.number_arcs)] # STM
+
+                    # Evaluate the boundary conditions
+                    res = self.get_bc(y0g, yb, paramGuess, aux_args)
+                    r1 = np.linalg.norm(res)
+                    if replay and r0 is not None and r1 > r0:
+                        # Residual grew, switch back to adaptive steps
+                        replay = False
+                        continue
+                    break
 
-                # Obtain just last timestep for use with correction
-                yf = [yySTM[i][-1] for i in range(self.number_arcs)]
-                # Extract states and STM from ode45 output
-                yb = [yf[i][:nOdes] for i in range(self.number_arcs)]  # States
-                phiset = [np.reshape(yf[i][nOdes:],(nOdes, nOdes)) for i in range(self.number_arcs)] # STM
+                if not replay:
+                    step_grids = list(tset)
+
+                iteration_stats.append(stats)
+                if self.verbose:
+                    logging.debug('Integrator: '+str(stats))
+
+                if errorsel is not None and r0 is not None and r1 > r0:
+                    # Newton iterations are struggling, keep the STM accurate as well
+                    errorsel = None
 
                 # y1 = yySTM[0][:, :nOdes]
                 # for i in range(1, self.number_arcs):
@@ -308,11 +520,7 @@ class MultipleShooting(Algorithm):
                 # for i in range(0,len(y1[:,3])):
                 #     print('den = ' + str((-0.5 * 1 * y1[i,3] * cos(y1[i,7]) - 1 * y1[i,5] * sin(y1[i,7]))) + '  u =' + str(y1[i,7]) + '  lamX =' + str(y1[i,3]) + '  lamA =' + str(y1[i,5]))
 
-                # Evaluate the boundary conditions
-                res = self.get_bc(y0g, yb, paramGuess, aux)
-
                 # Compute correction vector
-                r1 = np.linalg.norm(res)
                 if r1 > self.max_error:
                     logging.warn('Residue: '+str(r1) )
                     logging.warn('Residue exceeded max_error')
@@ -329,7 +537,7 @@ class MultipleShooting(Algorithm):
                     break
                 # logging.debug(paramGuess)
                 # Compute Jacobian of boundary conditions using numerical derviatives
-                J   = self.bc_jac_func(self.get_bc, y0g, yb, phiset, paramGuess, aux).astype(np.float64)
+                J   = bcjac_func(self.get_bc, y0g, yb, phiset, paramGuess, aux_args).astype(np.float64)
                 # if r0 is not None:
                 #     beta = (r0-r1)/(alpha*r0)
                 #     if beta < 0:
@@ -350,6 +558,10 @@ class MultipleShooting(Algorithm):
 
                 dy0 = alpha*beta*np.linalg.solve(J,-res)
 
+                # The batched propagator has no fixed steps to replay
+                replay = self.replay_tolerance is not None and not self.batched and \
+                    np.linalg.norm(dy0) < self.replay_tolerance*max(1.0, np.linalg.norm(np.concatenate(y0g)))
+
                 #dy0 = -alpha*beta*np.dot(np.transpose(np.dot(np.linalg.inv(np.dot(J,np.transpose(J))),J)),res)
 
                 # dy0 = np.linalg.solve(J,-res)
@@ -383,15 +595,17 @@ class MultipleShooting(Algorithm):
             for i in range(1, self.number_arcs):
                 x1 = np.hstack((x1, tset[i][1:]))
                 y1 = np.vstack((y1, (yySTM[i][1:, :nOdes])))
-            sol = Solution(x1, y1.T, paramGuess)
+            dense = DenseOutput.concatenate(denseset).select(slice(0,nOdes))
+            sol = Solution(x1, y1.T, paramGuess, dense=dense)
         else:
             # Return initial guess if it failed to converge
             sol = solinit
 
         sol.converged = converged
+        sol.integrator_stats = iteration_stats
         bvp.solution = sol
         sol.aux = aux
 
-        if self.worker is None:
+        if self.worker is None or self.batched:
             ode45.closePool()
         return sol
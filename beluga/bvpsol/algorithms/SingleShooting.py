@@ -1,11 +1,12 @@
 # from autodiff import Function, Gradient
 import numpy as np
+from functools import partial
 
 from .. import Solution
 from beluga.utils import keyboard, timeout
-from beluga.utils.ode45 import ode45
+from beluga.utils import Propagator, IntegratorStats
 # from beluga.utils.propagators import ode45n as ode45
-from ..Algorithm import Algorithm
+from ..Algorithm import Algorithm, RejectOutsideDomain
 from math import *
 # from beluga.utils.joblib import Memory
 # from joblib import Memory
@@ -30,9 +31,8 @@ import logging
 # signal.signal(signal.SIGALRM, timeout_handler)
 
 # dumps = picklemap(typed=True, flat=False, serializer='dill')
-#TODO: Save time steps from ode45 and use for fixed step RK4
 class SingleShooting(Algorithm):
-    def __init__(self, tolerance=1e-6, max_iterations=100, max_error=10, derivative_method='csd', cache_dir = None,verbose=False,cached=True):
+    def __init__(self, tolerance=1e-6, max_iterations=100, max_error=10, derivative_method='csd', cache_dir = None,verbose=False,cached=True,propagator='dopri5',state_bound=1e6,replay_tolerance=None,stm_error_control=False,backend='python'):
         self.tolerance = tolerance
         self.max_iterations = max_iterations
         self.verbose = verbose
@@ -41,11 +41,30 @@ class SingleShooting(Algorithm):
         if derivative_method == 'csd':
             self.stm_ode_func = self.__stmode_csd
             self.bc_jac_func  = self.__bcjac_csd
+            self.jac_func     = self.__jac_csd
         elif derivative_method == 'fd':
             self.stm_ode_func = self.__stmode_fd
             self.bc_jac_func  = self.__bcjac_fd
+            self.jac_func     = self.__jac_fd
         else:
             raise ValueError("Invalid derivative method specified. Valid options are 'csd' and 'fd'.")
+        # Backend of the real-only problem functions that 'fd' derivatives use, passed
+        # on to NecessaryConditions by Beluga.solve ('python' or 'numba')
+        if backend not in ('python', 'numba'):
+            raise ValueError("Invalid backend specified. Valid options are 'python' and 'numba'.")
+        self.backend = backend
+        # Use propagator='rosenbrock' for stiff problems
+        self.propagator = Propagator(solver=propagator)
+        # Propagations are aborted once a state grows beyond state_bound times
+        # the largest magnitude in the initial guess (None to disable)
+        self.state_bound = state_bound
+        # Newton corrections smaller than replay_tolerance (relative to the guess)
+        # reuse the steps of the last adaptive propagation while their error
+        # estimates stay within the tolerances (None, the default, disables it)
+        self.replay_tolerance = replay_tolerance
+        # Step size control only looks at the states, unless the STM is included
+        # or the Newton residual grows
+        self.stm_error_control = stm_error_control
         self.cached = cached
         if cached and cache_dir is not None:
             self.set_cache_dir(cache_dir)
@@ -60,7 +79,23 @@ class SingleShooting(Algorithm):
         #     # dircache = file_archive()
         #     # self.solve = memoized(cache=dircache, keymap=dumps, ignore='self')(self.solve)
 
-    def __bcjac_csd(self, bc_func, ya, yb, phi, parameters, aux, StepSize=1e-16):
+    @staticmethod
+    def __bc_perturbed(bc_func, ya, yb, p, aux, bc_sides=None):
+        """
+        Returns the BC residual at ya and yb, and the residual as functions of ya and
+        of yb alone with the other arguments fixed. With the two sides of bc_func
+        given as 'bc_sides', the residual of the unperturbed side is not evaluated again.
+        """
+        if bc_sides is None:
+            return bc_func(ya,yb,p,aux), (lambda ya: bc_func(ya,yb,p,aux)), (lambda yb: bc_func(ya,yb,p,aux))
+        bc_func_left, bc_func_right = bc_sides
+        res_left = bc_func_left(ya,p,aux)
+        res_right = bc_func_right(yb,p,aux)
+        return (np.concatenate((res_left, res_right)),
+                (lambda ya: np.concatenate((bc_func_left(ya,p,aux), res_right))),
+                (lambda yb: np.concatenate((res_left, bc_func_right(yb,p,aux)))))
+
+    def __bcjac_csd(self, bc_func, ya, yb, phi, parameters, aux, StepSize=1e-16, bc_sides=None):
         ya = np.array(ya, dtype=complex)
         yb = np.array(yb, dtype=complex)
         # if parameters is not None:
@@ -71,17 +106,18 @@ class SingleShooting(Algorithm):
         nBCs = nOdes
         if parameters is not None:
             nBCs += parameters.size
+        _, bc_left, bc_right = self.__bc_perturbed(bc_func, ya, yb, p, aux, bc_sides)
         M = np.zeros((nBCs, nOdes))
         N = np.zeros((nBCs, nOdes))
         for i in range(nOdes):
             ya[i] = ya[i] + h*1.j
-            f = bc_func(ya,yb,p,aux)
+            f = bc_left(ya)
             M[:,i] = np.imag(f)/h
             ya[i] = ya[i] - h*1.j
 
             yb[i] = yb[i] + h*1.j
 
-            f = bc_func(ya,yb,p,aux)
+            f = bc_right(yb)
             N[:,i] = np.imag(f)/h
             yb[i] = yb[i] - h*1.j
 
@@ -97,7 +133,7 @@ class SingleShooting(Algorithm):
             J = M+np.dot(N,phi)
         return J
 
-    def __bcjac_fd(self, bc_func, ya, yb, phi, parameters, aux, StepSize=1e-6):
+    def __bcjac_fd(self, bc_func, ya, yb, phi, parameters, aux, StepSize=1e-6, bc_sides=None):
 
         ya = np.array(ya, ndmin=1)
         yb = np.array(yb, ndmin=1)
@@ -111,19 +147,19 @@ class SingleShooting(Algorithm):
         if parameters is not None:
             nBCs += parameters.size
 
-        fx = bc_func(ya,yb,p,aux)
+        fx, bc_left, bc_right = self.__bc_perturbed(bc_func, ya, yb, p, aux, bc_sides)
 
         M = np.zeros((nBCs, nOdes))
         N = np.zeros((nBCs, nOdes))
 
         for i in range(nOdes):
             ya[i] = ya[i] + h
-            f = bc_func(ya,yb,p,aux)
+            f = bc_left(ya)
             M[:,i] = (f-fx)/h
             ya[i] = ya[i] - h
 
             yb[i] = yb[i] + h
-            f = bc_func(ya,yb,p,aux)
+            f = bc_right(yb)
             N[:,i] = (f-fx)/h
             yb[i] = yb[i] - h
 
@@ -139,21 +175,44 @@ class SingleShooting(Algorithm):
             J = M+np.dot(N,phi)
         return J
 
-    def __stmode_fd(self, x, y, odefn, parameters, aux, nOdes = 0, StepSize=1e-6):
-        "Finite difference version of state transition matrix"
+    def __jac_fd(self, x, y, odefn, parameters, aux, fx=None, StepSize=1e-6):
+        "Finite difference Jacobian of the ODE function with respect to the states (without STM terms)"
         N = y.shape[0]
         nOdes = int(0.5 * (sqrt(4 * N + 1) - 1))
 
-        phi = y[nOdes:].reshape((nOdes, nOdes))  # Convert STM terms to matrix form
         Y = np.array(y[0:nOdes])  # Just states
         F = np.empty((nOdes, nOdes))
-
-        # Compute Jacobian matrix, F using finite difference
-        fx = (odefn(x, Y, parameters, aux))
+        if fx is None:
+            fx = odefn(x, Y, parameters, aux)
         for i in range(nOdes):
             Y[i] += StepSize
             F[:, i] = (odefn(x, Y, parameters, aux) - fx) / StepSize
             Y[i] -= StepSize
+        return F
+
+    def __jac_csd(self, x, y, odefn, parameters, aux, StepSize=1e-100):
+        "Complex step Jacobian of the ODE function with respect to the states (without STM terms)"
+        N = y.shape[0]
+        nOdes = int(0.5*(sqrt(4*N+1)-1))
+
+        Y = np.array(y[0:nOdes], dtype=complex)  # Just states
+        F = np.zeros((nOdes, nOdes))
+        for i in range(nOdes):
+            Y[i] += StepSize * 1.j
+            F[:, i] = np.imag(odefn(x, Y, parameters, aux)) / StepSize
+            Y[i] -= StepSize * 1.j
+        return F
+
+    def __stmode_fd(self, x, y, odefn, parameters, aux, nOdes = 0, StepSize=1e-6):
+        "Finite difference version of state transition matrix"
+        N = y.shape[0]
+        nOdes = int(0.5 * (sqrt(4 * N + 1) - 1))
+
+        phi = y[nOdes:].reshape((nOdes, nOdes))  # Convert STM terms to matrix form
+
+        # Compute Jacobian matrix, F using finite difference
+        fx = (odefn(x, y[0:nOdes], parameters, aux))
+        F = self.__jac_fd(x, y, odefn, parameters, aux, fx=fx, StepSize=StepSize)
 
         phiDot = np.dot(F, phi)
         return np.concatenate((fx, np.reshape(phiDot, (nOdes * nOdes))))
@@ -164,25 +223,53 @@ class SingleShooting(Algorithm):
         nOdes = int(0.5*(sqrt(4*N+1)-1))
 
         phi = y[nOdes:].reshape((nOdes, nOdes)) # Convert STM terms to matrix form
-        Y = np.array(y[0:nOdes], dtype=complex)  # Just states
-        F = np.zeros((nOdes, nOdes))
 
         # Compute Jacobian matrix using complex step derivative
-        for i in range(nOdes):
-            Y[i] += StepSize * 1.j
-            F[:, i] = np.imag(odefn(x, Y, parameters, aux)) / StepSize
-            Y[i] -= StepSize * 1.j
+        F = self.__jac_csd(x, y, odefn, parameters, aux, StepSize=StepSize)
 
         # Phidot = F*Phi (matrix product)
         phiDot = np.dot(F,phi)
         # phiDot = np.real(np.dot(g(x,y,paameters,aux),phi))
         return np.concatenate((odefn(x,y, parameters, aux), np.reshape(phiDot, (nOdes*nOdes))))
 
+
+    def __bcjac_generated(self, bc_func, ya, yb, phi, parameters, aux, bc_jac_func=None):
+        "Jacobian of the boundary conditions from the generated bc_jac_func"
+        M, N, P = bc_jac_func(ya, yb, parameters, aux)
+        J = M+np.dot(N,phi)
+        if parameters is not None:
+            J = np.hstack((J,P))
+        return J
+
+    def __jac_generated(self, x, y, odefn, parameters, aux, deriv_jac_func=None):
+        "Jacobian of the ODE function with respect to the states from the generated deriv_jac_func"
+        N = y.shape[0]
+        nOdes = int(0.5*(sqrt(4*N+1)-1))
+        return deriv_jac_func(x, y[0:nOdes], parameters, aux)[0]
+
+    def __stmode_generated(self, x, y, odefn, parameters, aux, deriv_jac_func=None):
+        "State transition matrix from the generated deriv_jac_func"
+        N = y.shape[0]
+        nOdes = int(0.5*(sqrt(4*N+1)-1))
+
+        phi = y[nOdes:].reshape((nOdes, nOdes)) # Convert STM terms to matrix form
+
+        F = deriv_jac_func(x, y[0:nOdes], parameters, aux)[0]
+
+        phiDot = np.dot(F, phi)
+        return np.concatenate((odefn(x, y[0:nOdes], parameters, aux), np.reshape(phiDot, (nOdes*nOdes))))
+
     # @memoized(cache=file_archive(serialized=True, cached=False), ignore='self')
     def solve(self,bvp):
         """Solve a two-point boundary value problem
             using the single shooting method
 
+        With derivative_method 'fd', the real-only functions of the BVP are used
+        (see BVP.real_variant). Their math functions raise ValueError for arguments
+        outside of the real domain, e.g. sqrt(-1). In the ODE function this rejects
+        the trial step like a non-finite value, but in the boundary conditions it
+        ends the solve, which returns an unconverged solution.
+
         Args:
             deriv_func: the ODE function
             bc_func: the boundary conditions function
@@ -197,10 +284,43 @@ class SingleShooting(Algorithm):
         y0g = solinit.y[:,0]
         paramGuess = solinit.parameters
 
-        deriv_func = bvp.deriv_func
-        bc_func = bvp.bc_func
+        # Finite differences never pass complex numbers, so they can use the faster
+        # real-only functions. Complex-step derivatives need the complex-safe ones.
+        # Both variants of the generated functions take the aux values as one flat tuple.
+        funcs = bvp.real_variant() if self.derivative_method == 'fd' else bvp.flat_variant()
+
+        deriv_func = funcs.deriv_func
+        bc_func = funcs.bc_func
+
+        # Use the generated Jacobians of the ODE and BC functions when the problem has them,
+        # custom functions fall back to numerical derivatives
+        deriv_jac_func = getattr(funcs, 'deriv_jac_func', None)
+        if deriv_jac_func is None:
+            stm_ode_func = self.stm_ode_func
+            jac_func = self.jac_func
+        else:
+            stm_ode_func = partial(self.__stmode_generated, deriv_jac_func=deriv_jac_func)
+            jac_func = partial(self.__jac_generated, deriv_jac_func=deriv_jac_func)
+        # The fused function evaluates the states and the STM without a wrapper
+        if getattr(funcs, 'deriv_stm_func', None) is not None:
+            stm_ode_func = funcs.deriv_stm_func
+        if funcs is not bvp and self.derivative_method == 'fd':
+            # Out-of-domain arguments of the real-only math functions reject the trial step
+            stm_ode_func = RejectOutsideDomain(stm_ode_func)
+            jac_func = RejectOutsideDomain(jac_func, jacobian=True)
+
+        bc_jac_func = getattr(funcs, 'bc_jac_func', None)
+        if bc_jac_func is None:
+            # Perturbing one boundary state only changes the residual of its side
+            bc_sides = None
+            if getattr(funcs, 'bc_func_left', None) is not None and getattr(funcs, 'bc_func_right', None) is not None:
+                bc_sides = (funcs.bc_func_left, funcs.bc_func_right)
+            bcjac_func = partial(self.bc_jac_func, bc_sides=bc_sides)
+        else:
+            bcjac_func = partial(self.__bcjac_generated, bc_jac_func=bc_jac_func)
 
         aux = bvp.solution.aux
+        aux_args = funcs.pack_aux(aux)
         # Only the start and end times are required for ode45
         t0 = x[0]
         tf = x[-1]
@@ -214,6 +334,16 @@ class SingleShooting(Algorithm):
 
         # Initial state of STM is an identity matrix
         stm0 = np.eye(nOdes).reshape(nOdes*nOdes)
+
+        # Step size control on the states only, the STM follows their steps
+        errorsel = None if self.stm_error_control else slice(0, nOdes)
+
+        # Bounding box for the states, the STM is not bounded
+        if self.state_bound is None:
+            maxstate = None
+        else:
+            maxstate = np.concatenate((self.state_bound*max(1.0, np.max(np.abs(solinit.y)))*np.ones(nOdes),
+                                       np.inf*np.ones(nOdes*nOdes)))
         iter = 1            # Initialize iteraiton counter
         converged = False   # Convergence flag
 
@@ -223,6 +353,16 @@ class SingleShooting(Algorithm):
         beta = 1
         r0 = None
 
+        # Accepted steps of the last adaptive propagation and whether to replay them
+        step_grid = None
+        replay = False
+
+        # Integrator statistics of each Newton iteration
+        iteration_stats = []
+
+        # Iterative propagators (mcpi) start from the last propagated trajectory
+        dense = None
+
         tspan = [t0,tf]
         # tspan = np.linspace(0,1,200)
         try:
@@ -231,6 +371,7 @@ class SingleShooting(Algorithm):
                     logging.warn("Maximum iterations exceeded!")
                     break
                 y0 = np.concatenate( (y0g, stm0) )  # Add STM states to system
+                stats = IntegratorStats()
 
                 # Propagate STM and original system together
                 # stm_ode45 = SingleShooting.ode_wrap(self.stm_ode_func,deriv_func, paramGuess, aux, nOdes = y0g.shape[0])
@@ -239,17 +380,47 @@ class SingleShooting(Algorithm):
 
                 #TODO: Make timeout configurable
                 # with timeout(2,'ode45 exceeded maximum allowed time of 2 second'):
-                t,yy = ode45(self.stm_ode_func, tspan, y0, deriv_func, paramGuess, aux, nOdes = y0g.shape[0], abstol=self.tolerance/10, reltol=1e-5)
+                while True:
+                    # A time span with more than two entries gives fixed steps, which
+                    # are aborted if their error estimate exceeds the tolerances
+                    try:
+                        t,yy,dense,prop_stats = self.propagator(stm_ode_func, step_grid if replay else tspan, y0, deriv_func, paramGuess, aux_args, nOdes = y0g.shape[0], abstol=self.tolerance/10, reltol=1e-5, dense_output=True,
+                                                     jacobian=jac_func, stm=nOdes, maxstate=maxstate, errorsel=errorsel, return_stats=True, guess=dense, gridcheck=True)
+                    except RuntimeError as e:
+                        if not replay:
+                            raise
+                        # Count the aborted attempt before propagating adaptively
+                        stats = stats + getattr(e, 'stats', IntegratorStats())
+                        replay = False
+                        continue
+                    stats = stats + prop_stats
+
+                    # Obtain just last timestep for use with correction
+                    yf = yy[-1]
+                    # Extract states and STM from ode45 output
+                    yb = yf[:nOdes]  # States
+                    phi = np.reshape(yf[nOdes:],(nOdes, nOdes)) # STM
+                    # Evaluate the boundary conditions
+                    res = bc_func(y0g, yb, paramGuess, aux_args)
+
+                    r1 = np.linalg.norm(res)
+                    if replay and r0 is not None and r1 > r0:
+                        # Residual grew, switch back to adaptive steps
+                        replay = False
+                        continue
+                    break
 
-                # Obtain just last timestep for use with correction
-                yf = yy[-1]
-                # Extract states and STM from ode45 output
-                yb = yf[:nOdes]  # States
-                phi = np.reshape(yf[nOdes:],(nOdes, nOdes)) # STM
-                # Evaluate the boundary conditions
-                res = bc_func(y0g, yb, paramGuess, aux)
+                if not replay:
+                    step_grid = t
+
+                iteration_stats.append(stats)
+                if self.verbose:
+                    logging.debug('Integrator: '+str(stats))
+
+                if errorsel is not None and r0 is not None and r1 > r0:
+                    # Newton iterations are struggling, keep the STM accurate as well
+                    errorsel = None
 
-                r1 = np.linalg.norm(res)
                 if r1 > self.max_error:
                     logging.warn('Error exceeded max_error')
                     raise RuntimeError('Error exceeded max_error')
@@ -266,7 +437,7 @@ class SingleShooting(Algorithm):
                     break
 
                 # Compute Jacobian of boundary conditions using numerical derviatives
-                J   = self.bc_jac_func(bc_func, y0g, yb, phi, paramGuess, aux)
+                J   = bcjac_func(bc_func, y0g, yb, phi, paramGuess, aux_args)
                 # Compute correction vector
 
                 if r0 is not None:
@@ -296,6 +467,9 @@ class SingleShooting(Algorithm):
                     else:
                         # Re-raise exception if system is infeasible
                         raise
+
+                replay = self.replay_tolerance is not None and \
+                    np.linalg.norm(dy0) < self.replay_tolerance*max(1.0, np.linalg.norm(y0g))
                 # dy0 = -alpha*beta*np.dot(np.dot(np.linalg.inv(np.dot(J,J.T)),J).T,res)
 
                 # Apply corrections to states and parameters (if any)
@@ -319,11 +493,12 @@ class SingleShooting(Algorithm):
             # keyboard()
             x1, y1 = t, yy[:,:nOdes]
             # x1, y1 = ode45(deriv_func, [x[0],x[-1]], y0g, paramGuess, aux, abstol=self.tolerance, reltol=1e-3)
-            sol = Solution(x1,y1.T,paramGuess,aux)
+            sol = Solution(x1,y1.T,paramGuess,aux,dense=dense.select(slice(0,nOdes)))
         else:
             # Return initial guess if it failed to converge
             sol = solinit
         sol.converged = converged
+        sol.integrator_stats = iteration_stats
         bvp.solution = sol
         sol.aux = aux
         # logging.debug(sol.y[:,0])
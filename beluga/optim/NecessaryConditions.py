@@ -1,8 +1,11 @@
 from sympy import *
 from sympy.core.function import AppliedUndef, Function
 # from sympy.parsing.sympy_parser import parse_expr
-import pystache, imp, inspect, logging, os
+import pystache, imp, inspect, logging, os, sys
+import hashlib, importlib.machinery, json
+from sympy import __version__ as sympy_version
 import re as _re
+import time as _time
 
 import beluga.bvpsol.BVP as BVP
 
@@ -13,15 +16,82 @@ import numpy as np
 
 from beluga.optim.AircraftNoiseCtrl import CtrlSols  #TEMPORARY!!!!!
 
+try:
+    import numba
+    from numba.core.errors import NumbaError
+    NUMBASUPPORTED = 1
+except ImportError:
+    NUMBASUPPORTED = 0
+
+# Boundary values such as _x0['x'] are replaced by plain symbols for SymPy
+_boundary_pattern = _re.compile(r"(_x0|_xf)\['(\w+)'\]")
+# Files written to the cache directory by save_problem_data and compile_function,
+# including temporary ones left behind by an interrupted run
+_cache_entry_pattern = _re.compile(r"^(bvp_[0-9a-f]{16}\.dat|\w+_[0-9a-f]{16}\.py)(\.\d+\.tmp)?$")
+
+def parse_boundary_values(expr):
+    return sympify2(_boundary_pattern.sub(r'\1__\2', expr) if isinstance(expr, str) else expr)
+
+def restore_boundary_values(expr):
+    return _re.sub(r"(_x0|_xf)__(\w+)", r"\1['\2']", str(expr))
+
+def _canonical(obj):
+    """Plain data version of obj (e.g. a problem definition) for hashing"""
+    if isinstance(obj, (str, int, float, bool, type(None))):
+        return obj
+    if isinstance(obj, dict):
+        return dict((str(key), _canonical(value)) for (key, value) in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return [_canonical(value) for value in obj]
+    if hasattr(obj, '__dict__'):
+        return [type(obj).__name__, _canonical(vars(obj))]
+    return str(obj)
+
+_source_hash = None
+
+def source_hash():
+    """
+    Hash of the source of the code that derives the problem data: the whole
+    beluga.optim package and sympify2. Computed once per process.
+    """
+    global _source_hash
+    if _source_hash is None:
+        optim_dir = os.path.dirname(os.path.abspath(__file__))
+        files = [os.path.join(root, name) for (root, _, names) in os.walk(optim_dir)
+                 for name in names if name.endswith('.py')]
+        files = sorted(files) + [os.path.abspath(inspect.getsourcefile(sympify2))]
+        sha = hashlib.sha1()
+        for filename in files:
+            sha.update(os.path.relpath(filename, optim_dir).encode())
+            with open(filename, 'rb') as f:
+                sha.update(f.read())
+        _source_hash = sha.hexdigest()
+    return _source_hash
+
 class NecessaryConditions(object):
     """Defines necessary conditions of optimality."""
 
     # pystache renderer without HTML escapes
     renderer = pystache.Renderer(escape=lambda u: u)
 
-    def __init__(self, cached=True):
+    def __init__(self, cached=True, cse=True, hoist=True, cache_dir=None, backend='python',
+                 track_branches=False, cache_max_age=30*24*3600):
         """!
         \brief     Initializes all of the relevant necessary conditions of opimality.
+        \details   With 'cse' set, common subexpressions of the generated functions
+                   are computed once per call (see make_cse). With 'hoist' set as well,
+                   subexpressions of constants are computed once per solve (see hoist_aux).
+                   With 'cached' set and a 'cache_dir', the generated code is written
+                   to and reused from files in 'cache_dir' (see compile_function).
+                   Entries older than 'cache_max_age' seconds are deleted whenever a
+                   new problem is derived (see prune_cache). The cache only holds
+                   derived data, so 'cache_dir' is always safe to delete.
+                   With 'backend' set to 'numba', the real-only functions are compiled
+                   with Numba (see make_numba_funcs). With 'track_branches' set and
+                   more than two control options, compute_control evaluates only the
+                   two options that minimized the Hamiltonian in its last full scan
+                   (see utils.BranchTracker). This is a heuristic, the other options
+                   can become the minimizer between scans.
         \author    Michael Grant
         \author    Thomas Antony
         \version   0.1
@@ -38,6 +108,18 @@ class NecessaryConditions(object):
         self.bc_initial = []
         self.bc_terminal = []
 
+        self.cached = cached
+        self.cache_dir = cache_dir
+        self.cache_max_age = cache_max_age
+        self.backend = backend
+        self.track_branches = track_branches
+        self.cse = cse
+        self.hoist = hoist
+        # Hoisting is only done for the analytical mode, see get_bvp
+        self.hoisting = False
+        self.hoisted = {}
+        self.aux_symbols = set()
+
         from .. import Beluga # helps prevent cyclic imports
         self.compile_list = ['deriv_func','bc_func','compute_control']
         self.template_prefix = Beluga.config.getroot()+'/beluga/bvpsol/templates/'
@@ -447,12 +529,360 @@ class NecessaryConditions(object):
 
         return new_H
 
+    def make_cse(self, expr_list):
+        """
+        Eliminates common subexpressions from a list of expressions that are
+        evaluated together in one generated function
+
+        Returns:
+            (temporaries, reduced): the shared subexpressions as a list of
+            {'name','expr'} dictionaries for the templates, and the reduced
+            expressions as strings. Expressions that SymPy cannot parse (e.g.
+            the numerical costate rates) are returned unchanged.
+        """
+        if not self.cse:
+            return [], [restore_boundary_values(expr) for expr in expr_list]
+
+        parsed = []
+        for expr in expr_list:
+            try:
+                parsed.append(self.hoist_aux(parse_boundary_values(expr)))
+            except Exception:
+                parsed.append(None)
+
+        temporaries, reduced = cse([expr for expr in parsed if expr is not None],
+                                   symbols=numbered_symbols('_cse'), order='none')
+        reduced = iter(reduced)
+
+        restore = restore_boundary_values
+        return ([{'name': str(sym), 'expr': restore(expr)} for (sym, expr) in temporaries],
+                [str(expr) if parsed_expr is None else restore(next(reduced))
+                    for (expr, parsed_expr) in zip(expr_list, parsed)])
+
+    def hoist_aux(self, expr):
+        """
+        Replaces the subexpressions of 'expr' that only depend on the constants by
+        symbols named _aux0, _aux1, ..., so that they are evaluated once per solve by
+        the generated prepare_aux function instead of on every call (see BVP.pack_aux)
+
+        The constant factors of products and the constant terms of sums are grouped,
+        e.g. 0.5*rho0*Aref*v**2 becomes _aux0*v**2.
+        """
+        if not self.hoisting or expr.is_Atom:
+            return expr
+
+        def is_aux(expr):
+            return expr.free_symbols <= self.aux_symbols and not expr.atoms(AppliedUndef)
+
+        def register(expr):
+            if expr not in self.hoisted:
+                self.hoisted[expr] = Symbol('_aux'+str(len(self.hoisted)))
+            return self.hoisted[expr]
+
+        if is_aux(expr) and expr.free_symbols:
+            return register(expr)
+        if expr.is_Add or expr.is_Mul:
+            aux_args = [arg for arg in expr.args if is_aux(arg)]
+            args = [self.hoist_aux(arg) for arg in expr.args if not is_aux(arg)]
+            # Single constants or numbers are left in place
+            if len(aux_args) > 1 or (aux_args and not aux_args[0].is_Atom):
+                args.append(register(expr.func(*aux_args)))
+            else:
+                args += aux_args
+            return expr.func(*args)
+        return expr.func(*[self.hoist_aux(arg) for arg in expr.args])
+
+    def make_prelude(self, exprs):
+        """
+        Finds the quantities and the hoisted constant subexpressions (see hoist_aux)
+        that a generated function needs to evaluate 'exprs'
+
+        Returns:
+            (quantities, hoisted): {'name','expr'} lists in evaluation order
+        """
+        word = _re.compile(r'[A-Za-z_]\w*')
+        names = set(word.findall(' '.join(str(expr) for expr in exprs)))
+        # Quantities may depend on each other
+        added = True
+        while added:
+            added = False
+            for qty in self.prelude_quantities:
+                if qty['name'] in names and not set(word.findall(qty['expr'])) <= names:
+                    names.update(word.findall(qty['expr']))
+                    added = True
+        return ([qty for qty in self.prelude_quantities if qty['name'] in names],
+                [aux for aux in self.problem_data['aux_hoisted'] if aux['name'] in names])
+
+    def make_preludes(self):
+        """
+        Adds the quantities and hoisted subexpressions each generated function of
+        the analytical mode needs to problem_data, e.g. 'deriv_quantities' and
+        'deriv_hoisted' for deriv_func. Unused quantities are left out.
+        """
+        data = self.problem_data
+        # Quantities are evaluated on every call, apart from their constant subexpressions
+        self.prelude_quantities = []
+        for qty in data['quantity_list']:
+            try:
+                expr = str(self.hoist_aux(sympify2(qty['expr'])))
+            except Exception:
+                expr = qty['expr']
+            self.prelude_quantities.append({'name': qty['name'], 'expr': expr})
+        data['aux_hoisted'] = [{'name': str(name), 'expr': str(expr)}
+                               for (expr, name) in sorted(self.hoisted.items(), key=lambda item: int(str(item[1])[4:]))]
+
+        temp_exprs = lambda temps: [temp['expr'] for temp in temps]
+        entry_exprs = lambda data, names: [entry['expr'] for name in names for entry in data.get(name, [])]
+        groups = [('deriv', temp_exprs(data['deriv_temps']) + data['deriv_list_cse']),
+                  ('ham', temp_exprs(data['ham_temps']) + [data['ham_expr_cse']]),
+                  ('control', temp_exprs(data['dHdu_temps']) + data['dHdu_cse'] +
+                              temp_exprs(data.get('d2Hdu2_temps', [])) + data.get('d2Hdu2_cse', []) +
+                              [ctrl['expr'] for option in data['control_options'] for ctrl in option]),
+                  ('left_bc', temp_exprs(data['left_bc_temps']) + data['left_bc_list_cse']),
+                  ('right_bc', temp_exprs(data['right_bc_temps']) + data['right_bc_list_cse']),
+                  ('jac', temp_exprs(data.get('jac_temps', [])) +
+                          entry_exprs(data, ['dfdX', 'dfdp', 'dfdu', 'dgdX', 'dgdp', 'dgdu']))]
+        for (group, exprs) in groups:
+            data[group+'_quantities'], data[group+'_hoisted'] = self.make_prelude(exprs)
+        if 'deriv_stm' in data:
+            stm = data['deriv_stm']
+            stm['stm_quantities'], stm['stm_hoisted'] = self.make_prelude(
+                    temp_exprs(stm['stm_temps']) + entry_exprs(stm, ['rates', 'dfdX', 'dfdu', 'dgdX', 'dgdu']))
+        for side in data.get('bc_jac_sides', []):
+            side['bc_jac_quantities'], side['bc_jac_hoisted'] = self.make_prelude(
+                    temp_exprs(side['bc_jac_temps']) + entry_exprs(side, ['dbcdX', 'dbcdp', 'dbcdu', 'dgdX', 'dgdp', 'dgdu']))
+
+        # Hoisted values follow the boundary values in the flat aux tuple
+        start = data['num_aux_vars'] + 2*len(data['state_list'])
+        data['aux_hoisted_slice'] = '%d:%d' % (start, start + len(data['aux_hoisted']))
+
+    def make_jac_variables(self):
+        """
+        Parses the states, parameters, controls and dH/du for the Jacobian generators
+
+        Returns:
+            (states, params, controls, dHdu) as SymPy expressions, or None if dH/du
+            cannot be differentiated symbolically (custom functions)
+        """
+        states = [sympify2(state) for state in self.problem_data['state_list']]
+        params = [sympify2(param) for param in self.problem_data['parameter_list']]
+        controls = [sympify2(ctrl) for ctrl in self.problem_data['control_list']]
+        try:
+            dHdu = [sympify2(expr).subs(self.quantity_vars) for expr in self.problem_data['dHdu']]
+        except Exception:
+            return None
+        if any(expr.atoms(AppliedUndef, Derivative) for expr in dHdu) or len(dHdu) != len(controls):
+            return None
+        return states, params, controls, dHdu
+
+    def make_jac_entries(self, matrices, vectors=()):
+        """
+        Differentiates the expressions of a generated Jacobian function
+
+        Args:
+            matrices: list of (name, expressions, variables), one per matrix
+            vectors: list of (name, expressions) evaluated in the same function,
+                which share the subexpressions of the matrices
+
+        Returns:
+            (temporaries, entries): the shared subexpressions (see make_cse) and
+            the nonzero entries of each matrix as {name: [{'row','col','expr'}]},
+            as well as every entry of each vector as {name: [{'row','expr'}]}
+        """
+        entries = []
+        for (name, exprs) in vectors:
+            entries += [(name, row, None, expr) for (row, expr) in enumerate(exprs)]
+        for (name, exprs, variables) in matrices:
+            for (row, expr) in enumerate(exprs):
+                for (col, var) in enumerate(variables):
+                    entry = diff(expr, var)
+                    if entry != 0:
+                        entries.append((name, row, col, entry))
+
+        temporaries, reduced = self.make_cse([entry for (_, _, _, entry) in entries])
+        names = [name for (name, _) in vectors] + [name for (name, _, _) in matrices]
+        return temporaries, dict((name, [{'row': row, 'col': col, 'expr': expr} if col is not None else {'row': row, 'expr': expr}
+                                         for ((entry_name, row, col, _), expr) in zip(entries, reduced)
+                                         if entry_name == name])
+                                 for name in names)
+
+    def make_control_hessian(self):
+        """
+        Symbolically differentiates dH/du with respect to the controls for the
+        Newton control solver of problems without a closed-form control law
+
+        Returns:
+            Template data for compute_control.py.mu: 'd2Hdu2_temps' and 'd2Hdu2_cse',
+            the entries of d2H/du2 row by row, or None if dH/du cannot be
+            differentiated symbolically
+        """
+        variables = self.make_jac_variables()
+        if variables is None:
+            return None
+        (_, _, controls, dHdu) = variables
+        temporaries, reduced = self.make_cse([diff(g, u) for g in dHdu for u in controls])
+        return {'control_hessian': True, 'd2Hdu2_temps': temporaries, 'd2Hdu2_cse': reduced}
+
+    def make_deriv_jac(self):
+        """
+        Symbolically differentiates the state and costate rates with respect to
+        the states and the parameters for deriv_jac_func and deriv_stm_func
+
+        The controls are found from dH/du = 0, so their derivatives follow from
+        the implicit function theorem at run time, whichever control option
+        is chosen.
+
+        Returns:
+            Template data for deriv_jac_func.py.mu and deriv_stm_func.py.mu (under
+            'deriv_stm'), or None if the rates cannot
+            be differentiated symbolically (custom functions or numerical
+            costate rates)
+        """
+        variables = self.make_jac_variables()
+        if variables is None:
+            return None
+        (states, params, controls, dHdu) = variables
+        try:
+            rates = [sympify2(rate).subs(self.quantity_vars) for rate in self.problem_data['deriv_list']]
+        except Exception:
+            return None
+        if any(expr.atoms(AppliedUndef, Derivative) for expr in rates):
+            return None
+
+        matrices = [('dfdX', rates, states), ('dfdp', rates, params), ('dfdu', rates, controls),
+                    ('dgdX', dHdu, states), ('dgdp', dHdu, params), ('dgdu', dHdu, controls)]
+        temporaries, entries = self.make_jac_entries(matrices)
+        data = {'jac_temps': temporaries, 'jac_controls': len(controls) > 0, 'num_params': len(params)}
+        data.update(entries)
+
+        # deriv_stm_func evaluates the rates and df/dX together, so they share one set of temporaries
+        temporaries, entries = self.make_jac_entries([matrix for matrix in matrices if matrix[0] != 'dfdp'],
+                                                     vectors=[('rates', rates)])
+        entries['stm_temps'] = temporaries
+        data['deriv_stm'] = entries
+        return data
+
+    def make_bc_jac(self):
+        """
+        Symbolically differentiates the left and right boundary conditions with
+        respect to the boundary states and the parameters for bc_jac_func
+
+        The Hamiltonian in the boundary conditions is expanded, and the controls
+        are handled as in make_deriv_jac.
+
+        Returns:
+            Template data for bc_jac_func.py.mu, or None if the boundary
+            conditions cannot be differentiated symbolically
+        """
+        variables = self.make_jac_variables()
+        if variables is None:
+            return None
+        (states, params, controls, dHdu) = variables
+        try:
+            ham = sympify2(str(self.ham)).subs(self.quantity_vars)
+            bc_lists = [[parse_boundary_values(bc).subs(self.quantity_vars).subs(Symbol('_H'), ham)
+                         for bc in self.problem_data[name]] for name in ['left_bc_list', 'right_bc_list']]
+        except Exception:
+            return None
+        if any(expr.atoms(AppliedUndef, Derivative) for bcs in bc_lists for expr in bcs):
+            return None
+
+        sides = []
+        for (side, bcs, arg, time, boundary, aux_type) in [('left', bc_lists[0], '_ya', 0, '_x0', 'initial'),
+                                                           ('right', bc_lists[1], '_yb', 1, '_xf', 'terminal')]:
+            temporaries, entries = self.make_jac_entries(
+                    [('dbcdX', bcs, states), ('dbcdp', bcs, params), ('dbcdu', bcs, controls),
+                     ('dgdX', dHdu, states), ('dgdp', dHdu, params), ('dgdu', dHdu, controls)])
+            entries.update({'side': side, 'arg': arg, 'time': time, 'boundary': boundary, 'aux_type': aux_type,
+                            'aux_slice': self.problem_data['aux_%s_slice' % aux_type],
+                            'num_bcs': len(bcs), 'bc_jac_temps': temporaries,
+                            # Controls only matter if the boundary conditions depend on them
+                            'bc_jac_controls': len(entries['dbcdu']) > 0})
+            sides.append(entries)
+        return {'bc_jac_sides': sides, 'num_params': len(params)}
+
     # Compiles a function template file into a function object
     # using the given data
-    def compile_function(self,filename,verbose=False):
+    def make_numba_funcs(self, problem):
+        """
+        Compiles the real-only variants of deriv_func, bc_func, compute_control and
+        deriv_stm_func with Numba. The compiled code is cached next to the generated
+        files when there is a cache directory (see compile_function).
+
+        Numba cannot compile the numerical control law (scipy.optimize.fsolve) or
+        calls of custom Python functions, so those problems keep the Python functions.
+
+        Returns:
+            dict: BVP attribute name -> compiled function, or None if Numba is not
+                  available or cannot compile the functions of this problem
+        """
+        data = self.problem_data
+        if not NUMBASUPPORTED:
+            logging.warn('Numba is not installed, using the Python functions')
+            return None
+        if not data['control_options'] or any(aux['vars'] for aux in data['aux_list'] if aux['type'] == 'function'):
+            logging.warn('Numba backend needs an analytical control law and no custom functions, using the Python functions')
+            return None
+
+        module = imp.new_module('_probobj_'+problem.name+'_numba')
+        templates = ['deriv_func', 'bc_func', 'compute_control']
+        jitted = ['deriv_func', 'bc_func_left', 'bc_func_right', 'bc_func', 'compute_hamiltonian', 'compute_control']
+        if 'deriv_stm' in data:
+            # The shooting solvers pass deriv_func to the STM function, which stays a Python wrapper
+            templates.append('deriv_stm_func')
+            jitted.append('deriv_stm_rates')
+        for func in templates:
+            self.compile_function(self.template_prefix+func+self.template_suffix, module=module,
+                                  math_module='beluga.utils.realmath', flat_aux=True, numba=True)
+
+        # Numba looks the module up by name to cache the compiled code and to load it
+        # again in a later run
+        sys.modules[module.__name__] = module
+        # The compiled functions call each other through the module globals
+        for name in jitted:
+            func = getattr(module, name)
+            cache = os.path.exists(func.__code__.co_filename)
+            setattr(module, name, numba.njit(cache=cache)(func))
+
+        # Compile right away with the argument types of the solvers, so that code Numba
+        # does not support falls back to Python instead of failing in the solver
+        num_states = data['num_states']
+        X = np.ones(num_states)
+        p = np.ones(len(data['parameter_list']))
+        aux = tuple(1.0 for _ in range(len(data['aux_index']) + len(data['aux_hoisted'])))
+        calls = [(module.deriv_func, (0.0, X, p, aux)), (module.bc_func, (X, X, p, aux))]
+        if 'deriv_stm' in data:
+            calls.append((module.deriv_stm_func, (0.0, np.ones(num_states*(num_states+1)), None, p, aux)))
+        for (func, args) in calls:
+            try:
+                func(*args)
+            except NumbaError as e:
+                logging.warn('Numba cannot compile the problem functions, using the Python functions')
+                logging.debug(e)
+                return None
+            except Exception:
+                # Compiled, but the trial point is outside the domain of the problem
+                pass
+
+        funcs = {'deriv_func': module.deriv_func, 'bc_func': module.bc_func, 'control_func': module.compute_control,
+                 'bc_func_left': module.bc_func_left, 'bc_func_right': module.bc_func_right}
+        if 'deriv_stm' in data:
+            funcs['deriv_stm_func'] = module.deriv_stm_func
+        return funcs
+
+    def compile_function(self,filename,verbose=False,module=None,math_module='beluga.utils.math',flat_aux=False,
+                         numba=False):
         """
         Compiles a function specified by template in filename and stores it in
-        self.compiled
+        self.compiled, or in 'module' if given. The generated code takes its math
+        functions from 'math_module', and the aux values as a flat tuple instead of
+        a dictionary if 'flat_aux' is set. With 'numba' set, the code is restricted
+        to what Numba can compile (see make_numba_funcs)
+
+        With caching enabled, the code is written to a file in self.cache_dir named
+        after a hash of the template and the data it is rendered with, and loaded
+        through importlib. Later runs of the same problem reuse the file and its
+        bytecode without rendering the template again.
 
         Returns:
             bool: True if successful
@@ -466,18 +896,48 @@ class NecessaryConditions(object):
             if self.problem_data is None:
                 raise ValueError('Problem data not defined. Unable to compile function.')
 
-            if self.compiled is None:
+            if module is None:
+                module = self.compiled
+            if module is None:
                 raise ValueError('Problem module not defined. Unable to compile function.')
 
-            # Render the template using the data
-            code = self.renderer.render(tmpl,self.problem_data)
-            # if verbose and 'compute_control' in filename:
-            # if verbose:
-            logging.debug(code)
-
             # For security
-            self.compiled.__dict__.update({'__builtin__':{}})
-            return exec(code,self.compiled.__dict__)
+            module.__dict__.update({'__builtin__':{}})
+
+            if self.cached and self.cache_dir is not None:
+                key = json.dumps([tmpl, self.problem_data, math_module, flat_aux, numba], sort_keys=True, default=str)
+                name = os.path.basename(filename).replace('.py.mu', '')
+                path = os.path.join(self.cache_dir, '%s_%s.py' % (name, hashlib.sha1(key.encode()).hexdigest()[:16]))
+                if not os.path.exists(path):
+                    code = self.render_function(tmpl, math_module, flat_aux, numba)
+                    # Written under a temporary name first so that no partial file is ever loaded
+                    tmp_path = '%s.%d.tmp' % (path, os.getpid())
+                    with open(tmp_path, 'w') as out:
+                        out.write(code)
+                    os.replace(tmp_path, path)
+                else:
+                    logging.debug('Loading generated code from '+path)
+                # Reads or writes the bytecode in __pycache__
+                code = importlib.machinery.SourceFileLoader(name, path).get_code(name)
+                return exec(code,module.__dict__)
+
+            return exec(self.render_function(tmpl, math_module, flat_aux, numba),module.__dict__)
+
+    def render_function(self, tmpl, math_module, flat_aux, numba=False):
+        """
+        Renders the template code 'tmpl' with the problem data (see compile_function)
+
+        Besides 'numba', the templates get its negation 'interpreted': inverted sections
+        do not hide the current list item, so {{^interpreted}} is used for Numba code
+        inside of loops.
+        """
+        code = self.renderer.render(tmpl,self.problem_data,math_module=math_module,flat_aux=flat_aux,
+                                    numba=numba,interpreted=not numba)
+        if flat_aux:
+            # Boundary values are unpacked into plain variables
+            code = _boundary_pattern.sub(r'\1__\2', code)
+        logging.debug(code)
+        return code
 
     # TODO: Maybe change all constraint limits (initial, terminal etc.) to be 'constants' that can be changed by continuation?
     def sanitize_constraint(self,constraint,problem):
@@ -695,6 +1155,10 @@ class NecessaryConditions(object):
         """Perform variational calculus calculations on optimal control problem
            and returns an object describing the boundary value problem to be solved
 
+        With caching enabled (see __init__), the derived problem data is stored in
+        self.cache_dir under a hash of the problem definition (see problem_hash)
+        and reused by later runs of the same problem instead of being derived again.
+
         Returns: bvpsol.BVP object
         """
 
@@ -702,9 +1166,131 @@ class NecessaryConditions(object):
         if hasattr(problem, 'mode'):
             logging.info('Control Calculation Mode Set to: ' + problem.mode)
             mode = problem.mode
+        # Likewise for the backend of the generated functions
+        if hasattr(problem, 'backend'):
+            logging.info('Function Backend Set to: ' + problem.backend)
+            self.backend = problem.backend
+
+        # Hashed before the path constraints add their states and controls to the problem
+        cache_file = None
+        if self.cached and self.cache_dir is not None:
+            cache_file = os.path.join(self.cache_dir, 'bvp_%s.dat' % self.problem_hash(problem, mode))
+
+        self.preprocess_problem(problem)
+
+        problem_data = self.load_problem_data(cache_file) if cache_file is not None else None
+        if problem_data is None:
+            self.make_problem_data(problem, mode)
+            if cache_file is not None:
+                self.prune_cache()
+                self.save_problem_data(cache_file)
+        else:
+            self.problem_data = problem_data
+            self.problem = problem
+            # Custom functions are looked up by the names found when the data was derived
+            function_names = [aux['vars'] for aux in problem_data['aux_list'] if aux['type'] == 'function'][0]
+            self.add_functions(problem, function_names)
+
+        return self.make_bvp(problem, mode)
+
+    @staticmethod
+    def add_functions(problem, names):
+        """
+        Adds the custom functions 'names' that are not in problem.functions yet from
+        the input module of the problem
+
+        Raises:
+            ValueError: If a function is defined in neither
+        """
+        problem.functions.update((name, getattr(problem.input_module, name)) for name in names
+                                 if name not in problem.functions and
+                                    inspect.isfunction(getattr(problem.input_module, name, None)))
+
+        undefined_func = [name for name in names if name not in problem.functions]
+        if undefined_func:
+            raise ValueError('Invalid function(s) specified: '+str(undefined_func))
+
+    def problem_hash(self, problem, mode):
+        """
+        Returns a hash of everything the problem data is derived from: the
+        definition of the problem, the options of this object and the versions
+        of the deriving code (see source_hash) and of SymPy
+        """
+        definition = [_canonical([problem.systems, problem.cost, problem.quantity_list, problem.parameters,
+                                  sorted(problem.functions)]),
+                      mode, self.cse, self.hoist, source_hash(), sympy_version]
+        return hashlib.sha1(json.dumps(definition, sort_keys=True).encode()).hexdigest()[:16]
+
+    def load_problem_data(self, filename):
+        """
+        Loads problem data saved by save_problem_data
+
+        Returns:
+            dict: The problem data, or None if the file does not exist or cannot be loaded
+        """
+        if not os.path.exists(filename):
+            return None
 
-        # Should this be moved into __init__ ?
-        # self.process_systems(problem)
+        with open(filename,'rb') as f:
+            try:
+                logging.info('Loading BVP information from cache')
+                return dill.load(f)
+            except Exception as e:
+                logging.warn('Failed to load BVP from '+filename)
+                logging.debug(e)
+                return None
+
+    def save_problem_data(self, filename):
+        """
+        Saves self.problem_data to filename, see get_bvp
+        """
+        logging.info('Caching BVP information to file')
+        # Written under a temporary name first so that no partial file is ever loaded
+        tmp_filename = '%s.%d.tmp' % (filename, os.getpid())
+        try:
+            with open(tmp_filename,'wb') as f:
+                dill.dump(self.problem_data,f)
+            os.replace(tmp_filename, filename)
+        except Exception as e:
+            logging.warn('Failed to save BVP to '+filename)
+            logging.debug(e)
+
+    def prune_cache(self):
+        """
+        Deletes the problem data (see save_problem_data) and the generated code (see
+        compile_function) in self.cache_dir that was written more than
+        self.cache_max_age seconds ago, with its bytecode and Numba cache files.
+        Problems that are still in use are derived again on their next run. Other
+        files in the directory are left alone.
+        """
+        if self.cache_max_age is None:
+            return
+        oldest = _time.time() - self.cache_max_age
+        pycache = os.path.join(self.cache_dir, '__pycache__')
+        compiled = os.listdir(pycache) if os.path.isdir(pycache) else []
+        for filename in os.listdir(self.cache_dir):
+            if not _cache_entry_pattern.match(filename):
+                continue
+            stem, ext = os.path.splitext(filename)
+            path = os.path.join(self.cache_dir, filename)
+            try:
+                if os.path.getmtime(path) >= oldest:
+                    continue
+                os.remove(path)
+                if ext == '.py':
+                    for name in compiled:
+                        if name.startswith(stem + '.'):
+                            os.remove(os.path.join(pycache, name))
+            except OSError as e:
+                # Removed by another process in the meantime
+                logging.debug(e)
+
+    def preprocess_problem(self, problem):
+        """
+        Processes the quantities and the path constraints of the problem. The path
+        constraints add states, controls, constants and constraints to the problem,
+        so this is done even when the problem data is loaded from the cache.
+        """
         logging.info('Processing quantity expressions')
         # Process quantities
         # Substitute all quantities that show up in other quantities with their expressions
@@ -732,6 +1318,12 @@ class NecessaryConditions(object):
         # Regularize path constraints using saturation functions
         self.process_path_constraints(problem)
 
+    def make_problem_data(self, problem, mode):
+        """
+        Derives the necessary conditions of the preprocessed problem and stores the
+        data the generated functions are rendered with in self.problem_data
+        """
+
         # self.state_subs = [(state.sym, sympify2(state.process_eqn)) for state in problem.states()]
         ## Create costate list
         self.costates = [state.make_costate() for state in problem.states()]
@@ -767,17 +1359,7 @@ class NecessaryConditions(object):
         self.problem = problem
 
         # Load required functions from the input file
-        new_functions = {(str(f.func),getattr(problem.input_module,str(f.func)))
-                            for f in func_list
-                            if hasattr(problem.input_module,str(f.func)) and
-                                inspect.isfunction(getattr(problem.input_module,str(f.func)))}
-
-        problem.functions.update(new_functions)
-
-        undefined_func = [f.func for f in func_list if str(f.func) not in problem.functions]
-
-        if not all(x is None for x in undefined_func):
-            raise ValueError('Invalid function(s) specified: '+str(undefined_func))
+        self.add_functions(problem, sorted(set(str(f.func) for f in func_list)))
 
         # Compute costate conditions
         self.make_costate_bc(problem.states(),'initial')
@@ -874,6 +1456,55 @@ class NecessaryConditions(object):
         }
     #    problem.constraints[i].expr for i in range(len(problem.constraints))
 
+        # Numbered control options for the branch tracking in compute_control
+        self.problem_data['control_branches'] = [{'index': i, 'option': option}
+                                                 for (i, option) in enumerate(self.problem_data['control_options'])]
+
+        # Order of the flat aux tuple (see BVP.pack_aux): the aux_list variables,
+        # then the initial and the terminal values of the states
+        num_states = len(self.problem_data['state_list'])
+        self.problem_data['aux_vars'] = [var for aux in self.problem_data['aux_list'] for var in aux['vars']]
+        self.problem_data['num_aux_vars'] = num_aux = len(self.problem_data['aux_vars'])
+        self.problem_data['aux_initial_slice'] = '%d:%d' % (num_aux, num_aux + num_states)
+        self.problem_data['aux_terminal_slice'] = '%d:%d' % (num_aux + num_states, num_aux + 2*num_states)
+        self.problem_data['aux_index'] = ([(aux['type'], var) for aux in self.problem_data['aux_list'] for var in aux['vars']] +
+                     [(aux_type, state) for aux_type in ['initial', 'terminal'] for state in self.problem_data['state_list']])
+
+        # Subexpressions of the constants are hoisted out of the analytical functions
+        self.hoisting = self.hoist and self.cse and mode not in ('dae', 'num')
+        self.hoisted = {}
+        self.aux_symbols = set(Symbol(var) for aux in self.problem_data['aux_list']
+                               if aux['type'] in ('const', 'constraint') for var in aux['vars'])
+
+        # Reduced expression lists and their shared subexpressions, one set per generated function
+        for (expr_list, temporaries) in [('deriv_list','deriv_temps'), ('state_rate_list','state_rate_temps'),
+                                         ('dHdu','dHdu_temps'), ('left_bc_list','left_bc_temps'),
+                                         ('right_bc_list','right_bc_temps')]:
+            self.problem_data[temporaries], self.problem_data[expr_list+'_cse'] = self.make_cse(self.problem_data[expr_list])
+        self.problem_data['ham_temps'], [self.problem_data['ham_expr_cse']] = self.make_cse([self.ham])
+
+        # Symbolic Jacobians of deriv_func and bc_func for the analytical control mode
+        if mode not in ('dae', 'num'):
+            if not self.problem_data['control_options']:
+                self.problem_data.update(self.make_control_hessian() or {})
+            jac_data = self.make_deriv_jac()
+            if jac_data is not None:
+                self.problem_data.update(jac_data)
+            bc_jac_data = self.make_bc_jac()
+            if bc_jac_data is not None:
+                self.problem_data.update(bc_jac_data)
+            # Quantities and hoisted subexpressions used by each function
+            self.make_preludes()
+
+    def make_bvp(self, problem, mode):
+        """
+        Generates the functions of the BVP from self.problem_data
+
+        Returns: bvpsol.BVP object
+        """
+        # Tracking evaluates two options, with two options it would cost as much as the full scan
+        self.problem_data['track_branches'] = self.track_branches and len(self.problem_data['control_options']) > 2
+
         # Create problem functions by importing from templates
         self.compiled = imp.new_module('_probobj_'+problem.name)
 
@@ -886,20 +1517,73 @@ class NecessaryConditions(object):
         compile_result = [self.compile_function(self.template_prefix+func+self.template_suffix, verbose=True)
                                         for func in self.compile_list]
 
+        # Vectorized variants evaluate all columns of a (num_states, n_points) array at once
+        self.compiled_vec = imp.new_module('_probobj_'+problem.name+'_vec')
+        vec_suffix = self.template_suffix.replace('.py.mu', '_vec.py.mu')
+        for func in self.compile_list:
+            self.compile_function(self.template_prefix+func+vec_suffix, module=self.compiled_vec)
+
+        deriv_jac_func = None
+        deriv_stm_func = None
+        bc_jac_func = None
+        prepare_aux = None
+        if 'deriv_stm' in self.problem_data:
+            self.compile_function(self.template_prefix+'deriv_jac_func.py.mu')
+            self.compile_function(self.template_prefix+'deriv_stm_func.py.mu')
+            deriv_jac_func = self.compiled.deriv_jac_func
+            deriv_stm_func = self.compiled.deriv_stm_func
+        if 'bc_jac_sides' in self.problem_data:
+            self.compile_function(self.template_prefix+'bc_jac_func.py.mu')
+            bc_jac_func = self.compiled.bc_jac_func
+        if mode not in ('dae', 'num'):
+            self.compile_function(self.template_prefix+'prepare_aux.py.mu')
+            prepare_aux = self.compiled.prepare_aux
+
+        # Variants of the analytical functions for the solvers, which take the aux values
+        # as one flat tuple: a complex-safe one for complex-step derivatives and a faster
+        # real-only one for finite differences. The numerical modes always need complex
+        # numbers for their complex-step derivatives, so they only get the dictionary one.
+        flat_funcs = None
+        real_funcs = None
+        if mode not in ('dae', 'num'):
+            self.compiled_flat = imp.new_module('_probobj_'+problem.name+'_flat')
+            self.compiled_real = imp.new_module('_probobj_'+problem.name+'_real')
+            variant_list = self.compile_list + [name for (name, func) in [('deriv_jac_func', deriv_jac_func),
+                                                                          ('deriv_stm_func', deriv_stm_func),
+                                                                          ('bc_jac_func', bc_jac_func)] if func is not None]
+            for func in variant_list:
+                self.compile_function(self.template_prefix+func+self.template_suffix, module=self.compiled_flat,
+                                      flat_aux=True)
+                self.compile_function(self.template_prefix+func+self.template_suffix, module=self.compiled_real,
+                                      math_module='beluga.utils.realmath', flat_aux=True)
+            # BVP attribute of each function, the two sides of bc_func are defined with it
+            attributes = dict((func, 'control_func' if func == 'compute_control' else func) for func in variant_list)
+            attributes.update(bc_func_left='bc_func_left', bc_func_right='bc_func_right')
+            flat_funcs = dict((attr, getattr(self.compiled_flat, func)) for (func, attr) in attributes.items())
+            real_funcs = dict((attr, getattr(self.compiled_real, func)) for (func, attr) in attributes.items())
+            if self.backend == 'numba':
+                real_funcs.update(self.make_numba_funcs(problem) or {})
+
         if mode == 'dae':
             dhdu_fn = self.compiled.get_dhdu_func
-            dae_num = len(problem.controls()) + len(self.mu_vars)
+            dae_num = self.problem_data['num_controls']
         else:
             dhdu_fn = None
             dae_num = 0
 
-        self.bvp = BVP(self.compiled.deriv_func,self.compiled.bc_func,dae_func_gen=dhdu_fn,dae_num_states=dae_num)
+        self.bvp = BVP(self.compiled.deriv_func,self.compiled.bc_func,dae_func_gen=dhdu_fn,dae_num_states=dae_num,
+                       deriv_func_vec=self.compiled_vec.deriv_func,bc_func_vec=self.compiled_vec.bc_func,
+                       deriv_jac_func=deriv_jac_func,bc_jac_func=bc_jac_func,
+                       deriv_stm_func=deriv_stm_func,flat_funcs=flat_funcs,real_funcs=real_funcs,
+                       aux_index=self.problem_data['aux_index'],prepare_aux=prepare_aux,
+                       bc_func_left=self.compiled.bc_func_left,bc_func_right=self.compiled.bc_func_right)
         self.bvp.solution.aux['const'] = dict((const.var,const.val) for const in problem.constants())
         self.bvp.solution.aux['parameters'] = self.problem_data['parameter_list']
         self.bvp.solution.aux['function']  = problem.functions
 
         # TODO: Fix hardcoding of function handle name (may be needed for multivehicle/phases)?
         self.bvp.control_func = self.compiled.compute_control
+        self.bvp.control_func_vec = self.compiled_vec.compute_control
         self.bvp.problem_data = self.problem_data
         # TODO: ^^ Do same for constraint values
         return self.bvp
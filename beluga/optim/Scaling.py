@@ -146,6 +146,8 @@ class Scaling(dict):
         # Scale the states and costates
         for idx,state in enumerate(self.problem_data['state_list']):
             sol.y[idx,:] /= self.scale_vals['states'][state]
+        if sol.dense is not None:
+            sol.dense.scale([1/self.scale_vals['states'][state] for state in self.problem_data['state_list']])
 
         # Scale auxiliary variables
         for aux in (self.problem_data['aux_list']+extras):
@@ -167,6 +169,8 @@ class Scaling(dict):
         # Scale the states and costates
         for idx,state in enumerate(self.problem_data['state_list']):
             sol.y[idx,:] *= self.scale_vals['states'][state]
+        if sol.dense is not None:
+            sol.dense.scale([self.scale_vals['states'][state] for state in self.problem_data['state_list']])
 
         # Scale auxiliary variables
         for aux in (self.problem_data['aux_list']+extras):
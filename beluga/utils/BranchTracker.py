@@ -0,0 +1,67 @@
+import numpy as np
+
+class BranchTracker(object):
+    """!
+    \brief     Heuristic that remembers which of several control options minimized the Hamiltonian.
+    \details   Used by the generated compute_control functions of problems with more
+               than two control options. After a full scan of all options, the winning
+               option and the runner-up are stored. Later calls evaluate only these two
+               at the current state and keep the winner while its Hamiltonian is below
+               the runner-up's and stays within half of the scanned margin to the best
+               of the other options.
+
+               This is not a switching check. The options that are not evaluated can
+               fall below the winner between scans, and the tracked control then does
+               not minimize the Hamiltonian until the next full scan. All options are
+               scanned when the check fails, when an option failed or tied in the last
+               scan, and after 'rescan_interval' kept calls in a row. Lower it to limit
+               how long a wrong option can be kept.
+    """
+    def __init__(self, rescan_interval=100):
+        """
+        rescan_interval : number of kept calls after which all options are scanned again
+        """
+        self.rescan_interval = rescan_interval
+        self.branch = None
+        self.runner_up = None
+        self.ham = np.nan
+        self.margin = 0.0
+        self.kept = 0
+        self.tracked_solves = 0
+        self.full_scans = 0
+
+    def select(self):
+        """
+        Returns the winning option and the runner-up of the last scan, or None if
+        all options have to be scanned
+        """
+        if self.branch is None or self.kept >= self.rescan_interval or not self.margin > 0:
+            return None
+        return self.branch, self.runner_up
+
+    def keep(self, ham, ham_runner_up):
+        """
+        Returns whether to keep the tracked option, given its Hamiltonian 'ham' and
+        the runner-up's 'ham_runner_up' at the current state. The options that are
+        not evaluated are only bounded by the margin of the last scan.
+        """
+        if ham < ham_runner_up and abs(ham - self.ham) < self.margin:
+            self.kept += 1
+            self.tracked_solves += 1
+            return True
+        return False
+
+    def record(self, hams):
+        """Stores the result of a full scan, in which option i had the Hamiltonian hams[i]"""
+        hams = np.real(np.array(hams, dtype=complex))
+        order = np.argsort(np.where(np.isnan(hams), np.inf, hams), kind='stable')
+        self.branch = int(order[0])
+        self.runner_up = int(order[1])
+        self.ham = hams[order[0]]
+        # Half of the margin to the options that are not evaluated when tracking
+        if np.all(np.isfinite(hams)):
+            self.margin = 0.5*(hams[order[2]] - self.ham) if len(hams) > 2 else np.inf
+        else:
+            self.margin = 0.0
+        self.kept = 0
+        self.full_scans += 1
@@ -0,0 +1,79 @@
+import time
+import numpy as np
+import scipy.optimize
+
+class ControlSolver(object):
+    """!
+    \brief     Solves dH/du = 0 for the controls of problems without a closed-form control law.
+    \details   Used by the generated compute_control functions. Newton's method with the
+               analytic Hessian d2H/du2 starts from the controls of the nearest of the
+               recently solved states, which for a propagation is the previous stage of
+               the same trajectory. Calls for other arcs, boundaries or perturbed states
+               therefore do not overwrite each other's starting points. Complex states of
+               complex-step derivatives are solved but not remembered. When Newton's method
+               does not converge within 'max_iterations', or no Hessian is given,
+               scipy.optimize.fsolve is used from the same start.
+    """
+    def __init__(self, guess, max_iterations=10, tolerance=1e-5, time_budget=None, history=8):
+        """
+        guess          : controls used before any state has been solved
+        max_iterations : iterations of Newton's method per solve
+        tolerance      : relative step size at which Newton's method stops, as xtol of fsolve
+        time_budget    : optional time in seconds after which Newton's method gives up.
+                         Makes the choice between Newton's method and fsolve depend
+                         on the machine load, so results may differ between runs
+        history        : number of solved states kept for warm starts
+        """
+        self.guess = np.array(guess, dtype=float)
+        self.max_iterations = max_iterations
+        self.tolerance = tolerance
+        self.time_budget = time_budget
+        self.history = history
+        self.states = []
+        self.controls = []
+        self.newton_solves = 0
+        self.fallback_solves = 0
+
+    def warm_start(self, X):
+        """Returns the controls of the recently solved state nearest to X"""
+        if not self.states:
+            return self.guess
+        distances = [np.sum(np.abs(X - state)) for state in self.states]
+        return self.controls[int(np.argmin(distances))]
+
+    def newton(self, dHdu, d2Hdu2, u):
+        """Returns the controls found by Newton's method, or None if it does not converge"""
+        start = time.time()
+        for _ in range(self.max_iterations):
+            try:
+                step = np.linalg.solve(np.reshape(d2Hdu2(u), (len(u), len(u))), np.asarray(dHdu(u)))
+            except np.linalg.LinAlgError:
+                return None
+            u = u - step
+            if not np.all(np.isfinite(u)):
+                return None
+            if np.all(np.abs(step) <= self.tolerance*np.maximum(1.0, np.abs(u))):
+                return u
+            if self.time_budget is not None and time.time() - start > self.time_budget:
+                return None
+        return None
+
+    def solve(self, X, dHdu, d2Hdu2=None):
+        """
+        Returns the controls u with dHdu(u) = 0 at the state X, where d2Hdu2(u)
+        is the Jacobian of dHdu(u) with respect to u
+        """
+        u0 = self.warm_start(X)
+        u = self.newton(dHdu, d2Hdu2, u0) if d2Hdu2 is not None else None
+        if u is None:
+            u = scipy.optimize.fsolve(dHdu, u0, xtol=self.tolerance)
+            self.fallback_solves += 1
+        else:
+            self.newton_solves += 1
+
+        if not np.iscomplexobj(X):
+            self.states.append(np.array(X))
+            self.controls.append(u)
+            if len(self.states) > self.history:
+                del self.states[0], self.controls[0]
+        return u
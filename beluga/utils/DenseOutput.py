@@ -0,0 +1,71 @@
+import numpy as np
+
+class DenseOutput(object):
+    """!
+    \brief     Continuous extension of a propagated trajectory.
+    \details   Stores one polynomial per integration step,
+
+                   y(t + theta*h) = y + h*(c_1*theta + c_2*theta**2 + ... + c_d*theta**d)
+
+               with 0 <= theta <= 1, built by the propagator from its stage derivatives.
+               Calling the object evaluates the solution at any number of times at once.
+    """
+    def __init__(self, t, h, y, coeffs):
+        """
+        t      : start time of each step, shape (N,)
+        h      : signed size of each step, shape (N,)
+        y      : state at the start of each step, shape (N, n)
+        coeffs : polynomial coefficients of each step, shape (N, n, d)
+        """
+        self.t = np.asarray(t, dtype=float)
+        self.h = np.asarray(h, dtype=float)
+        self.y = np.asarray(y)
+        self.coeffs = np.asarray(coeffs)
+
+    def __call__(self, x):
+        """
+        Evaluates the solution at time(s) 'x'
+
+        Returns an array of shape (len(x), n), like the state history returned
+        by the propagators, or a vector of shape (n,) for a scalar 'x'.
+        Times outside of the propagated span are extrapolated from the first or
+        last step.
+        """
+        x = np.asarray(x, dtype=float)
+        scalar = x.ndim == 0
+        x = np.atleast_1d(x)
+
+        # Steps are stored in the direction of propagation
+        direction = 1.0 if self.h[0] >= 0 else -1.0
+        idx = np.searchsorted(direction*self.t, direction*x, side='right') - 1
+        np.clip(idx, 0, self.t.shape[0] - 1, out=idx)
+
+        h = self.h[idx]
+        theta = (x - self.t[idx])/h
+        powers = theta[:, np.newaxis]**np.arange(1, self.coeffs.shape[2] + 1)
+        y = self.y[idx] + h[:, np.newaxis]*np.einsum('knd,kd->kn', self.coeffs[idx], powers)
+        return y[0] if scalar else y
+
+    def select(self, components):
+        """Returns the continuous extension of a subset of the state components"""
+        return DenseOutput(self.t, self.h, self.y[:, components], self.coeffs[:, components])
+
+    def scale(self, factors):
+        """
+        Multiplies the leading state components by the matching entries of 'factors'
+
+        Components beyond len(factors) are left unchanged.
+        """
+        n = len(factors)
+        self.y = self.y.copy()
+        self.coeffs = self.coeffs.copy()
+        self.y[:, :n] *= factors
+        self.coeffs[:, :n] *= np.asarray(factors)[:, np.newaxis]
+
+    @staticmethod
+    def concatenate(dense_list):
+        """Joins the continuous extensions of consecutive arcs"""
+        return DenseOutput(np.concatenate([d.t for d in dense_list]),
+                           np.concatenate([d.h for d in dense_list]),
+                           np.concatenate([d.y for d in dense_list]),
+                           np.concatenate([d.coeffs for d in dense_list]))
@@ -0,0 +1,52 @@
+import numpy as np
+
+class IntegratorStats(object):
+    """!
+    \brief     Cost statistics of one or more propagations.
+    \details   Returned by the propagators as an extra output when the option 'return_stats'
+               is set. Records of several propagations, e.g. the arcs of a multiple shooting
+               iteration or all iterations of a Newton solve, are combined with '+' or
+               IntegratorStats.total().
+    """
+    def __init__(self, nfevals=0, naccepted=0, nrejected=0, min_step=np.inf, max_step=0.0, wall_time=0.0, npropagations=0):
+        """
+        nfevals       : number of evaluations of the ODE function
+        naccepted     : number of accepted steps
+        nrejected     : number of rejected steps
+        min_step      : smallest magnitude of an accepted step
+        max_step      : largest magnitude of an accepted step
+        wall_time     : time spent in the propagator, in seconds
+        npropagations : number of propagator calls
+        """
+        self.nfevals = nfevals
+        self.naccepted = naccepted
+        self.nrejected = nrejected
+        self.min_step = min_step
+        self.max_step = max_step
+        self.wall_time = wall_time
+        self.npropagations = npropagations
+
+    def __add__(self, other):
+        return IntegratorStats(self.nfevals + other.nfevals,
+                               self.naccepted + other.naccepted,
+                               self.nrejected + other.nrejected,
+                               min(self.min_step, other.min_step),
+                               max(self.max_step, other.max_step),
+                               self.wall_time + other.wall_time,
+                               self.npropagations + other.npropagations)
+
+    @staticmethod
+    def total(stats_list):
+        """Combines a list of records, which may be empty"""
+        total = IntegratorStats()
+        for stats in stats_list:
+            total = total + stats
+        return total
+
+    def __repr__(self):
+        return ('IntegratorStats(nfevals=%d, naccepted=%d, nrejected=%d, min_step=%g, max_step=%g, wall_time=%g, npropagations=%d)' %
+                (self.nfevals, self.naccepted, self.nrejected, self.min_step, self.max_step, self.wall_time, self.npropagations))
+
+    def __str__(self):
+        return ('%d propagations, %d function calls, %d accepted and %d rejected steps, step size from %g to %g, %0.4f seconds' %
+                (self.npropagations, self.nfevals, self.naccepted, self.nrejected, self.min_step, self.max_step, self.wall_time))
@@ -1,6 +1,7 @@
 from .propagators import *
 import os
 from beluga.utils import keyboard
+from beluga.utils.IntegratorStats import IntegratorStats
 from multiprocessing_on_dill import pool
 import dill
 
@@ -16,7 +17,7 @@ class Propagator(object):
     \version   0.1
     \date      08/08/15
     """
-    def __init__(self, solver='ode45', process_count=-1):
+    def __init__(self, solver='ode45', process_count=-1, batched=False):
         possibles = globals().copy()
         possibles.update(locals())
         method = possibles.get(solver)
@@ -34,6 +35,12 @@ class Propagator(object):
 
         self.poolinitialized = False
 
+        # Propagate multiple arcs together in one vectorized loop
+        # The ODE function is then expected to accept stacked states (see dopri5_batch)
+        if batched and method is not dopri5:
+            raise Exception("Batched propagation is only implemented for dopri5")
+        self.batched = batched
+
     def __call__(self, f, tspan, y0, *args, **kwargs):
         # Solve can handle either tspan with list length 2, and numpy array y0 for a SINGLE arc
         # or a tspan list the same length as y0 list for MULTIPLE arcs
@@ -41,24 +48,44 @@ class Propagator(object):
 
         # Check if y0 is a list or np array. If it's a list, use parallel processing. Need to find a better way of determining parallel computations!
         if isinstance(y0,np.ndarray):
-            sol = self.solver(f, tspan, y0, *args, **kwargs)
+            return self.solver(f, tspan, y0, *args, **kwargs)
         else:
-            if self.poolinitialized:
+            if self.batched:
+                return dopri5_batch(f, tspan, y0, *args, **kwargs)
+            elif self.poolinitialized:
                 multisol = [self.pool.apply_async(self.solver,(f,t,y) + args,(kwargs)) for (t,y) in zip(tspan,y0)]
-                t_and_y = [s.get() for s in multisol]
+                t_and_y = []
+                aborted = None
+                for s in multisol:
+                    try:
+                        t_and_y.append(s.get())
+                    except RuntimeError as e:
+                        aborted = aborted or e
+                if aborted is not None:
+                    self.__raise_aborted(aborted, t_and_y, kwargs)
 
                 sol = list(zip(*t_and_y))
                 return sol
 
             else:
-                tout = []
-                yout = []
+                # Regroup per-arc outputs (t, y and optionally dense output) into lists
+                t_and_y = []
                 for i in range(len(y0)):
-                    ttemp, ytemp = ode45(f,tspan[i], y0[i], *args, **kwargs)
-                    tout.append(ttemp)
-                    yout.append(ytemp)
+                    try:
+                        t_and_y.append(self.solver(f,tspan[i], y0[i], *args, **kwargs))
+                    except RuntimeError as e:
+                        self.__raise_aborted(e, t_and_y, kwargs)
+                return tuple(list(out) for out in zip(*t_and_y))
 
-                return tout, yout
+    @staticmethod
+    def __raise_aborted(e, t_and_y, kwargs):
+        """
+        Raises the error of an aborted arc. If it carries the statistics of that arc
+        (see dopri5), those of the finished arcs are added to them.
+        """
+        if kwargs.get('return_stats') and hasattr(e, 'stats'):
+            e.stats = IntegratorStats.total([out[-1] for out in t_and_y]) + e.stats
+        raise e
 
     def startPool(self):
         if dill.__version__ == '0.2.5':
@@ -80,4 +107,6 @@ class Propagator(object):
         method = possibles.get(solver)
         if not method:
              raise Exception("Method %s not implemented" % solver)
+        if self.batched and method is not dopri5:
+            raise Exception("Batched propagation is only implemented for dopri5")
         self.solver = method
@@ -7,6 +7,10 @@ from .sympify2 import sympify2
 from .ode45_old import ode45_old
 from .ode45 import ode45_multi
 from .Propagator import Propagator
+from .DenseOutput import DenseOutput
+from .IntegratorStats import IntegratorStats
+from .ControlSolver import ControlSolver
+from .BranchTracker import BranchTracker
 from .ipsh import ipsh
 from .timeout import timeout
 
@@ -2,6 +2,7 @@ import scipy.integrate
 import numpy as np
 
 from beluga.utils.ode45_old import ode45_old
+from beluga.utils.propagators.dopri5 import dopri5
 
 def ode_wrap(func,*args):   # Required for odeint
     def func_wrapper(t,y):
@@ -37,7 +38,7 @@ def ode45_multi(f,tspan,y0,*args,**kwargs):
         y0 = [y0]
 
     # Propagate multiple arcs in parallel utilizing all cores available
-    t_and_y = Parallel(n_jobs=-1)(delayed(ode45_old)(f,t,y,*args,**kwargs)
+    t_and_y = Parallel(n_jobs=-1)(delayed(dopri5)(f,t,y,*args,**kwargs)
         for (t,y) in zip(tspan,y0))
     # t1_y1 = [ode45_old(f,t,y,*args,**kwargs) for (t,y) in t_and_y]
     return list(zip(*t_and_y))
@@ -45,7 +46,7 @@ def ode45_multi(f,tspan,y0,*args,**kwargs):
 def ode45(f,tspan,y0,*args,**kwargs):
     """Implements interface similar to MATLAB's ode45 using scipy"""
 
-    return ode45_old(f,tspan,y0,*args,**kwargs)
+    return dopri5(f,tspan,y0,*args,**kwargs)
 
     if len(tspan) == 2:
         # TODO: Change hardcoding?
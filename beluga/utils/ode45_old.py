@@ -3,6 +3,7 @@
 
 from numpy import double, sign, finfo, array, zeros, dot, mod, size, inf, all, max, min, abs, mat
 from numpy.linalg import norm
+from time import time
 import logging
 
 def warning(type, string):
@@ -26,12 +27,31 @@ def processOdeArgs(**kwargs):
                 'reltol': 1e-5,
                 'abstol': 1e-5,			# absolute tolerance
                 'outputsel': None,		# which components to save
+                'errorsel': None,		# which components to use for error control
                 # save output every outputsave steps
                 'outputsave': None,
                 'initialstep': None,
                 'maxstep': None,
                 'mass': None,
-                'stats': 'off'			# statistics
+                'stats': 'off',			# statistics
+                # also return an IntegratorStats record
+                'return_stats': False,
+                # also return a continuous extension of the solution
+                'dense_output': False,
+                # Jacobian of the ODE function (implicit propagators)
+                'jacobian': None,
+                # number of states followed by their STM in the state vector
+                'stm': None,
+                # event functions g(t,y,*args) located during propagation
+                'events': None,
+                # bound on the magnitude of the states (scalar or per component)
+                'maxstate': None,
+                # abort if the error estimate of a step on fixed time stamps exceeds the tolerances
+                'gridcheck': False,
+                # ODE function accepts a vector of times and one column of states per time (mcpi)
+                'vectorized': False,
+                # callable approximating the solution, starts iterative propagators (mcpi)
+                'guess': None
                 }
 
     if len(kwargs) > 0:
@@ -48,6 +68,7 @@ def processOdeArgs(**kwargs):
 
 def ode45_old(vfun, vslot, vinit, *args, **kwargs):
     # test input types etc
+    vstarttime = time()
 
     # process keyword arguments
     vodeoptions = processOdeArgs(**kwargs)
@@ -168,6 +189,7 @@ def ode45_old(vfun, vslot, vinit, *args, **kwargs):
     vk = zeros([6, d])
 
     vcntiter = 0
+    vminstep, vmaxstep = inf, 0.0
     while (vdirection * (vtimestamp) < vdirection * (vtimestop)) and (vdirection * (vstepsize) >= vdirection * (vminstepsize)):
         # Hit the endpoint of the time slot exactly
         if vtimestamp + vstepsize > vdirection * vtimestop:
@@ -218,6 +240,8 @@ def ode45_old(vfun, vslot, vinit, *args, **kwargs):
 
         # If the error is acceptable then update the vretval variables
         if all(vdelta <= vtau):
+            vminstep = min([vminstep, abs(vstepsize)])
+            vmaxstep = max([vmaxstep, abs(vstepsize)])
             vtimestamp = vtimestamp + vstepsize
             vu = y5  # use higher order estimation as "local extrapolation"
             # Save the solution every vodeoptions['outputsave'] steps
@@ -289,13 +313,14 @@ def ode45_old(vfun, vslot, vinit, *args, **kwargs):
         vretvaltime.append(vtimestamp)
         vretvalresult.append(vu)
 
+    vnsteps = vcntloop - 2						# vcntloop from 2..end
+    # vcntcycl from 1..end
+    vnfailed = (vcntcycles - 1) - (vcntloop - 2) + 1
+    vnfevals = 6 * (vcntcycles - 1)					# number of ode evaluations
+
     # Print additional information if option stats is set
     if vodeoptions['stats'] == 'on':
         vhavestats = True
-        vnsteps = vcntloop - 2						# vcntloop from 2..end
-        # vcntcycl from 1..end
-        vnfailed = (vcntcycles - 1) - (vcntloop - 2) + 1
-        vnfevals = 6 * (vcntcycles - 1)					# number of ode evaluations
         vndecomps = 0									# number of LU decompositions
         vnpds = 0									# number of partial derivatives
         vnlinsols = 0									# no. of solutions of linear systems
@@ -311,4 +336,7 @@ def ode45_old(vfun, vslot, vinit, *args, **kwargs):
     if vhaveoutputselection:
         vretvalresult = vretvalresult.transpose(
         )[vodeoptions['outputsel']].transpose()
+    if vodeoptions['return_stats']:
+        from beluga.utils.IntegratorStats import IntegratorStats
+        return (vretvaltime, vretvalresult, IntegratorStats(vnfevals, vnsteps, vnfailed, vminstep, vmaxstep, time() - vstarttime, 1))
     return (vretvaltime, vretvalresult)
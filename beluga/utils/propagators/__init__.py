@@ -1,6 +1,10 @@
 from .ode45 import ode45
 from .ode45n import ode45n
 from .mcpi import mcpi
+from .dopri5 import dopri5
+from .dop853 import dop853
+from .dopri5_batch import dopri5_batch
+from .rosenbrock import rosenbrock
 
 import os
 import glob
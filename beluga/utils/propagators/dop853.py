@@ -0,0 +1,502 @@
+import numpy as np
+from time import time
+from numpy.linalg import norm
+
+from beluga.utils.ode45_old import processOdeArgs, error, warning
+from beluga.utils.DenseOutput import DenseOutput
+from beluga.utils.IntegratorStats import IntegratorStats
+from .dopri5 import _grow, _interpolate, _locate_events, _abort_nonfinite, _abort_grid_error, _check_bounds, _SAFETY, _MIN_FACTOR, _MAX_FACTOR, _MAX_REJECTED, _MAX_NONFINITE, _INITIAL_BUFFER
+
+# Dormand-Prince 8(5,3) coefficients. Stages 13 to 15 are only needed for the
+# continuous extension of order 7.
+# Ref: Hairer, Norsett & Wanner, "Solving Ordinary Differential Equations I", Section II.10
+#      and the accompanying code dop853.f
+_C = np.array([
+    0.0,
+    0.526001519587677318785587544488e-01,
+    0.789002279381515978178381316732e-01,
+    0.118350341907227396726757197510,
+    0.281649658092772603273242802490,
+    0.333333333333333333333333333333,
+    0.25,
+    0.307692307692307692307692307692,
+    0.651282051282051282051282051282,
+    0.6,
+    0.857142857142857142857142857142,
+    1.0,
+    1.0,
+    0.1,
+    0.2,
+    0.777777777777777777777777777778])
+_A = np.zeros((16, 16))
+_A[1, 0] = 5.26001519587677318785587544488e-2
+
+_A[2, 0] = 1.97250569845378994544595329183e-2
+_A[2, 1] = 5.91751709536136983633785987549e-2
+
+_A[3, 0] = 2.95875854768068491816892993775e-2
+_A[3, 2] = 8.87627564304205475450678981324e-2
+
+_A[4, 0] = 2.41365134159266685502369798665e-1
+_A[4, 2] = -8.84549479328286085344864962717e-1
+_A[4, 3] = 9.24834003261792003115737966543e-1
+
+_A[5, 0] = 3.7037037037037037037037037037e-2
+_A[5, 3] = 1.70828608729473871279604482173e-1
+_A[5, 4] = 1.25467687566822425016691814123e-1
+
+_A[6, 0] = 3.7109375e-2
+_A[6, 3] = 1.70252211019544039314978060272e-1
+_A[6, 4] = 6.02165389804559606850219397283e-2
+_A[6, 5] = -1.7578125e-2
+
+_A[7, 0] = 3.70920001185047927108779319836e-2
+_A[7, 3] = 1.70383925712239993810214054705e-1
+_A[7, 4] = 1.07262030446373284651809199168e-1
+_A[7, 5] = -1.53194377486244017527936158236e-2
+_A[7, 6] = 8.27378916381402288758473766002e-3
+
+_A[8, 0] = 6.24110958716075717114429577812e-1
+_A[8, 3] = -3.36089262944694129406857109825
+_A[8, 4] = -8.68219346841726006818189891453e-1
+_A[8, 5] = 2.75920996994467083049415600797e1
+_A[8, 6] = 2.01540675504778934086186788979e1
+_A[8, 7] = -4.34898841810699588477366255144e1
+
+_A[9, 0] = 4.77662536438264365890433908527e-1
+_A[9, 3] = -2.48811461997166764192642586468
+_A[9, 4] = -5.90290826836842996371446475743e-1
+_A[9, 5] = 2.12300514481811942347288949897e1
+_A[9, 6] = 1.52792336328824235832596922938e1
+_A[9, 7] = -3.32882109689848629194453265587e1
+_A[9, 8] = -2.03312017085086261358222928593e-2
+
+_A[10, 0] = -9.3714243008598732571704021658e-1
+_A[10, 3] = 5.18637242884406370830023853209
+_A[10, 4] = 1.09143734899672957818500254654
+_A[10, 5] = -8.14978701074692612513997267357
+_A[10, 6] = -1.85200656599969598641566180701e1
+_A[10, 7] = 2.27394870993505042818970056734e1
+_A[10, 8] = 2.49360555267965238987089396762
+_A[10, 9] = -3.0467644718982195003823669022
+
+_A[11, 0] = 2.27331014751653820792359768449
+_A[11, 3] = -1.05344954667372501984066689879e1
+_A[11, 4] = -2.00087205822486249909675718444
+_A[11, 5] = -1.79589318631187989172765950534e1
+_A[11, 6] = 2.79488845294199600508499808837e1
+_A[11, 7] = -2.85899827713502369474065508674
+_A[11, 8] = -8.87285693353062954433549289258
+_A[11, 9] = 1.23605671757943030647266201528e1
+_A[11, 10] = 6.43392746015763530355970484046e-1
+
+_A[12, 0] = 5.42937341165687622380535766363e-2
+_A[12, 5] = 4.45031289275240888144113950566
+_A[12, 6] = 1.89151789931450038304281599044
+_A[12, 7] = -5.8012039600105847814672114227
+_A[12, 8] = 3.1116436695781989440891606237e-1
+_A[12, 9] = -1.52160949662516078556178806805e-1
+_A[12, 10] = 2.01365400804030348374776537501e-1
+_A[12, 11] = 4.47106157277725905176885569043e-2
+
+_A[13, 0] = 5.61675022830479523392909219681e-2
+_A[13, 6] = 2.53500210216624811088794765333e-1
+_A[13, 7] = -2.46239037470802489917441475441e-1
+_A[13, 8] = -1.24191423263816360469010140626e-1
+_A[13, 9] = 1.5329179827876569731206322685e-1
+_A[13, 10] = 8.20105229563468988491666602057e-3
+_A[13, 11] = 7.56789766054569976138603589584e-3
+_A[13, 12] = -8.298e-3
+
+_A[14, 0] = 3.18346481635021405060768473261e-2
+_A[14, 5] = 2.83009096723667755288322961402e-2
+_A[14, 6] = 5.35419883074385676223797384372e-2
+_A[14, 7] = -5.49237485713909884646569340306e-2
+_A[14, 10] = -1.08347328697249322858509316994e-4
+_A[14, 11] = 3.82571090835658412954920192323e-4
+_A[14, 12] = -3.40465008687404560802977114492e-4
+_A[14, 13] = 1.41312443674632500278074618366e-1
+
+_A[15, 0] = -4.28896301583791923408573538692e-1
+_A[15, 5] = -4.69762141536116384314449447206
+_A[15, 6] = 7.68342119606259904184240953878
+_A[15, 7] = 4.06898981839711007970213554331
+_A[15, 8] = 3.56727187455281109270669543021e-1
+_A[15, 12] = -1.39902416515901462129418009734e-3
+_A[15, 13] = 2.9475147891527723389556272149
+_A[15, 14] = -9.15095847217987001081870187138
+
+# 8th order weights, stage 13 is the derivative at the end of the step (FSAL)
+_B = _A[12, :12]
+
+# Differences between the 8th order weights and the embedded 5th and 3rd order ones
+_E3 = np.zeros(13)
+_E3[:12] = _B
+_E3[0] -= 0.244094488188976377952755905512
+_E3[8] -= 0.733846688281611857341361741547
+_E3[11] -= 0.220588235294117647058823529412e-1
+
+_E5 = np.zeros(13)
+_E5[0] = 0.1312004499419488073250102996e-1
+_E5[5] = -0.1225156446376204440720569753e+1
+_E5[6] = -0.4957589496572501915214079952
+_E5[7] = 0.1664377182454986536961530415e+1
+_E5[8] = -0.3503288487499736816886487290
+_E5[9] = 0.3341791187130174790297318841
+_E5[10] = 0.8192320648511571246570742613e-1
+_E5[11] = -0.2235530786388629525884427845e-1
+
+# Dense output of dop853.f,
+#   y(t + theta*h) = y + F_0*theta + F_1*theta*(1 - theta) + F_2*theta**2*(1 - theta) + ...
+# with F_0 = y_new - y, F_1 = h*f - F_0, F_2 = 2*F_0 - h*(f + f_new) and F_3 to F_6
+# given by the rows of D times h*K
+_D = np.zeros((4, 16))
+_D[0, 0] = -0.84289382761090128651353491142e+1
+_D[0, 5] = 0.56671495351937776962531783590
+_D[0, 6] = -0.30689499459498916912797304727e+1
+_D[0, 7] = 0.23846676565120698287728149680e+1
+_D[0, 8] = 0.21170345824450282767155149946e+1
+_D[0, 9] = -0.87139158377797299206789907490
+_D[0, 10] = 0.22404374302607882758541771650e+1
+_D[0, 11] = 0.63157877876946881815570249290
+_D[0, 12] = -0.88990336451333310820698117400e-1
+_D[0, 13] = 0.18148505520854727256656404962e+2
+_D[0, 14] = -0.91946323924783554000451984436e+1
+_D[0, 15] = -0.44360363875948939664310572000e+1
+
+_D[1, 0] = 0.10427508642579134603413151009e+2
+_D[1, 5] = 0.24228349177525818288430175319e+3
+_D[1, 6] = 0.16520045171727028198505394887e+3
+_D[1, 7] = -0.37454675472269020279518312152e+3
+_D[1, 8] = -0.22113666853125306036270938578e+2
+_D[1, 9] = 0.77334326684722638389603898808e+1
+_D[1, 10] = -0.30674084731089398182061213626e+2
+_D[1, 11] = -0.93321305264302278729567221706e+1
+_D[1, 12] = 0.15697238121770843886131091075e+2
+_D[1, 13] = -0.31139403219565177677282850411e+2
+_D[1, 14] = -0.93529243588444783865713862664e+1
+_D[1, 15] = 0.35816841486394083752465898540e+2
+
+_D[2, 0] = 0.19985053242002433820987653617e+2
+_D[2, 5] = -0.38703730874935176555105901742e+3
+_D[2, 6] = -0.18917813819516756882830838328e+3
+_D[2, 7] = 0.52780815920542364900561016686e+3
+_D[2, 8] = -0.11573902539959630126141871134e+2
+_D[2, 9] = 0.68812326946963000169666922661e+1
+_D[2, 10] = -0.10006050966910838403183860980e+1
+_D[2, 11] = 0.77771377980534432092869265740
+_D[2, 12] = -0.27782057523535084065932004339e+1
+_D[2, 13] = -0.60196695231264120758267380846e+2
+_D[2, 14] = 0.84320405506677161018159903784e+2
+_D[2, 15] = 0.11992291136182789328035130030e+2
+
+_D[3, 0] = -0.25693933462703749003312586129e+2
+_D[3, 5] = -0.15418974869023643374053993627e+3
+_D[3, 6] = -0.23152937917604549567536039109e+3
+_D[3, 7] = 0.35763911791061412378285349910e+3
+_D[3, 8] = 0.93405324183624310003907691704e+2
+_D[3, 9] = -0.37458323136451633156875139351e+2
+_D[3, 10] = 0.10409964950896230045147246184e+3
+_D[3, 11] = 0.29840293426660503123344363579e+2
+_D[3, 12] = -0.43533456590011143754432175058e+2
+_D[3, 13] = 0.96324553959188282948394950600e+2
+_D[3, 14] = -0.39177261675615439165231486172e+2
+_D[3, 15] = -0.14972683625798562581422125276e+3
+
+def _dense_matrix():
+    """Rewrites the dense output of dop853.f as y + h*K^T*P*[theta, theta^2, ..., theta^7]"""
+    # Weights of the 16 stages in F_0/h to F_6/h
+    W = np.zeros((7, 16))
+    W[0, :12] = _B
+    W[1, 0] = 1
+    W[1, :12] -= _B
+    W[2, :12] = 2*_B
+    W[2, 0] -= 1
+    W[2, 12] -= 1
+    W[3:] = _D
+
+    # Monomial coefficients of the polynomials multiplying F_0 to F_6
+    poly = np.polynomial.polynomial
+    basis = [poly.polymul(poly.polypow([0, 1], (j + 2)//2), poly.polypow([1, -1], (j + 1)//2)) for j in range(7)]
+    M = np.zeros((7, 8))
+    for j, b in enumerate(basis):
+        M[j, :len(b)] = b
+    return np.dot(W.T, M[:, 1:])
+
+_P = _dense_matrix()
+
+_STAGES = 12
+_ERROR_ORDER = 8
+
+def dop853(vfun, vslot, vinit, *args, **kwargs):
+    """!
+    \brief     Dormand-Prince 8(5,3) propagator for long, smooth arcs at tight tolerances.
+    \details   Same signature, options and outputs as dopri5. Every step costs twelve
+               evaluations of 'vfun', the last stage of an accepted step is reused as the
+               first stage of the next one. The error estimate combines the embedded 5th
+               and 3rd order solutions as in dop853.f.
+
+               The continuous extension is of order 7 and needs three more evaluations
+               of 'vfun' per step. They are only done if 'dense_output' or 'events' is
+               set.
+    """
+    start_time = time()
+    options = processOdeArgs(**kwargs)
+
+    tspan = np.array(vslot, ndmin=1, dtype=float)
+    y0 = np.array(vinit, ndmin=1)
+    dtype = np.result_type(y0, float)
+    y = y0.astype(dtype)
+    n = y.shape[0]
+
+    fixed_step = len(tspan) > 2
+    gridcheck = options['gridcheck']
+    t0, tf = tspan[0], tspan[-1]
+    direction = 1.0 if tf >= t0 else -1.0
+    span = abs(tf - t0)
+
+    # Tolerances are ignored if fixed time stamps are given, unless gridcheck is set
+    normcontrol = options['normcontrol'] == 'on'
+    reltol, abstol = options['reltol'], options['abstol']
+    errorsel = options['errorsel']
+    if errorsel is None:
+        errorsel = slice(None)
+
+    nonnegative = options['nonnegative']
+    if nonnegative is not None and options['mass'] is not None:
+        warning('OdePkg:InvalidArgument', 'Option "nonnegative" will be ignored if mass matrix is set')
+        nonnegative = None
+
+    outputsave = options['outputsave'] or 1
+    dense_output = options['dense_output']
+    maxstate = options['maxstate']
+
+    events = options['events']
+    if callable(events):
+        events = [events]
+    extended = dense_output or bool(events)
+
+    maxstep = options['maxstep']
+    if maxstep is None:
+        maxstep = span/10
+    maxstep = abs(maxstep)
+
+    h = options['initialstep']
+    if h is None:
+        h = span/100
+    h = min(abs(h), maxstep)
+
+    # Preallocated work arrays
+    K = np.empty((16, n), dtype=dtype)
+    y_new = np.empty(n, dtype=dtype)
+    y_stage = np.empty(n, dtype=dtype)
+
+    # Growable output buffers
+    capacity = len(tspan) if fixed_step else _INITIAL_BUFFER
+    tout = np.empty(capacity)
+    yout = np.empty((capacity, n), dtype=dtype)
+    tout[0] = t0
+    yout[0] = y
+    count = 1
+
+    if dense_output:
+        dense_t = np.empty(capacity)
+        dense_h = np.empty(capacity)
+        dense_y = np.empty((capacity, n), dtype=dtype)
+        dense_q = np.empty((capacity, n, _P.shape[1]), dtype=dtype)
+        dense_count = 0
+
+    t = t0
+    K[0] = vfun(t, y, *args)
+    if not np.all(np.isfinite(K[0])):
+        _abort_nonfinite(t)
+    nfevals = 1
+    nsteps = 0
+    nfailed = 0
+    smallest_step, largest_step = np.inf, 0.0
+    rejected = 0
+    nonfinite = 0
+    t_nonfinite = t0
+    last_saved = True
+    grid_idx = 1
+
+    if events:
+        g_old = np.array([g(t, y, *args) for g in events])
+        t_events = [[] for _ in events]
+        y_events = [[] for _ in events]
+
+    while direction*(tf - t) > 0:
+        if fixed_step:
+            if grid_idx >= len(tspan):
+                break
+            step = tspan[grid_idx] - t
+        else:
+            min_step = 16*np.finfo(float).eps*max(abs(t), span)
+            if h < min_step:
+                error('OdePkg:InvalidArgument', 'Solving has not been successful. The iterative integration loop exited at time t = %f before endpoint at tend = %f was reached. This may happen if the stepsize grows smaller than defined in vminstepsize. Try to reduce the value of "initialstep" and/or "maxstep" with the command "odeset".\n' %
+                      (t, tf))
+            # Hit the endpoint of the time slot exactly
+            if h >= abs(tf - t):
+                h = abs(tf - t)
+            step = direction*h
+
+        for i in range(1, _STAGES):
+            np.dot(_A[i, :i], K[:i], out=y_stage)
+            y_stage *= step
+            y_stage += y
+            K[i] = vfun(t + _C[i]*step, y_stage, *args)
+
+        np.dot(_B, K[:_STAGES], out=y_new)
+        y_new *= step
+        y_new += y
+        if nonnegative is not None:
+            y_new[nonnegative] = np.abs(y_new[nonnegative])
+
+        # FSAL stage: derivative at the end of the step
+        K[_STAGES] = vfun(t + step, y_new, *args)
+        nfevals += _STAGES
+
+        if not (np.all(np.isfinite(y_new)) and np.all(np.isfinite(K[_STAGES]))):
+            # Retry with a smaller step in case the trial step left the domain of 'vfun'
+            nonfinite += 1
+            t_nonfinite = t + step
+            if fixed_step or nonfinite >= _MAX_NONFINITE:
+                _abort_nonfinite(t + step)
+            accept = False
+            factor = _MIN_FACTOR
+        elif fixed_step and not gridcheck:
+            accept = True
+        else:
+            err5 = np.dot(_E5, K[:_STAGES + 1, errorsel])
+            err3 = np.dot(_E3, K[:_STAGES + 1, errorsel])
+            if normcontrol:
+                tau = max(reltol*max(norm(y[errorsel], np.inf), 1.0), abstol)
+                err5 = norm(err5, np.inf)/tau
+                err3 = norm(err3, np.inf)/tau
+            else:
+                tau = np.maximum(reltol*np.abs(y[errorsel]), abstol)
+                err5 = np.max(np.abs(err5)/tau)
+                err3 = np.max(np.abs(err3)/tau)
+            # The 3rd order estimate guards against a vanishing 5th order one
+            denom = np.sqrt(err5**2 + 0.01*err3**2)
+            ratio = 0.0 if denom == 0 else abs(step)*err5**2/denom
+            accept = ratio <= 1.0
+            if fixed_step and not accept:
+                _abort_grid_error(t + step, IntegratorStats(nfevals, nsteps, nfailed + 1, smallest_step, largest_step, time() - start_time, 1))
+
+            if ratio == 0:
+                factor = _MAX_FACTOR
+            else:
+                factor = min(_MAX_FACTOR, max(_MIN_FACTOR, _SAFETY*ratio**(-1./_ERROR_ORDER)))
+            if not accept:
+                factor = min(factor, 1.0)
+
+        if accept:
+            if extended:
+                # Extra stages of the continuous extension
+                for i in range(_STAGES + 1, 16):
+                    np.dot(_A[i, :i], K[:i], out=y_stage)
+                    y_stage *= step
+                    y_stage += y
+                    K[i] = vfun(t + _C[i]*step, y_stage, *args)
+                nfevals += 3
+
+            if dense_output:
+                if dense_count == dense_t.shape[0]:
+                    dense_t = _grow(dense_t, dense_count)
+                    dense_h = _grow(dense_h, dense_count)
+                    dense_y = _grow(dense_y, dense_count)
+                    dense_q = _grow(dense_q, dense_count)
+                dense_t[dense_count] = t
+                dense_h[dense_count] = step
+                dense_y[dense_count] = y
+                np.dot(K.T, _P, out=dense_q[dense_count])
+                dense_count += 1
+
+            terminal = False
+            if events:
+                g_new = np.array([g(t + step, y_new, *args) for g in events])
+                q = np.dot(K.T, _P)
+                for (theta, i) in _locate_events(events, g_old, g_new, t, step, y, q, args):
+                    t_event = t + theta*step
+                    y_event = _interpolate(y, step, q, theta)
+                    t_events[i].append(t_event)
+                    y_events[i].append(y_event)
+                    if getattr(events[i], 'terminal', False):
+                        terminal = True
+                        break
+                g_old = g_new
+
+            t = t + step
+            y, y_new = y_new, y
+            K[0] = K[_STAGES]
+            nsteps += 1
+            smallest_step = min(smallest_step, abs(step))
+            largest_step = max(largest_step, abs(step))
+            rejected = 0
+            grid_idx += 1
+            # Count non-finite trial steps again once the propagation got past them
+            if direction*(t - t_nonfinite) >= 0:
+                nonfinite = 0
+
+            if terminal:
+                t = t_event
+                y[:] = y_event
+            if maxstate is not None:
+                _check_bounds(t, y, maxstate)
+
+            last_saved = nsteps % outputsave == 0
+            if last_saved:
+                if count == tout.shape[0]:
+                    tout = _grow(tout, count)
+                    yout = _grow(yout, count)
+                tout[count] = t
+                yout[count] = y
+                count += 1
+
+            if terminal:
+                break
+        else:
+            nfailed += 1
+            rejected += 1
+            if rejected >= _MAX_REJECTED:
+                error("fatal", "Solving has not been successful. The iterative integration loop exited at time t = %f before endpoint at tend = %f was reached. This happened because the iterative integration loop does not find a valid solution at this time stamp. Try to reduce the value of \"initialstep\" and/or \"maxstep\" with the command \"odeset\".\n" %
+                      (t, tf))
+
+        if not fixed_step:
+            h = min(maxstep, h*factor)
+
+    # Save the last step, if not already saved
+    if not last_saved:
+        if count == tout.shape[0]:
+            tout = _grow(tout, count)
+            yout = _grow(yout, count)
+        tout[count] = t
+        yout[count] = y
+        count += 1
+
+    if options['stats'] == 'on':
+        print('Number of successful steps %d' % nsteps)
+        print('Number of failed attempts:  %d' % nfailed)
+        print('Number of function calls:   %d' % nfevals)
+
+    tout = tout[:count]
+    yout = yout[:count]
+    if options['outputsel'] is not None:
+        yout = yout[:, options['outputsel']]
+
+    result = (tout, yout)
+    if dense_output:
+        dense = DenseOutput(dense_t[:dense_count], dense_h[:dense_count], dense_y[:dense_count], dense_q[:dense_count])
+        if options['outputsel'] is not None:
+            dense = dense.select(options['outputsel'])
+        result += (dense,)
+    if events:
+        t_events = [np.array(te) for te in t_events]
+        y_events = [np.array(ye).reshape((-1, n)) for ye in y_events]
+        if options['outputsel'] is not None:
+            y_events = [ye[:, options['outputsel']] for ye in y_events]
+        result += (t_events, y_events)
+    if options['return_stats']:
+        result += (IntegratorStats(nfevals, nsteps, nfailed, smallest_step, largest_step, time() - start_time, 1),)
+    return result
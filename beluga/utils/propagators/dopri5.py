@@ -0,0 +1,378 @@
+import numpy as np
+from time import time
+from numpy.linalg import norm
+from scipy.optimize import brentq
+
+from beluga.utils.ode45_old import processOdeArgs, error, warning
+from beluga.utils.DenseOutput import DenseOutput
+from beluga.utils.IntegratorStats import IntegratorStats
+
+# Dormand-Prince 5(4) coefficients
+# Ref: Hairer, Norsett & Wanner, "Solving Ordinary Differential Equations I", Table 5.2
+_C = np.array([0, 1./5, 3./10, 4./5, 8./9, 1., 1.])
+_A = np.array([
+    [0, 0, 0, 0, 0, 0],
+    [1./5, 0, 0, 0, 0, 0],
+    [3./40, 9./40, 0, 0, 0, 0],
+    [44./45, -56./15, 32./9, 0, 0, 0],
+    [19372./6561, -25360./2187, 64448./6561, -212./729, 0, 0],
+    [9017./3168, -355./33, 46732./5247, 49./176, -5103./18656, 0],
+    [35./384, 0, 500./1113, 125./192, -2187./6784, 11./84]])
+# 5th order weights (same as the last row of A, which gives FSAL)
+_B = _A[6]
+# Difference between the 5th and the embedded 4th order weights
+_E = np.array([71./57600, 0, -71./16695, 71./1920, -17253./339200, 22./525, -1./40])
+# Continuous extension of order 4, y(t + theta*h) = y + h*K^T*P*[theta, theta^2, theta^3, theta^4]
+# Ref: Hairer, Norsett & Wanner, "Solving Ordinary Differential Equations I", Section II.6
+_P = np.array([
+    [1, -8048581381./2820520608, 8663915743./2820520608, -12715105075./11282082432],
+    [0, 0, 0, 0],
+    [0, 131558114200./32700410799, -68118460800./10900136933, 87487479700./32700410799],
+    [0, -1754552775./470086768, 14199869525./1410260304, -10690763975./1880347072],
+    [0, 127303824393./49829197408, -318862633887./49829197408, 701980252875./199316789632],
+    [0, -282668133./205662961, 2019193451./616988883, -1453857185./822651844],
+    [0, 40617522./29380423, -110615467./29380423, 69997945./29380423]])
+
+_ORDER = 5
+_SAFETY = 0.8
+_MIN_FACTOR = 0.2
+_MAX_FACTOR = 5.0
+_MAX_REJECTED = 1000
+# Trial steps with non-finite values before giving up, counted until the
+# propagation gets past the last of them
+_MAX_NONFINITE = 10
+_INITIAL_BUFFER = 64
+
+def _grow(buf, count):
+    """Doubles the number of rows in an output buffer keeping the first 'count' rows"""
+    new_buf = np.empty((2*buf.shape[0],) + buf.shape[1:], dtype=buf.dtype)
+    new_buf[:count] = buf[:count]
+    return new_buf
+
+def _interpolate(y, step, q, theta):
+    """Evaluates the continuous extension of a step with coefficients 'q' at 'theta'"""
+    return y + step*np.dot(q, theta**np.arange(1, q.shape[1] + 1))
+
+def _locate_events(events, g_old, g_new, t, step, y, q, args):
+    """
+    Finds the zero crossings of the event functions within a step
+
+    Returns a list of (theta, index) pairs sorted by time, where the event
+    occurs at t + theta*step. Roots are found on the continuous extension.
+    """
+    found = []
+    for i, g in enumerate(events):
+        if g_old[i] == 0 or g_old[i]*g_new[i] > 0:
+            continue
+        direction = getattr(g, 'direction', 0)
+        if direction*g_old[i] > 0:
+            # Crossing in the other direction
+            continue
+        if g_new[i] == 0:
+            theta = 1.0
+        else:
+            theta = brentq(lambda th: g(t + th*step, _interpolate(y, step, q, th), *args), 0.0, 1.0)
+        found.append((theta, i))
+    found.sort()
+    return found
+
+def _abort_nonfinite(t):
+    error('OdePkg:NonFinite', 'Propagation aborted at time t = %f because the solution is no longer finite.\n' % t)
+
+def _abort_grid_error(t, stats):
+    try:
+        error('OdePkg:GridError', 'Propagation aborted at time t = %f because the error estimate of the step on the given time stamps exceeds the tolerances.\n' % t)
+    except RuntimeError as e:
+        # Cost of the aborted propagation, for the statistics of the caller
+        e.stats = stats
+        raise
+
+def _check_bounds(t, y, maxstate):
+    if np.any(np.abs(y) > maxstate):
+        error('OdePkg:StateBound', 'Propagation aborted at time t = %f because the state left the bounding box given by "maxstate".\n' % t)
+
+def dopri5(vfun, vslot, vinit, *args, **kwargs):
+    """!
+    \brief     Dormand-Prince 5(4) propagator with FSAL reuse.
+    \details   Drop-in replacement for ode45_old with the same signature and options.
+               Stage derivatives and output are stored in preallocated arrays and the
+               stage arithmetic is done in-place. The last stage of every accepted step
+               is reused as the first stage of the next one, so each step costs six
+               evaluations of 'vfun'.
+
+               If 'vslot' has more than two entries, the solution is advanced on exactly
+               those time stamps without error control. With the option 'gridcheck' set,
+               the propagation is aborted instead if the error estimate of a step exceeds
+               the tolerances.
+
+               With the option 'dense_output' set, a DenseOutput object interpolating
+               every accepted step is returned as a third output.
+
+               The option 'events' takes a list of functions g(t, y, *args). Their zero
+               crossings are located on the continuous extension of every step. A function
+               with the attribute 'terminal' set to True stops the propagation at its first
+               zero, and the attribute 'direction' (1 or -1) restricts the crossings to
+               increasing or decreasing values of g. The times and states of the events
+               are returned as two more outputs, lists with one array per function.
+
+               The option 'errorsel' selects the components used for error control, all
+               of them by default.
+
+               With the option 'return_stats' set, an IntegratorStats record of the
+               propagation is returned as the last output.
+
+               Propagation is aborted with an error if the state becomes non-finite or if
+               any component exceeds the option 'maxstate' in magnitude (scalar or one
+               bound per component).
+    """
+    start_time = time()
+    options = processOdeArgs(**kwargs)
+
+    tspan = np.array(vslot, ndmin=1, dtype=float)
+    y0 = np.array(vinit, ndmin=1)
+    dtype = np.result_type(y0, float)
+    y = y0.astype(dtype)
+    n = y.shape[0]
+
+    fixed_step = len(tspan) > 2
+    gridcheck = options['gridcheck']
+    t0, tf = tspan[0], tspan[-1]
+    direction = 1.0 if tf >= t0 else -1.0
+    span = abs(tf - t0)
+
+    # Tolerances are ignored if fixed time stamps are given, unless gridcheck is set
+    normcontrol = options['normcontrol'] == 'on'
+    reltol, abstol = options['reltol'], options['abstol']
+    errorsel = options['errorsel']
+
+    nonnegative = options['nonnegative']
+    if nonnegative is not None and options['mass'] is not None:
+        warning('OdePkg:InvalidArgument', 'Option "nonnegative" will be ignored if mass matrix is set')
+        nonnegative = None
+
+    outputsave = options['outputsave'] or 1
+    dense_output = options['dense_output']
+    maxstate = options['maxstate']
+
+    events = options['events']
+    if callable(events):
+        events = [events]
+
+    maxstep = options['maxstep']
+    if maxstep is None:
+        maxstep = span/10
+    maxstep = abs(maxstep)
+
+    h = options['initialstep']
+    if h is None:
+        h = span/100
+    h = min(abs(h), maxstep)
+
+    # Preallocated work arrays
+    K = np.empty((7, n), dtype=dtype)
+    y_new = np.empty(n, dtype=dtype)
+    y_stage = np.empty(n, dtype=dtype)
+    y_err = np.empty(n if errorsel is None else np.arange(n)[errorsel].shape[0], dtype=dtype)
+
+    # Growable output buffers
+    capacity = len(tspan) if fixed_step else _INITIAL_BUFFER
+    tout = np.empty(capacity)
+    yout = np.empty((capacity, n), dtype=dtype)
+    tout[0] = t0
+    yout[0] = y
+    count = 1
+
+    if dense_output:
+        dense_t = np.empty(capacity)
+        dense_h = np.empty(capacity)
+        dense_y = np.empty((capacity, n), dtype=dtype)
+        dense_q = np.empty((capacity, n, _P.shape[1]), dtype=dtype)
+        dense_count = 0
+
+    t = t0
+    K[0] = vfun(t, y, *args)
+    if not np.all(np.isfinite(K[0])):
+        _abort_nonfinite(t)
+    nfevals = 1
+    nsteps = 0
+    nfailed = 0
+    smallest_step, largest_step = np.inf, 0.0
+    rejected = 0
+    nonfinite = 0
+    t_nonfinite = t0
+    last_saved = True
+    grid_idx = 1
+
+    if events:
+        g_old = np.array([g(t, y, *args) for g in events])
+        t_events = [[] for _ in events]
+        y_events = [[] for _ in events]
+
+    while direction*(tf - t) > 0:
+        if fixed_step:
+            if grid_idx >= len(tspan):
+                break
+            step = tspan[grid_idx] - t
+        else:
+            min_step = 16*np.finfo(float).eps*max(abs(t), span)
+            if h < min_step:
+                error('OdePkg:InvalidArgument', 'Solving has not been successful. The iterative integration loop exited at time t = %f before endpoint at tend = %f was reached. This may happen if the stepsize grows smaller than defined in vminstepsize. Try to reduce the value of "initialstep" and/or "maxstep" with the command "odeset".\n' %
+                      (t, tf))
+            # Hit the endpoint of the time slot exactly
+            if h >= abs(tf - t):
+                h = abs(tf - t)
+            step = direction*h
+
+        # Stages 2 through 6 computed in-place
+        for i in range(1, 6):
+            np.dot(_A[i, :i], K[:i], out=y_stage)
+            y_stage *= step
+            y_stage += y
+            K[i] = vfun(t + _C[i]*step, y_stage, *args)
+
+        np.dot(_B[:6], K[:6], out=y_new)
+        y_new *= step
+        y_new += y
+        if nonnegative is not None:
+            y_new[nonnegative] = np.abs(y_new[nonnegative])
+
+        # FSAL stage: derivative at the end of the step
+        K[6] = vfun(t + step, y_new, *args)
+        nfevals += 6
+
+        if not (np.all(np.isfinite(y_new)) and np.all(np.isfinite(K[6]))):
+            # Retry with a smaller step in case the trial step left the domain of 'vfun'
+            nonfinite += 1
+            t_nonfinite = t + step
+            if fixed_step or nonfinite >= _MAX_NONFINITE:
+                _abort_nonfinite(t + step)
+            accept = False
+            factor = _MIN_FACTOR
+        elif fixed_step and not gridcheck:
+            accept = True
+        else:
+            if errorsel is None:
+                np.dot(_E, K, out=y_err)
+                y_ctrl = y
+            else:
+                np.dot(_E, K[:, errorsel], out=y_err)
+                y_ctrl = y[errorsel]
+            y_err *= step
+            if normcontrol:
+                delta = norm(y_err, np.inf)
+                tau = max(reltol*max(norm(y_ctrl, np.inf), 1.0), abstol)
+                ratio = delta/tau
+            else:
+                tau = np.maximum(reltol*np.abs(y_ctrl), abstol)
+                ratio = np.max(np.abs(y_err)/tau)
+            accept = ratio <= 1.0
+            if fixed_step and not accept:
+                _abort_grid_error(t + step, IntegratorStats(nfevals, nsteps, nfailed + 1, smallest_step, largest_step, time() - start_time, 1))
+
+            if ratio == 0:
+                factor = _MAX_FACTOR
+            else:
+                factor = min(_MAX_FACTOR, max(_MIN_FACTOR, _SAFETY*ratio**(-1./_ORDER)))
+            if not accept:
+                factor = min(factor, 1.0)
+
+        if accept:
+            if dense_output:
+                if dense_count == dense_t.shape[0]:
+                    dense_t = _grow(dense_t, dense_count)
+                    dense_h = _grow(dense_h, dense_count)
+                    dense_y = _grow(dense_y, dense_count)
+                    dense_q = _grow(dense_q, dense_count)
+                dense_t[dense_count] = t
+                dense_h[dense_count] = step
+                dense_y[dense_count] = y
+                np.dot(K.T, _P, out=dense_q[dense_count])
+                dense_count += 1
+
+            terminal = False
+            if events:
+                g_new = np.array([g(t + step, y_new, *args) for g in events])
+                q = np.dot(K.T, _P)
+                for (theta, i) in _locate_events(events, g_old, g_new, t, step, y, q, args):
+                    t_event = t + theta*step
+                    y_event = _interpolate(y, step, q, theta)
+                    t_events[i].append(t_event)
+                    y_events[i].append(y_event)
+                    if getattr(events[i], 'terminal', False):
+                        terminal = True
+                        break
+                g_old = g_new
+
+            t = t + step
+            y, y_new = y_new, y
+            K[0] = K[6]
+            nsteps += 1
+            smallest_step = min(smallest_step, abs(step))
+            largest_step = max(largest_step, abs(step))
+            rejected = 0
+            grid_idx += 1
+            # Count non-finite trial steps again once the propagation got past them
+            if direction*(t - t_nonfinite) >= 0:
+                nonfinite = 0
+
+            if terminal:
+                t = t_event
+                y[:] = y_event
+            if maxstate is not None:
+                _check_bounds(t, y, maxstate)
+
+            last_saved = nsteps % outputsave == 0
+            if last_saved:
+                if count == tout.shape[0]:
+                    tout = _grow(tout, count)
+                    yout = _grow(yout, count)
+                tout[count] = t
+                yout[count] = y
+                count += 1
+
+            if terminal:
+                break
+        else:
+            nfailed += 1
+            rejected += 1
+            if rejected >= _MAX_REJECTED:
+                error("fatal", "Solving has not been successful. The iterative integration loop exited at time t = %f before endpoint at tend = %f was reached. This happened because the iterative integration loop does not find a valid solution at this time stamp. Try to reduce the value of \"initialstep\" and/or \"maxstep\" with the command \"odeset\".\n" %
+                      (t, tf))
+
+        if not fixed_step:
+            h = min(maxstep, h*factor)
+
+    # Save the last step, if not already saved
+    if not last_saved:
+        if count == tout.shape[0]:
+            tout = _grow(tout, count)
+            yout = _grow(yout, count)
+        tout[count] = t
+        yout[count] = y
+        count += 1
+
+    if options['stats'] == 'on':
+        print('Number of successful steps %d' % nsteps)
+        print('Number of failed attempts:  %d' % nfailed)
+        print('Number of function calls:   %d' % nfevals)
+
+    tout = tout[:count]
+    yout = yout[:count]
+    if options['outputsel'] is not None:
+        yout = yout[:, options['outputsel']]
+
+    result = (tout, yout)
+    if dense_output:
+        dense = DenseOutput(dense_t[:dense_count], dense_h[:dense_count], dense_y[:dense_count], dense_q[:dense_count])
+        if options['outputsel'] is not None:
+            dense = dense.select(options['outputsel'])
+        result += (dense,)
+    if events:
+        t_events = [np.array(te) for te in t_events]
+        y_events = [np.array(ye).reshape((-1, n)) for ye in y_events]
+        if options['outputsel'] is not None:
+            y_events = [ye[:, options['outputsel']] for ye in y_events]
+        result += (t_events, y_events)
+    if options['return_stats']:
+        result += (IntegratorStats(nfevals, nsteps, nfailed, smallest_step, largest_step, time() - start_time, 1),)
+    return result
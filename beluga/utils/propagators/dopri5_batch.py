@@ -0,0 +1,235 @@
+import numpy as np
+from time import time
+
+from beluga.utils.ode45_old import processOdeArgs, error
+from beluga.utils.DenseOutput import DenseOutput
+from beluga.utils.IntegratorStats import IntegratorStats
+from .dopri5 import _abort_nonfinite, _check_bounds, _A, _B, _C, _E, _P, _ORDER, _SAFETY, _MIN_FACTOR, _MAX_FACTOR, _MAX_REJECTED, _MAX_NONFINITE, _INITIAL_BUFFER
+
+def columnwise(vfun):
+    """
+    Wraps a single-trajectory ODE function so that it accepts stacked states
+        Input is assumed to be a vector of times and a matrix with one column per
+        trajectory, like the vectorized functions of a BVP
+    """
+    def wrapper(t, Y, *args):
+        out = np.empty(Y.shape, dtype=np.result_type(Y, float))
+        for k in range(Y.shape[1]):
+            out[:, k] = vfun(t[k], Y[:, k], *args)
+        return out
+    return wrapper
+
+def dopri5_batch(vfun, vslots, vinits, *args, **kwargs):
+    """!
+    \brief     Propagates several trajectories together in one vectorized Dormand-Prince 5(4) loop.
+    \details   The K initial conditions are advanced together. Every trajectory has its
+               own time span, step size and error control. Trajectories that have reached
+               the end of their time span or whose step was rejected are masked out of the
+               update. Time spans only give the start and end times, fixed time stamps are
+               not supported.
+
+               'vfun' is called as vfun(t, Y, *args) where 't' is a vector of K' times and
+               'Y' is an (n, K') array with one column of states per active trajectory, the
+               layout of the vectorized functions of a BVP (e.g. 'deriv_func_vec'). It
+               should return the (n, K') array of derivatives. Use columnwise() to wrap a
+               function that only handles one trajectory at a time.
+
+               As in dopri5, trial steps with non-finite values are retried with smaller
+               steps, and the propagation is aborted if the state of a trajectory stays
+               non-finite or exceeds the option 'maxstate' in magnitude.
+
+               Returns lists of time and state arrays, one entry per trajectory, like
+               Propagator does for multiple arcs. With the option 'dense_output' set, a
+               list of DenseOutput objects is returned as well, and with 'return_stats'
+               a list of IntegratorStats records. The wall time of the batch is shared
+               among the trajectories in proportion to their function calls.
+    """
+    start_time = time()
+    options = processOdeArgs(**kwargs)
+
+    Y = np.array(vinits, ndmin=2)
+    dtype = np.result_type(Y, float)
+    Y = Y.astype(dtype)
+    nTraj, n = Y.shape
+
+    # A single time span may be shared by all trajectories
+    tspans = np.array(vslots, dtype=float, ndmin=2)
+    if tspans.shape[0] == 1:
+        tspans = np.repeat(tspans, nTraj, axis=0)
+    if tspans.shape[0] != nTraj:
+        raise ValueError('Number of time spans should match number of initial conditions')
+    if tspans.shape[1] != 2:
+        raise ValueError('Time spans should only have the start and end times, fixed time stamps are not supported')
+    t0 = tspans[:, 0].copy()
+    tf = tspans[:, -1].copy()
+    direction = np.where(tf >= t0, 1.0, -1.0)
+    span = np.abs(tf - t0)
+
+    dense_output = options['dense_output']
+    maxstate = options['maxstate']
+    normcontrol = options['normcontrol'] == 'on'
+    reltol, abstol = options['reltol'], options['abstol']
+    errorsel = options['errorsel']
+    if errorsel is None:
+        errorsel = slice(None)
+
+    maxstep = options['maxstep']
+    maxstep = span/10 if maxstep is None else np.abs(maxstep)*np.ones(nTraj)
+    h = options['initialstep']
+    h = span/100 if h is None else np.abs(h)*np.ones(nTraj)
+    h = np.minimum(h, maxstep)
+
+    K = np.empty((7, nTraj, n), dtype=dtype)
+
+    # States are stored with one row per trajectory, 'vfun' takes one column each
+    def f(t, Y):
+        return np.transpose(vfun(t, Y.T, *args))
+
+    # Growable output buffers shared by all trajectories, one counter per trajectory
+    tout = np.empty((_INITIAL_BUFFER, nTraj))
+    yout = np.empty((_INITIAL_BUFFER, nTraj, n), dtype=dtype)
+    tout[0] = t0
+    yout[0] = Y
+    count = np.ones(nTraj, dtype=int)
+    if dense_output:
+        # Step i of a trajectory starts at its i-th output point
+        qout = np.empty((_INITIAL_BUFFER, nTraj, n, _P.shape[1]), dtype=dtype)
+
+    t = t0.copy()
+    K[0] = f(t, Y)
+    if not np.all(np.isfinite(K[0])):
+        _abort_nonfinite(t[np.argmin(np.all(np.isfinite(K[0]), axis=1))])
+    nfevals = nTraj
+    nsteps = 0
+    nfailed = 0
+    rejected = np.zeros(nTraj, dtype=int)
+    nrejected = np.zeros(nTraj, dtype=int)
+    nonfinite = np.zeros(nTraj, dtype=int)
+    t_nonfinite = t0.copy()
+    done = span == 0
+
+    while not np.all(done):
+        active = np.nonzero(~done)[0]
+        all_active = active.shape[0] == nTraj
+        sel = slice(None) if all_active else active
+
+        ta = t[sel]
+        ya = Y[sel]
+        ka = K[:, sel]
+        remaining = np.abs(tf[sel] - ta)
+        min_step = 16*np.finfo(float).eps*np.maximum(np.abs(ta), span[sel])
+        if np.any(h[sel] < min_step):
+            k = active[np.argmax(h[sel] < min_step)]
+            error('OdePkg:InvalidArgument', 'Solving has not been successful. The iterative integration loop exited at time t = %f before endpoint at tend = %f was reached for trajectory %d.\n' %
+                  (t[k], tf[k], k))
+
+        # Hit the endpoint of each time span exactly
+        step = direction[sel]*np.minimum(h[sel], remaining)
+        step_col = step[:, np.newaxis]
+
+        for i in range(1, 6):
+            y_stage = ya + step_col*np.tensordot(_A[i, :i], ka[:i], axes=1)
+            ka[i] = f(ta + _C[i]*step, y_stage)
+
+        y_new = ya + step_col*np.tensordot(_B[:6], ka[:6], axes=1)
+        ka[6] = f(ta + step, y_new)
+        nfevals += 6*ta.shape[0]
+        finite = np.all(np.isfinite(y_new), axis=1) & np.all(np.isfinite(ka[6]), axis=1)
+
+        y_err = step_col*np.tensordot(_E, ka[:, :, errorsel], axes=1)
+        y_ctrl = ya[:, errorsel]
+        if normcontrol:
+            delta = np.max(np.abs(y_err), axis=1)
+            tau = np.maximum(reltol*np.maximum(np.max(np.abs(y_ctrl), axis=1), 1.0), abstol)
+            ratio = delta/tau
+        else:
+            tau = np.maximum(reltol*np.abs(y_ctrl), abstol)
+            ratio = np.max(np.abs(y_err)/tau, axis=1)
+        accept = finite & (ratio <= 1.0)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            factor = np.where(ratio == 0, _MAX_FACTOR, _SAFETY*ratio**(-1./_ORDER))
+        factor = np.clip(factor, _MIN_FACTOR, _MAX_FACTOR)
+        factor[~accept] = np.minimum(factor[~accept], 1.0)
+
+        # Retry with a smaller step in case the trial step left the domain of 'vfun'
+        factor[~finite] = _MIN_FACTOR
+        failed = active[~finite]
+        nonfinite[failed] += 1
+        t_nonfinite[failed] = ta[~finite] + step[~finite]
+        if np.any(nonfinite >= _MAX_NONFINITE):
+            _abort_nonfinite(t_nonfinite[np.argmax(nonfinite)])
+
+        # Advance accepted trajectories
+        acc = active[accept]
+        if dense_output:
+            q_acc = np.einsum('skn,sd->knd', ka[:, accept], _P)
+        t[acc] = ta[accept] + step[accept]
+        Y[acc] = y_new[accept]
+        ka[0, accept] = ka[6, accept]
+        if not all_active:
+            K[:, active] = ka
+        # Count non-finite trial steps again once the propagation got past them
+        past = acc[direction[acc]*(t[acc] - t_nonfinite[acc]) >= 0]
+        nonfinite[past] = 0
+        if maxstate is not None:
+            beyond = acc[np.any(np.abs(Y[acc]) > maxstate, axis=1)]
+            if beyond.shape[0] > 0:
+                _check_bounds(t[beyond[0]], Y[beyond[0]], maxstate)
+
+        if np.any(count[acc] == tout.shape[0]):
+            new_tout = np.empty((2*tout.shape[0], nTraj))
+            new_yout = np.empty((2*yout.shape[0], nTraj, n), dtype=dtype)
+            new_tout[:tout.shape[0]] = tout
+            new_yout[:yout.shape[0]] = yout
+            tout, yout = new_tout, new_yout
+            if dense_output:
+                new_qout = np.empty((2*qout.shape[0],) + qout.shape[1:], dtype=dtype)
+                new_qout[:qout.shape[0]] = qout
+                qout = new_qout
+        if dense_output:
+            qout[count[acc] - 1, acc] = q_acc
+        tout[count[acc], acc] = t[acc]
+        yout[count[acc], acc] = Y[acc]
+        count[acc] += 1
+
+        nsteps += acc.shape[0]
+        nfailed += active.shape[0] - acc.shape[0]
+        rejected[acc] = 0
+        rejected[active[~accept]] += 1
+        nrejected[active[~accept]] += 1
+        if np.any(rejected >= _MAX_REJECTED):
+            k = np.argmax(rejected)
+            error("fatal", "Solving has not been successful. The iterative integration loop exited at time t = %f before endpoint at tend = %f was reached for trajectory %d.\n" %
+                  (t[k], tf[k], k))
+
+        h[active] = np.minimum(maxstep[active], h[active]*factor)
+        done = direction*(tf - t) <= 0
+
+    if options['stats'] == 'on':
+        print('Number of successful steps %d' % nsteps)
+        print('Number of failed attempts:  %d' % nfailed)
+        print('Number of function calls:   %d' % nfevals)
+
+    tset = [tout[:count[k], k].copy() for k in range(nTraj)]
+    yset = [yout[:count[k], k].copy() for k in range(nTraj)]
+    if options['outputsel'] is not None:
+        yset = [y[:, options['outputsel']] for y in yset]
+
+    result = (tset, yset)
+    if dense_output:
+        denseset = [DenseOutput(tset[k][:-1], np.diff(tset[k]), yout[:count[k] - 1, k].copy(), qout[:count[k] - 1, k].copy())
+                    for k in range(nTraj)]
+        if options['outputsel'] is not None:
+            denseset = [dense.select(options['outputsel']) for dense in denseset]
+        result += (denseset,)
+    if options['return_stats']:
+        # Every attempted step costs six calls, plus the initial derivative
+        calls = 1 + 6*(count - 1 + nrejected)
+        share = (time() - start_time)*calls/np.sum(calls)
+        statsset = [IntegratorStats(calls[k], count[k] - 1, nrejected[k],
+                                    np.min(np.abs(np.diff(tset[k])), initial=np.inf), np.max(np.abs(np.diff(tset[k])), initial=0.0),
+                                    share[k], 1)
+                    for k in range(nTraj)]
+        result += (statsset,)
+    return result
@@ -1,83 +1,311 @@
 import numpy as np
-import numpy.matlib as matlib
 from math import *
-def mcpi(ode, tSpan, x0, *args, N = 10, tol = 1e-4, return_Beta = False):
+from time import time
+from numpy.polynomial import chebyshev
+
+from beluga.utils.ode45_old import processOdeArgs, error
+from beluga.utils.DenseOutput import DenseOutput
+from beluga.utils.IntegratorStats import IntegratorStats
+from .dopri5 import _abort_nonfinite, _check_bounds, _MAX_NONFINITE
+
+_MIN_ORDER = 4
+# Picard iterations per segment before it is split
+_MAX_PICARD = 50
+# Picard corrections are converged below this fraction of the tolerances, which keeps
+# the iteration error well below the truncation error
+_PICARD_TOL = 0.1
+_GROW = 2.0
+_SHRINK = 0.5
+
+# Chebyshev-Picard operators for each order
+_OPERATORS = {}
+
+# The continuous extension between two nodes is a polynomial of degree 7 fitted to
+# the Chebyshev polynomial of the segment at these fractions of the interval
+_DENSE_THETA = (1 - np.cos(np.arange(1, 8)*pi/7))/2
+_DENSE_FIT = np.linalg.inv(_DENSE_THETA[:, np.newaxis]**np.arange(1, 8))
+
+def mcpi(vfun, vslot, vinit, *args, N = 16, max_N = 64, tol = None, return_Beta = False, **kwargs):
     """!
     \brief     ODE propagator that uses the Modified Chebyshev-Picard Iteration method
     \details   Propagates a system of ODEs using MCPI. Code based on original work by
-               Xiaoli Bai and MATLAB code by Darin Koblick. The function was simplified
-               by removing several for loops and the function header matched to that of
-               MATLAB's ode45
+               Xiaoli Bai and MATLAB code by Darin Koblick. The function header matches
+               that of the other propagators.
+
+               The time span is split into segments. On every segment the solution is
+               approximated by a Chebyshev polynomial of order N, and Picard iterations
+               update the states at all N+1 Chebyshev-Gauss-Lobatto nodes at once. With
+               the option 'vectorized' set, 'vfun' is called once per iteration as
+               vfun(t, X, *args) with a vector of node times 't' and one column of states
+               per node in 'X', the layout of the vectorized functions of a BVP (e.g.
+               'deriv_func_vec'). Otherwise it is called node by node.
+
+               A segment is accepted once the Picard iterations have converged and the
+               trailing Chebyshev coefficients are below the tolerances. The order is
+               raised (up to max_N) if they are not, and the segment is halved if the
+               iterations do not converge. The order of the next segment follows the
+               decay of the coefficients of the last one, and its length grows while
+               low orders suffice. Every new iteration starts from the previous iterate:
+               the lower order polynomial when the order is raised or the segment split,
+               the option 'guess' (e.g. the DenseOutput of an earlier propagation) or a
+               linear extrapolation from the end of the last segment otherwise.
+
+               Returns the times and states at the nodes of all segments, or on the time
+               stamps in 'vslot' if it has more than two entries. The options
+               'dense_output' (polynomials of degree 7 between the nodes),
+               'return_stats' (function calls count every node), 'outputsel', 'errorsel'
+               and 'maxstate' work as in dopri5. 'tol' sets both tolerances. With
+               'return_Beta' set, the Chebyshev coefficients of each segment are returned
+               after the states.
     \author    Thomas Antony
-    \version   0.1
+    \version   0.2
     \date      07/22/15
     \copyright Coming.
     """
+    start_time = time()
+    options = processOdeArgs(**kwargs)
+    if tol is not None:
+        options['reltol'] = options['abstol'] = tol
+    normcontrol = options['normcontrol'] == 'on'
+    reltol, abstol = options['reltol'], options['abstol']
+    errorsel = options['errorsel']
+    if errorsel is None:
+        errorsel = slice(None)
+    maxstate = options['maxstate']
+    guess = options['guess']
 
-    x0 = np.array(x0)
-    # Convert to 2D numpy array if 1D
-    if len(x0.shape) == 1:
-        x0 = np.array([x0])
+    tspan = np.array(vslot, ndmin=1, dtype=float)
+    y0 = np.array(vinit, ndmin=1)
+    if y0.ndim == 2:
+        # One row of states per time stamp, used as the initial guess
+        rows = y0.astype(float)
+        guess = lambda t: np.array([np.interp(t, tspan, col) for col in rows.T]).T
+        y0 = rows[0]
+    dtype = np.result_type(y0, float)
+    x = y0.astype(dtype)
+    n = x.shape[0]
 
-    # Convert to row vector if col vector given
-    # If matrix in 'wrong' format, convert to right format
-    if x0.shape[1] == 1: #or x0.shape[0] != len(tSpan):
-        x0 = x0.T
+    fixed_grid = len(tspan) > 2
+    t0, tf = tspan[0], tspan[-1]
+    direction = 1.0 if tf >= t0 else -1.0
+    span = abs(tf - t0)
 
-    # If column vector is given, convert to matrix using repetition
-    if x0.shape[0] != N+1:
-        x_guess = matlib.repmat(x0[0,:],N+1,1);
+    if options['vectorized']:
+        # The iterations keep one row per node, the vectorized function takes columns
+        vode = lambda t, X, *args: np.transpose(vfun(t, X.T, *args))
     else:
-        x_guess = x0;
-
-    print(x_guess)
-    tau = np.cos(np.linspace(N,0,N+1)*pi/N)
-
-    omega1 = (tSpan[-1]+tSpan[0])/2
-    omega2 = (tSpan[-1]-tSpan[0])/2
-
-    vec_1_Nt = matlab_colon(1,N).T # (1:N)'
-    vec_0_Np1t = matlab_colon(0,N+1).T # (0:N+1)'
-    vec_0_N  = matlab_colon(0,N)    # 0:N
-    vec_1_Np1 = matlab_colon(1,N+1) # 1:N+1
-
-    T = chebypoly(vec_0_Np1t,tau);
-    V = np.ones_like(tau)/N
-    V[1:-1] *= 2
-
-    TV1 = T[0:N,:]*V
-    TV2 = T[2:N+2,:]*V;
-    TV = (TV1-TV2)/(2*vec_1_Nt)
-    TV[-1,:] = TV1[-1,:]/(2*N)
-    S = 2*((-1)**(vec_1_Nt.T+1))     # S = 2.*((-1).^((1:N)+1));
-
-    Cx = T[0:N+1,0:N+1].T   # Cx = T(1:N+1,1:N+1)';
-    Cx[:,0] /= 2
-
-    err1 = err2 = np.inf
-    ctr = 0
-    max_iter = 100
-
-    vode = vectorize_ode(ode)
-    # xdot = vode(tau,x_guess)
-
-    s_tau = tau*omega2 + omega1  # Scaled tau
-    x_new = np.empty_like(x_guess)
-
-    while ((tol < err1 or tol < err2) and (ctr < max_iter)):
-        ctr = ctr + 1
-
-        F = vode(s_tau,x_guess,*args)*omega2
-        Beta_r = np.dot(TV,F)
-        Beta_k = np.r_[np.dot(S,Beta_r) + 2*x_guess[0,:],Beta_r]    # [2*x0+S*Beta_r; Beta_r]
-        x_new = np.dot(Cx,Beta_k)
-        err2 = err1;
-        err1 = np.amax(abs(x_new - x_guess))
-        x_guess = x_new
-    if not return_Beta:
-        return (s_tau,x_new)
-    else:
-        return (s_tau,x_new,Beta_k)
+        vode = vectorize_ode(vfun)
+
+    maxstep = options['maxstep']
+    maxstep = span if maxstep is None else abs(maxstep)
+    h = options['initialstep']
+    h = maxstep if h is None else min(abs(h), maxstep)
+    order = min(max(N, _MIN_ORDER), max_N)
+
+    def tolerance(X, sel):
+        if normcontrol:
+            return max(reltol*max(np.max(np.abs(X[:, sel])), 1.0), abstol)
+        return np.maximum(reltol*np.max(np.abs(X[:, sel]), axis=0), abstol)
+
+    # Data of the accepted segments
+    seg_t = []
+    seg_x = []
+    seg_beta = []
+    seg_start = []
+
+    t = t0
+    f_end = None        # Derivative at the end of the last segment
+    carry = None        # Polynomial of the last iterate on (t_a, t_b, coefficients)
+    nfevals = 0
+    nsegments = 0
+    nrejected = 0
+    nonfinite = 0
+    t_nonfinite = t0
+    smallest_step, largest_step = np.inf, 0.0
+    split = False       # Whether the current segment has been split
+
+    while direction*(tf - t) > 0:
+        min_step = 16*np.finfo(float).eps*max(abs(t), span)
+        if h < min_step:
+            error('OdePkg:InvalidArgument', 'Solving has not been successful. The iterative integration loop exited at time t = %f before endpoint at tend = %f was reached. The Picard iterations do not converge even on very short segments.\n' %
+                  (t, tf))
+        if h >= abs(tf - t):
+            h = abs(tf - t)
+        step = direction*h
+
+        tau, C, Tn = _chebyshev_operators(order)
+        omega1 = t + step/2
+        omega2 = step/2
+        s_tau = omega1 + omega2*tau
+
+        # Warm start
+        if carry is not None:
+            (ta, tb, beta) = carry
+            X = chebyshev.chebval((s_tau - (ta + tb)/2)/((tb - ta)/2), beta).T
+        elif guess is not None:
+            X = np.array(guess(s_tau), dtype=dtype).reshape((order + 1, n))
+        elif f_end is not None:
+            X = x + np.outer(s_tau - t, f_end)
+        else:
+            X = np.tile(x, (order + 1, 1))
+        X[0] = x
+        carry = None
+
+        # Picard iterations
+        converged = False
+        err_prev = np.inf
+        for it in range(_MAX_PICARD):
+            F = vode(s_tau, X, *args)
+            nfevals += order + 1
+            if not np.all(np.isfinite(F)):
+                nonfinite += 1
+                t_nonfinite = t + step
+                if nonfinite >= _MAX_NONFINITE:
+                    _abort_nonfinite(t)
+                break
+            beta = omega2*np.dot(C, F)
+            beta[0] += x
+            X_new = np.dot(Tn, beta)
+            # All components have to converge, 'errorsel' only controls the order
+            err = np.max(np.abs(X_new - X)/tolerance(X_new, slice(None)))
+            X = X_new
+            if err <= _PICARD_TOL:
+                converged = True
+                break
+            # Give up early if the iterations diverge or would need too long. The
+            # corrections may grow over the first iterations on long segments.
+            rate = err/err_prev
+            if it >= 4 and (rate >= 1.0 or err*rate**(_MAX_PICARD - it - 1) > _PICARD_TOL):
+                break
+            err_prev = err
+
+        if not converged:
+            # Picard iterations do not contract over this segment
+            nrejected += 1
+            split = True
+            h *= _SHRINK
+            continue
+
+        scale = tolerance(X, errorsel)
+        coeff_err = np.max(np.abs(beta[:, errorsel])/scale, axis=1)
+        if max(coeff_err[-2:]) > 1.0:
+            # Truncation error too large, raise the order or split the segment
+            carry = (t, t + step, beta)
+            if order < max_N:
+                order = min(2*order, max_N)
+            else:
+                nrejected += 1
+                split = True
+                h *= _SHRINK
+            continue
+
+        if maxstate is not None:
+            for (tk, xk) in zip(s_tau, X):
+                _check_bounds(tk, xk, maxstate)
+
+        seg_t.append(s_tau)
+        seg_x.append(X)
+        seg_beta.append(beta)
+        seg_start.append(t)
+        nsegments += 1
+        smallest_step = min(smallest_step, h)
+        largest_step = max(largest_step, h)
+
+        # Order of the next segment from the decay of the coefficients
+        significant = np.nonzero(coeff_err > 1.0)[0]
+        needed = significant[-1] + 1 if significant.shape[0] > 0 else 1
+        order = min(max(needed + 2, _MIN_ORDER), max_N)
+        if order > 0.75*max_N:
+            h *= _SHRINK
+        elif order <= max(N, _MIN_ORDER) and not split:
+            h *= _GROW
+        h = min(h, maxstep)
+
+        t = t + step
+        x = X[-1]
+        # Count non-finite trial steps again once the propagation got past them
+        if direction*(t - t_nonfinite) >= 0:
+            nonfinite = 0
+        f_end = F[-1]
+        split = False
+
+    if not seg_t:
+        # Empty time span
+        seg_t.append(np.array([t0]))
+        seg_x.append(x[np.newaxis])
+        seg_beta.append(x[np.newaxis])
+        seg_start.append(t0)
+
+    # Nodes of all segments, the first node of a segment is the last of the one before
+    tout = np.concatenate([seg_t[0]] + [s[1:] for s in seg_t[1:]])
+    yout = np.concatenate([seg_x[0]] + [s[1:] for s in seg_x[1:]])
+    tout[-1] = t
+
+    if fixed_grid:
+        # Evaluate the Chebyshev polynomials on the requested time stamps
+        starts = np.array(seg_start)
+        idx = np.clip(np.searchsorted(direction*starts, direction*tspan, side='right') - 1, 0, len(seg_start) - 1)
+        grid_y = np.empty((len(tspan), n), dtype=dtype)
+        for k in range(len(seg_start)):
+            sel = idx == k
+            if np.any(sel):
+                ta, tb = seg_t[k][0], seg_t[k][-1]
+                grid_y[sel] = chebyshev.chebval((tspan[sel] - (ta + tb)/2)/((tb - ta)/2), seg_beta[k]).T
+        grid_y[0] = y0
+
+    if options['stats'] == 'on':
+        print('Number of segments         %d' % nsegments)
+        print('Number of failed attempts:  %d' % nrejected)
+        print('Number of function calls:   %d' % nfevals)
+
+    result_t, result_y = (tspan, grid_y) if fixed_grid else (tout, yout)
+    if options['outputsel'] is not None:
+        result_y = result_y[:, options['outputsel']]
+    result = (result_t, result_y)
+
+    if options['dense_output']:
+        dense_q = []
+        for (s_t, X, beta) in zip(seg_t, seg_x, seg_beta):
+            tau = (2*s_t - s_t[0] - s_t[-1])/(s_t[-1] - s_t[0])
+            samples = tau[:-1, np.newaxis] + np.diff(tau)[:, np.newaxis]*_DENSE_THETA
+            values = chebyshev.chebval(samples, beta) - X[:-1].T[:, :, np.newaxis]
+            dense_q.append(np.einsum('ki,nji->jnk', _DENSE_FIT, values)/np.diff(s_t)[:, np.newaxis, np.newaxis])
+        dense = DenseOutput(tout[:-1], np.diff(tout), yout[:-1], np.concatenate(dense_q))
+        if options['outputsel'] is not None:
+            dense = dense.select(options['outputsel'])
+        result += (dense,)
+    if return_Beta:
+        result += (seg_beta,)
+    if options['return_stats']:
+        result += (IntegratorStats(nfevals, nsegments, nrejected, smallest_step, largest_step, time() - start_time, 1),)
+    return result
+
+def _chebyshev_operators(N):
+    """
+    Returns the Chebyshev-Gauss-Lobatto nodes on [-1, 1] for order N, the matrix
+    mapping the derivatives at the nodes to the Chebyshev coefficients of their
+    integral from -1, and the values of the Chebyshev polynomials at the nodes
+    """
+    if N not in _OPERATORS:
+        tau = np.cos(np.linspace(N,0,N+1)*pi/N)
+
+        vec_1_Nt = matlab_colon(1,N).T # (1:N)'
+        vec_0_Np1t = matlab_colon(0,N+1).T # (0:N+1)'
+
+        T = chebypoly(vec_0_Np1t,tau)
+        V = np.ones_like(tau)/N
+        V[1:-1] *= 2
+
+        TV1 = T[0:N,:]*V
+        TV2 = T[2:N+2,:]*V
+        TV = (TV1-TV2)/(2*vec_1_Nt)
+        TV[-1,:] = TV1[-1,:]/(2*N)
+        S = 2*((-1)**(vec_1_Nt.T+1))     # S = 2.*((-1).^((1:N)+1));
+
+        # Coefficients of the integral, the constant one makes it vanish at -1
+        C = np.vstack((np.dot(S,TV)/2, TV))
+        _OPERATORS[N] = (tau, C, T[0:N+1,:].T.copy())
+    return _OPERATORS[N]
 
 def chebypoly(k, tau):
     # Computes T_k(x) for all points in tau for all k
@@ -93,8 +321,7 @@ def vectorize_ode(ode):
         """
         Wrapper that evaluates the ODE for entire trajectory space
         """
-        out = np.empty_like(x)
-        out[:] = np.NaN
+        out = np.empty(x.shape, dtype=np.result_type(x, float))
         for index in range(len(t)):
             out[index,:] = ode(t[index],x[index,:],*args,**vargs)
         return out
@@ -104,11 +331,3 @@ def matlab_colon(a,b):
     # Returns the same result as (a:b) in matlab
     #   Converts the result to a row-vector
     return np.linspace(a,b,b-a+1,dtype=int)[np.newaxis,:]
-
-if __name__ == '__main__':
-    def test_ode(t, X):
-        y = X[0];
-        ydot = X[1];
-        return np.array([ydot,-y])
-
-    mcpi(test_ode,[0, pi/2],[100,1.45], 10)
@@ -0,0 +1,340 @@
+import numpy as np
+from time import time
+from numpy.linalg import norm
+from scipy.linalg import lu_factor, lu_solve
+
+from beluga.utils.ode45_old import processOdeArgs, error, warning
+from beluga.utils.DenseOutput import DenseOutput
+from beluga.utils.IntegratorStats import IntegratorStats
+from .dopri5 import _grow, _abort_nonfinite, _abort_grid_error, _check_bounds, _SAFETY, _MIN_FACTOR, _MAX_FACTOR, _MAX_REJECTED, _MAX_NONFINITE, _INITIAL_BUFFER
+
+# ROS34PW2 coefficients, a stiffly accurate, L-stable Rosenbrock-W method of order 3
+# with an embedded method of order 2. Being a W-method, the order holds for any
+# approximation of the Jacobian, so Jacobians and factorizations may be reused.
+# Ref: Rang & Angermann, "New Rosenbrock W-methods of order 3 for partial
+#      differential algebraic equations of index 1", BIT 45 (2005)
+_GAMMA = 0.435866521508459
+_ALPHA = np.array([
+    [0, 0, 0, 0],
+    [0.87173304301691801, 0, 0, 0],
+    [0.84457060015369423, -0.11299064236484185, 0, 0],
+    [0, 0, 1, 0]])
+_GAMMA_IJ = np.array([
+    [_GAMMA, 0, 0, 0],
+    [-0.87173304301691801, _GAMMA, 0, 0],
+    [-0.90338057013044082, 0.054180672388095326, _GAMMA, 0],
+    [0.24212380706095346, -1.2232505839045147, 0.54526025533510214, _GAMMA]])
+_B = np.array([0.24212380706095346, -1.2232505839045147, 1.5452602553351020, 0.435866521508459])
+_B_HAT = np.array([0.37810903145819369, -0.096042292212423178, 0.5, 0.2179332607542295])
+
+# Transformed coefficients which avoid matrix-vector products with the Jacobian
+# Ref: Hairer & Wanner, "Solving Ordinary Differential Equations II", Section IV.7
+_GAMMA_INV = np.linalg.inv(_GAMMA_IJ)
+_A = np.dot(_ALPHA, _GAMMA_INV)
+_C = np.diag(1/np.diag(_GAMMA_IJ)) - _GAMMA_INV
+_M = np.dot(_B, _GAMMA_INV)
+_E = _M - np.dot(_B_HAT, _GAMMA_INV)
+_NODES = np.sum(_ALPHA, axis=1)
+
+_STAGES = 4
+_ERROR_ORDER = 3
+# Keep the step size, and the factorization, if the proposed change is this small
+_HOLD_STEP = 1.2
+# Accepted steps after which the Jacobian is evaluated again
+_MAX_JACOBIAN_AGE = 10
+
+def _numerical_jacobian(vfun, t, y, n, *args):
+    """Jacobian of the first 'n' rates with respect to the first 'n' states"""
+    F = np.empty((n, n))
+    try:
+        step = 1e-100
+        Y = np.array(y, dtype=complex)
+        for i in range(n):
+            Y[i] += step*1j
+            F[:, i] = np.imag(vfun(t, Y, *args)[:n])/step
+            Y[i] -= step*1j
+    except TypeError:
+        # Function does not accept complex numbers
+        step = 1e-6
+        Y = np.array(y, dtype=float)
+        fx = vfun(t, Y, *args)[:n]
+        for i in range(n):
+            Y[i] += step
+            F[:, i] = (vfun(t, Y, *args)[:n] - fx)/step
+            Y[i] -= step
+    return F
+
+def rosenbrock(vfun, vslot, vinit, *args, **kwargs):
+    """!
+    \brief     Linearly implicit Rosenbrock-W propagator (ROS34PW2) for stiff problems.
+    \details   Same signature and options as dopri5. Every step solves four linear systems
+               with the matrix I/(h*gamma) - J. The Jacobian J is only evaluated again after
+               a rejected step or every few accepted steps, and the LU factorization is kept
+               as long as J and the step size do not change.
+
+               Additional options:
+                 jacobian : function jacobian(t, y, *args) returning the Jacobian of 'vfun'.
+                            Complex step (or finite difference) of 'vfun' if not given.
+                 stm      : number of states 'n' if 'vinit' holds the states followed by
+                            their state transition matrix (row-major), as propagated by the
+                            shooting solvers. 'jacobian' then only returns the (n, n)
+                            Jacobian F of the states and the system is solved with the
+                            block structure diag(F, kron(F, I)).
+
+               Events are not supported, but the 'maxstate' and non-finite guards of
+               dopri5 are. A non-finite Jacobian is replaced by the last finite one.
+    """
+    start_time = time()
+    options = processOdeArgs(**kwargs)
+
+    tspan = np.array(vslot, ndmin=1, dtype=float)
+    y = np.array(vinit, ndmin=1, dtype=float)
+    N = y.shape[0]
+
+    fixed_step = len(tspan) > 2
+    gridcheck = options['gridcheck']
+    t0, tf = tspan[0], tspan[-1]
+    direction = 1.0 if tf >= t0 else -1.0
+    span = abs(tf - t0)
+
+    normcontrol = options['normcontrol'] == 'on'
+    reltol, abstol = options['reltol'], options['abstol']
+    errorsel = options['errorsel']
+
+    nonnegative = options['nonnegative']
+    if nonnegative is not None and options['mass'] is not None:
+        warning('OdePkg:InvalidArgument', 'Option "nonnegative" will be ignored if mass matrix is set')
+        nonnegative = None
+
+    outputsave = options['outputsave'] or 1
+    dense_output = options['dense_output']
+    maxstate = options['maxstate']
+
+    nStm = options['stm']
+    n = N if nStm is None else nStm
+    jacobian = options['jacobian']
+    if jacobian is None:
+        jacobian = lambda t, y, *args: _numerical_jacobian(vfun, t, y, n, *args)
+
+    maxstep = options['maxstep']
+    if maxstep is None:
+        maxstep = span/10
+    maxstep = abs(maxstep)
+
+    h = options['initialstep']
+    if h is None:
+        h = span/100
+    h = min(abs(h), maxstep)
+
+    U = np.empty((_STAGES, N))
+
+    capacity = len(tspan) if fixed_step else _INITIAL_BUFFER
+    tout = np.empty(capacity)
+    yout = np.empty((capacity, N))
+    tout[0] = t0
+    yout[0] = y
+    count = 1
+
+    if dense_output:
+        dense_t = np.empty(capacity)
+        dense_h = np.empty(capacity)
+        dense_y = np.empty((capacity, N))
+        dense_q = np.empty((capacity, N, 3))
+        dense_count = 0
+
+    t = t0
+    f0 = vfun(t, y, *args)
+    if not np.all(np.isfinite(f0)):
+        _abort_nonfinite(t)
+    nfevals = 1
+    njacs = 0
+    ndecomps = 0
+    nsteps = 0
+    nfailed = 0
+    smallest_step, largest_step = np.inf, 0.0
+    rejected = 0
+    nonfinite = 0
+    t_nonfinite = t0
+    last_saved = True
+    grid_idx = 1
+
+    J = None
+    jac_age = 0
+    lu = None
+    lu_step = None
+
+    # Non-finite stage rates are passed through and reject the step below
+    def solve(rhs):
+        if nStm is None:
+            return lu_solve(lu, rhs, check_finite=False)
+        # State and STM parts share the factorization of I/(h*gamma) - F
+        X = lu_solve(lu, np.column_stack((rhs[:n], rhs[n:].reshape((n, n)))), check_finite=False)
+        return np.concatenate((X[:, 0], X[:, 1:].reshape(n*n)))
+
+    while direction*(tf - t) > 0:
+        if fixed_step:
+            if grid_idx >= len(tspan):
+                break
+            step = tspan[grid_idx] - t
+        else:
+            min_step = 16*np.finfo(float).eps*max(abs(t), span)
+            if h < min_step:
+                error('OdePkg:InvalidArgument', 'Solving has not been successful. The iterative integration loop exited at time t = %f before endpoint at tend = %f was reached. This may happen if the stepsize grows smaller than defined in vminstepsize. Try to reduce the value of "initialstep" and/or "maxstep" with the command "odeset".\n' %
+                      (t, tf))
+            if h >= abs(tf - t):
+                h = abs(tf - t)
+            step = direction*h
+
+        if J is None or (jac_age > 0 and (rejected > 0 or jac_age >= _MAX_JACOBIAN_AGE)):
+            J_new = np.array(jacobian(t, y, *args), dtype=float)
+            njacs += 1
+            if np.all(np.isfinite(J_new)):
+                J = J_new
+            elif J is None:
+                _abort_nonfinite(t)
+            # Otherwise keep the last Jacobian, as between regular evaluations
+            jac_age = 0
+            lu = None
+        if lu is None or step != lu_step:
+            lu = lu_factor(np.eye(n)/(step*_GAMMA) - J)
+            lu_step = step
+            ndecomps += 1
+
+        U[0] = solve(f0)
+        for i in range(1, _STAGES):
+            y_stage = y + np.dot(_A[i, :i], U[:i])
+            U[i] = solve(vfun(t + _NODES[i]*step, y_stage, *args) + np.dot(_C[i, :i], U[:i])/step)
+        nfevals += _STAGES - 1
+
+        y_new = y + np.dot(_M, U)
+        if nonnegative is not None:
+            y_new[nonnegative] = np.abs(y_new[nonnegative])
+
+        if not np.all(np.isfinite(y_new)):
+            # Retry with a smaller step in case the trial step left the domain of 'vfun'
+            nonfinite += 1
+            t_nonfinite = t + step
+            if fixed_step or nonfinite >= _MAX_NONFINITE:
+                _abort_nonfinite(t + step)
+            accept = False
+            factor = _MIN_FACTOR
+        elif fixed_step and not gridcheck:
+            accept = True
+        else:
+            if errorsel is None:
+                y_err = np.dot(_E, U)
+                y_ctrl = y
+            else:
+                y_err = np.dot(_E, U[:, errorsel])
+                y_ctrl = y[errorsel]
+            if normcontrol:
+                delta = norm(y_err, np.inf)
+                tau = max(reltol*max(norm(y_ctrl, np.inf), 1.0), abstol)
+                ratio = delta/tau
+            else:
+                tau = np.maximum(reltol*np.abs(y_ctrl), abstol)
+                ratio = np.max(np.abs(y_err)/tau)
+            accept = ratio <= 1.0
+            if fixed_step and not accept:
+                _abort_grid_error(t + step, IntegratorStats(nfevals, nsteps, nfailed + 1, smallest_step, largest_step, time() - start_time, 1))
+
+            if ratio == 0:
+                factor = _MAX_FACTOR
+            else:
+                factor = min(_MAX_FACTOR, max(_MIN_FACTOR, _SAFETY*ratio**(-1./_ERROR_ORDER)))
+            if not accept:
+                factor = min(factor, 1.0)
+            elif 1.0 <= factor <= _HOLD_STEP:
+                factor = 1.0
+
+        if accept:
+            f1 = vfun(t + step, y_new, *args)
+            nfevals += 1
+            if not np.all(np.isfinite(f1)):
+                # Retry with a smaller step, as for non-finite trial steps
+                nonfinite += 1
+                t_nonfinite = t + step
+                if fixed_step or nonfinite >= _MAX_NONFINITE:
+                    _abort_nonfinite(t + step)
+                accept = False
+                factor = _MIN_FACTOR
+
+        if accept:
+            if dense_output:
+                if dense_count == dense_t.shape[0]:
+                    dense_t = _grow(dense_t, dense_count)
+                    dense_h = _grow(dense_h, dense_count)
+                    dense_y = _grow(dense_y, dense_count)
+                    dense_q = _grow(dense_q, dense_count)
+                # Cubic Hermite interpolation between the steps
+                slope = (y_new - y)/step
+                dense_t[dense_count] = t
+                dense_h[dense_count] = step
+                dense_y[dense_count] = y
+                dense_q[dense_count, :, 0] = f0
+                dense_q[dense_count, :, 1] = 3*slope - 2*f0 - f1
+                dense_q[dense_count, :, 2] = f0 + f1 - 2*slope
+                dense_count += 1
+
+            t = t + step
+            y = y_new
+            f0 = f1
+            nsteps += 1
+            smallest_step = min(smallest_step, abs(step))
+            largest_step = max(largest_step, abs(step))
+            jac_age += 1
+            rejected = 0
+            grid_idx += 1
+            # Count non-finite trial steps again once the propagation got past them
+            if direction*(t - t_nonfinite) >= 0:
+                nonfinite = 0
+            if maxstate is not None:
+                _check_bounds(t, y, maxstate)
+
+            last_saved = nsteps % outputsave == 0
+            if last_saved:
+                if count == tout.shape[0]:
+                    tout = _grow(tout, count)
+                    yout = _grow(yout, count)
+                tout[count] = t
+                yout[count] = y
+                count += 1
+        else:
+            nfailed += 1
+            rejected += 1
+            if rejected >= _MAX_REJECTED:
+                error("fatal", "Solving has not been successful. The iterative integration loop exited at time t = %f before endpoint at tend = %f was reached. This happened because the iterative integration loop does not find a valid solution at this time stamp. Try to reduce the value of \"initialstep\" and/or \"maxstep\" with the command \"odeset\".\n" %
+                      (t, tf))
+
+        if not fixed_step:
+            h = min(maxstep, h*factor)
+
+    if not last_saved:
+        if count == tout.shape[0]:
+            tout = _grow(tout, count)
+            yout = _grow(yout, count)
+        tout[count] = t
+        yout[count] = y
+        count += 1
+
+    if options['stats'] == 'on':
+        print('Number of successful steps %d' % nsteps)
+        print('Number of failed attempts:  %d' % nfailed)
+        print('Number of function calls:   %d' % nfevals)
+        print('Number of Jacobians:        %d' % njacs)
+        print('Number of LU decompositions: %d' % ndecomps)
+
+    tout = tout[:count]
+    yout = yout[:count]
+    if options['outputsel'] is not None:
+        yout = yout[:, options['outputsel']]
+
+    result = (tout, yout)
+    if dense_output:
+        dense = DenseOutput(dense_t[:dense_count], dense_h[:dense_count], dense_y[:dense_count], dense_q[:dense_count])
+        if options['outputsel'] is not None:
+            dense = dense.select(options['outputsel'])
+        result += (dense,)
+    if options['return_stats']:
+        result += (IntegratorStats(nfevals, nsteps, nfailed, smallest_step, largest_step, time() - start_time, 1),)
+    return result
@@ -0,0 +1,12 @@
+"""
+Real-only versions of the functions in beluga.utils.math, bound directly to the
+math module. The generated functions import them instead of beluga.utils.math
+when no complex numbers flow through them (finite-difference derivatives), which
+avoids the type and range checks on every call.
+
+Unlike beluga.utils.math, arguments outside the real domain of sqrt, log, asin,
+acos, acosh and atanh raise ValueError instead of giving complex results.
+"""
+from math import exp, log, log10, sqrt, \
+                 sin, cos, tan, asin, acos, atan, \
+                 sinh, cosh, tanh, asinh, acosh, atanh
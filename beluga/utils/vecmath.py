@@ -0,0 +1,58 @@
+"""
+Array versions of the functions in beluga.utils.math, used by the vectorized
+functions generated from the *_vec templates. Every function is a NumPy ufunc or
+a thin wrapper around one, so expressions broadcast over all points at once.
+
+As in beluga.utils.math, arguments outside the real domain of sqrt, log, asin,
+acos, acosh and atanh give complex results instead of NaN.
+"""
+import numpy as np
+
+I = 1j
+pi = np.pi
+e = np.e
+
+exp = np.exp
+log = np.emath.log
+log10 = np.emath.log10
+sqrt = np.emath.sqrt
+
+sin = np.sin
+cos = np.cos
+tan = np.tan
+asin = np.emath.arcsin
+acos = np.emath.arccos
+atan = np.arctan
+atan2 = np.arctan2
+
+sinh = np.sinh
+cosh = np.cosh
+tanh = np.tanh
+asinh = np.arcsinh
+
+
+def acosh(x):
+    x = np.asarray(x)
+    if not np.iscomplexobj(x) and np.any(x < 1):
+        x = x.astype(complex)
+    return np.arccosh(x)
+
+
+def atanh(x):
+    x = np.asarray(x)
+    if not np.iscomplexobj(x) and np.any(np.abs(x) > 1):
+        x = x.astype(complex)
+    return np.arctanh(x)
+
+
+def im(x):
+    return np.imag(x)
+
+
+def broadcast_rows(rows, shape):
+    """
+    Stacks a list of expressions into an array with one row per expression.
+        Expressions that do not depend on the states (e.g. constants) are
+        broadcast to 'shape', the shape of one row of states.
+    """
+    return np.array([np.broadcast_to(row, shape) for row in rows])
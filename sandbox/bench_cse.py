@@ -0,0 +1,76 @@
+"""
+Compares the evaluation time of the generated problem functions with and without
+common-subexpression elimination on the hypersonic examples.
+
+Usage: python bench_cse.py [example ...]
+       examples: planarHypersonic, hypersonic3DOF, hypersonic3DOFCrossrange
+
+Deriving the necessary conditions of the 3DOF examples takes several minutes.
+"""
+import ast
+import os
+import sys
+from timeit import timeit
+
+import numpy as np
+
+from beluga.optim.NecessaryConditions import NecessaryConditions
+
+root = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'examples')
+examples = {'planarHypersonic': os.path.join(root, 'planarHypersonic', 'planarHypersonic.py'),
+            'hypersonic3DOF': os.path.join(root, 'hypersonic3DOF', 'hypersonic3DOF.py'),
+            'hypersonic3DOFCrossrange': os.path.join(root, 'Sparapany', 'ParallelTimeTrials', 'hypersonic3DOFCrossrange.py')}
+
+def load_get_problem(filename):
+    """
+    Returns get_problem() of an example script. Only the imports and the function
+    itself are run, as some examples need MATLAB in their main block.
+    """
+    tree = ast.parse(open(filename).read(), filename)
+    body = [node for node in tree.body
+            if isinstance(node, ast.FunctionDef) and node.name == 'get_problem' or
+               isinstance(node, (ast.Import, ast.ImportFrom)) and 'matlab' not in ast.dump(node)]
+    namespace = {}
+    exec(compile(ast.Module(body=body, type_ignores=[]), filename, 'exec'), namespace)
+    return namespace['get_problem']
+
+def time_functions(filename, cse):
+    # Some examples load their initial guess from the example directory
+    cwd = os.getcwd()
+    os.chdir(os.path.dirname(filename))
+    try:
+        get_problem = load_get_problem(filename)
+        args = [None]*get_problem.__code__.co_argcount
+        problem = get_problem(*args)
+        bvp = NecessaryConditions(cse=cse).get_bvp(problem)
+        # Evaluate at the end points of the initial guess
+        solinit = problem.guess.generate(bvp)
+    finally:
+        os.chdir(cwd)
+
+    ya, yb, p = solinit.y[:,0], solinit.y[:,-1], solinit.parameters
+    aux = bvp.solution.aux
+    aux['initial'] = dict(zip(bvp.problem_data['state_list'], ya))
+    aux['terminal'] = dict(zip(bvp.problem_data['state_list'], yb))
+
+    number = 2000
+    results = {'deriv_func': timeit(lambda: bvp.deriv_func(0, ya, p, aux), number=number)/number,
+               'bc_func': timeit(lambda: bvp.bc_func(ya, yb, p, aux), number=number)/number}
+    if bvp.problem_data['control_options']:
+        results['compute_control'] = timeit(lambda: bvp.control_func(0, ya, p, aux), number=number)/number
+    return results, bvp.deriv_func(0, ya, p, aux)
+
+def main():
+    names = sys.argv[1:] or list(examples)
+    for name in names:
+        before, f_before = time_functions(examples[name], cse=False)
+        after, f_after = time_functions(examples[name], cse=True)
+        print(name)
+        print('   function           before [us]   after [us]   speedup')
+        for func in before:
+            print('   %-18s %-13.1f %-12.1f %.2f' % (func, 1e6*before[func], 1e6*after[func], before[func]/after[func]))
+        print('   max. relative difference of deriv_func: %.1e' %
+              np.max(np.abs(f_after - f_before)/np.maximum(np.abs(f_before), 1.0)))
+
+if __name__ == '__main__':
+    main()
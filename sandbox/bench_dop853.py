@@ -0,0 +1,76 @@
+"""
+Compares the number of RHS evaluations of dop853, dopri5 and ode45_old at equal
+accuracy on a planar hypersonic glide at constant angle of attack.
+
+Usage: python bench_dop853.py
+"""
+import numpy as np
+from math import pi
+
+from beluga.utils.ode45_old import ode45_old
+from beluga.utils.propagators import dopri5, dop853
+
+# Same vehicle and atmosphere as examples/planarHypersonic
+mu = 3.986e5*1e9
+rho0 = 1.2
+H = 7500
+mass = 750/2.2046226
+re = 6378000
+Aref = pi*(24*.0254/2)**2
+alfa = 5*pi/180
+Cl = 1.5658*alfa
+Cd = 1.6537*alfa**2 + 0.0612
+
+nfevals = [0]
+def glide(t, X):
+    nfevals[0] += 1
+    h, theta, v, gam = X
+    r = re + h
+    q = 0.5*rho0*np.exp(-h/H)*v**2*Aref
+    return np.array([v*np.sin(gam),
+                     v*np.cos(gam)/r,
+                     -q*Cd/mass - mu*np.sin(gam)/r**2,
+                     q*Cl/(mass*v) + (v/r - mu/(v*r**2))*np.cos(gam)])
+
+y0 = np.array([80000.0, 0.0, 5000.0, -5*pi/180])
+tspan = [0.0, 200.0]
+# Scale of each state for the error measure
+scale = np.array([1000.0, 1e-3, 100.0, 1e-2])
+
+def run(solver, tol):
+    nfevals[0] = 0
+    out = solver(glide, tspan, y0, reltol=tol, abstol=tol)
+    return out[1][-1], nfevals[0]
+
+def main():
+    reference = dop853(glide, tspan, y0, reltol=1e-14, abstol=1e-14)[1][-1]
+
+    results = {}
+    for (name, solver) in [('ode45_old', ode45_old), ('dopri5', dopri5), ('dop853', dop853)]:
+        results[name] = []
+        print(name)
+        print('   tolerance     error       RHS calls')
+        for tol in 10.0**-np.arange(5, 13):
+            try:
+                yf, n = run(solver, tol)
+            except Exception:
+                continue
+            err = np.max(np.abs(yf - reference)/scale)
+            results[name].append((err, n))
+            print('   %.0e     %.3e   %d' % (tol, err, n))
+
+    # RHS calls needed for a given error, interpolated in log-log scale
+    print('\nRHS calls at equal accuracy')
+    print('   error      ' + ''.join('%-12s' % name for name in results))
+    for target in [1e-5, 1e-7, 1e-9]:
+        row = []
+        for name in results:
+            err, n = np.array(sorted(results[name])).T
+            if target < err[0] or target > err[-1]:
+                row.append('-')
+            else:
+                row.append('%d' % np.exp(np.interp(np.log(target), np.log(err), np.log(n))))
+        print('   %.0e    ' % target + ''.join('%-12s' % r for r in row))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+"""
+Compares the wall time and RHS evaluations of the vectorized Chebyshev-Picard
+propagator against dopri5 and ode45_old on a planar hypersonic glide at constant
+angle of attack.
+
+Usage: python bench_mcpi.py
+"""
+import numpy as np
+from math import pi
+from time import time
+
+from beluga.utils.ode45_old import ode45_old
+from beluga.utils.propagators import dopri5, dop853, mcpi
+
+# Same vehicle and atmosphere as examples/planarHypersonic
+mu = 3.986e5*1e9
+rho0 = 1.2
+H = 7500
+mass = 750/2.2046226
+re = 6378000
+Aref = pi*(24*.0254/2)**2
+alfa = 5*pi/180
+Cl = 1.5658*alfa
+Cd = 1.6537*alfa**2 + 0.0612
+
+ncalls = [0]
+def glide(t, X):
+    # Works on one state vector or on one column of states per node
+    ncalls[0] += 1
+    h, theta, v, gam = X
+    r = re + h
+    q = 0.5*rho0*np.exp(-h/H)*v**2*Aref
+    return np.array([v*np.sin(gam),
+                     v*np.cos(gam)/r,
+                     -q*Cd/mass - mu*np.sin(gam)/r**2,
+                     q*Cl/(mass*v) + (v/r - mu/(v*r**2))*np.cos(gam)])
+
+y0 = np.array([80000.0, 0.0, 5000.0, -5*pi/180])
+tspan = [0.0, 200.0]
+# Scale of each state for the error measure
+scale = np.array([1000.0, 1e-3, 100.0, 1e-2])
+
+solvers = [('ode45_old', ode45_old, {}),
+           ('dopri5', dopri5, {}),
+           ('mcpi', mcpi, {}),
+           ('mcpi (vectorized)', mcpi, {'vectorized': True})]
+
+def run(solver, tol, options, repeat=3):
+    best = np.inf
+    for _ in range(repeat):
+        ncalls[0] = 0
+        start = time()
+        out = solver(glide, tspan, y0, reltol=tol, abstol=tol, return_stats=True, **options)
+        best = min(best, time() - start)
+    return out[1][-1], out[-1].nfevals, ncalls[0], best
+
+def main():
+    reference = dop853(glide, tspan, y0, reltol=1e-14, abstol=1e-14)[1][-1]
+
+    print('%-20s%-12s%-12s%-12s%-12s%s' % ('solver', 'tolerance', 'error', 'RHS evals', 'RHS calls', 'time [ms]'))
+    for (name, solver, options) in solvers:
+        for tol in [1e-6, 1e-8, 1e-10]:
+            try:
+                yf, nfevals, calls, elapsed = run(solver, tol, options)
+            except Exception:
+                continue
+            err = np.max(np.abs(yf - reference)/scale)
+            print('%-20s%-12.0e%-12.3e%-12d%-12d%.2f' % (name, tol, err, nfevals, calls, 1000*elapsed))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+"""
+Compares the evaluation time of the real-only problem functions that the
+finite-difference solvers use, as generated Python code and compiled with Numba.
+
+Usage: python bench_numba.py [example ...]
+       examples: brachistochrone, planarHypersonic, hypersonic3DOF
+
+Needs Numba. The functions are compiled (or loaded from the cache directory)
+in get_bvp, whose time is shown as well.
+"""
+import ast
+import os
+import sys
+import tempfile
+import time
+from timeit import timeit
+
+import numpy as np
+
+from beluga.optim.NecessaryConditions import NecessaryConditions, NUMBASUPPORTED
+
+root = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'examples')
+examples = {'brachistochrone': os.path.join(root, 'brachistochrone', 'brachisto.py'),
+            'planarHypersonic': os.path.join(root, 'planarHypersonic', 'planarHypersonic.py'),
+            'hypersonic3DOF': os.path.join(root, 'hypersonic3DOF', 'hypersonic3DOF.py')}
+
+def load_get_problem(filename):
+    """
+    Returns get_problem() of an example script. Only the imports and the function
+    itself are run, as some examples need MATLAB in their main block.
+    """
+    tree = ast.parse(open(filename).read(), filename)
+    body = [node for node in tree.body
+            if isinstance(node, ast.FunctionDef) and node.name == 'get_problem' or
+               isinstance(node, (ast.Import, ast.ImportFrom)) and 'matlab' not in ast.dump(node)]
+    namespace = {}
+    exec(compile(ast.Module(body=body, type_ignores=[]), filename, 'exec'), namespace)
+    return namespace['get_problem']
+
+def time_functions(filename, backend, cache_dir):
+    # Some examples load their initial guess from the example directory
+    cwd = os.getcwd()
+    os.chdir(os.path.dirname(filename))
+    try:
+        get_problem = load_get_problem(filename)
+        args = [None]*get_problem.__code__.co_argcount
+        problem = get_problem(*args)
+        start = time.time()
+        bvp = NecessaryConditions(backend=backend, cache_dir=cache_dir).get_bvp(problem)
+        setup_time = time.time() - start
+        # Evaluate at the end points of the initial guess
+        solinit = problem.guess.generate(bvp)
+    finally:
+        os.chdir(cwd)
+
+    ya, yb, p = solinit.y[:,0], solinit.y[:,-1], np.asarray(solinit.parameters, dtype=float)
+    aux = bvp.solution.aux
+    aux['initial'] = dict(zip(bvp.problem_data['state_list'], ya))
+    aux['terminal'] = dict(zip(bvp.problem_data['state_list'], yb))
+    funcs = bvp.real_variant()
+    aux = funcs.pack_aux(aux)
+    Y = np.r_[ya, np.eye(len(ya)).reshape(-1)]
+
+    calls = {'deriv_func': lambda: funcs.deriv_func(0.0, ya, p, aux),
+             'bc_func': lambda: funcs.bc_func(ya, yb, p, aux)}
+    if funcs.deriv_stm_func is not None:
+        calls['deriv_stm_func'] = lambda: funcs.deriv_stm_func(0.0, Y, None, p, aux)
+
+    number = 2000
+    return setup_time, dict((name, timeit(call, number=number)/number) for (name, call) in calls.items())
+
+def main():
+    if not NUMBASUPPORTED:
+        print('Numba is not installed')
+        return
+    names = sys.argv[1:] or list(examples)
+    # Shared by both runs of each example, the second one loads the compiled code
+    cache_dir = tempfile.mkdtemp()
+    for name in names:
+        _, python = time_functions(examples[name], 'python', cache_dir)
+        setup_numba, _ = time_functions(examples[name], 'numba', cache_dir)
+        setup_cached, cached = time_functions(examples[name], 'numba', cache_dir)
+        print(name)
+        print('   get_bvp with Numba: %.1f s, with the cached code: %.1f s' % (setup_numba, setup_cached))
+        print('   function           python [us]   numba [us]   speedup')
+        for func in python:
+            print('   %-18s %-13.1f %-12.1f %.1f' % (func, 1e6*python[func], 1e6*cached[func], python[func]/cached[func]))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,24 @@
+from math import *
+import numpy as np
+import pytest
+
+from beluga.bvpsol.Algorithm import RejectOutsideDomain
+
+def test_reject_outside_domain():
+    """Only math domain errors give NaN results, other errors are raised"""
+    def odefn(t,y,p,aux):
+        return np.array([sqrt(y[0]), y[1]])
+    func = RejectOutsideDomain(odefn)
+    assert func(0, np.array([4.0, 1.0]), [], {})[0] == 2.0
+    assert np.all(np.isnan(func(0, np.array([-4.0, 1.0, 0, 0, 0, 0]), [], {})))
+    assert func(0, np.array([-4.0, 1.0, 0, 0, 0, 0]), [], {}).shape == (6,)
+
+    # The Jacobian of two states with their STM is a 2x2 matrix
+    jac = RejectOutsideDomain(lambda t,y,p,aux: np.diag([0.5/sqrt(y[0]), 1.0]), jacobian=True)
+    J = jac(0, np.array([-4.0, 1.0, 1, 0, 0, 1]), [], {})
+    assert J.shape == (2, 2) and np.all(np.isnan(J))
+
+    def odefn_bug(t,y,p,aux):
+        return np.reshape(y, (4, 4))
+    with pytest.raises(ValueError):
+        RejectOutsideDomain(odefn_bug)(0, np.array([1.0, 1.0]), [], {})
@@ -0,0 +1,97 @@
+from math import *
+import beluga.bvpsol as bvpsol
+from beluga.bvpsol.algorithms.GACPI import GACPI
+import numpy as np
+import numpy.testing as npt
+
+def test_solve():
+    """Test GACPI using analytic solution of a BVP"""
+    calls = [0]
+    def odefn(t,X,p,aux):
+        calls[0] += 1
+        y = X[0]
+        ydot = X[1]
+        xf = p[0]
+        # y'' + y(x) = 0, also with one column of states per node
+        return xf*np.array([
+            ydot,
+            -y
+        ])
+
+    def bcfn(ya,yb,p,aux):
+        # y(0) = 0
+        # y(pi/2) = 2
+        return np.array([
+                    ya[0] - 0,
+                    yb[0] - 2,
+                    p[0]  - pi/2])
+
+    x = np.linspace(0,1,3)
+    y = np.array([[0,0.05,0.1],[0.1,1,2]])
+
+    # Vectorized ODE function, called once per Picard iteration with all nodes
+    bvp = bvpsol.BVP(odefn,bcfn,deriv_func_vec=odefn)
+    bvp.solution = bvpsol.Solution(x,y,[pi/2])
+    sol = GACPI(tolerance=1e-6).solve(bvp)
+    assert sol.converged
+    assert sol.y.shape[1] == sol.x.size > 3
+
+    # Computing analytic solutions
+    xs = sol.parameters[0]*sol.x
+    y_expected = [2*np.sin(xs), 2*np.cos(xs)]
+    npt.assert_almost_equal(sol.y,y_expected,decimal=5)
+    npt.assert_almost_equal(sol.parameters,[pi/2])
+
+    # Without the vectorized function the nodes are evaluated one by one
+    vec_calls = calls[0]
+    calls[0] = 0
+    bvp = bvpsol.BVP(odefn,bcfn)
+    bvp.solution = bvpsol.Solution(x,y,[pi/2])
+    sol2 = GACPI(tolerance=1e-6).solve(bvp)
+    assert sol2.converged
+    npt.assert_almost_equal(sol2.y,sol.y)
+    assert vec_calls*sol.x.size < calls[0]
+
+def test_solve_bc_jacobian():
+    """GACPI uses the generated BC Jacobian, or the two sides of the BCs for finite differences"""
+    def odefn(t,X,p,aux):
+        return p[0]*np.array([X[1], -X[0]])
+
+    def bcfn(ya,yb,p,aux):
+        return np.array([ya[0], yb[0] - 2, p[0] - pi/2])
+
+    calls = {'jac': 0, 'left': 0, 'right': 0}
+    def bc_jac(ya,yb,p,aux):
+        calls['jac'] += 1
+        M = np.array([[1.0, 0], [0, 0], [0, 0]])
+        N = np.array([[0, 0], [1.0, 0], [0, 0]])
+        P = np.array([[0], [0], [1.0]])
+        return M, N, P
+
+    def bc_left(ya,p,aux):
+        calls['left'] += 1
+        return np.array([ya[0]])
+
+    def bc_right(yb,p,aux):
+        calls['right'] += 1
+        return np.array([yb[0] - 2, p[0] - pi/2])
+
+    x = np.linspace(0,1,3)
+    y = np.array([[0,0.05,0.1],[0.1,1,2]])
+    bvp = bvpsol.BVP(odefn,bcfn,deriv_func_vec=odefn)
+    bvp.solution = bvpsol.Solution(x,y,[pi/2])
+    ref = GACPI().solve(bvp)
+
+    bvp = bvpsol.BVP(odefn,bcfn,deriv_func_vec=odefn,bc_jac_func=bc_jac)
+    bvp.solution = bvpsol.Solution(x,y,[pi/2])
+    sol = GACPI().solve(bvp)
+    assert sol.converged and calls['jac'] > 0
+    npt.assert_almost_equal(sol.y,ref.y)
+
+    bvp = bvpsol.BVP(odefn,bcfn,deriv_func_vec=odefn,bc_func_left=bc_left,bc_func_right=bc_right)
+    bvp.solution = bvpsol.Solution(x,y,[pi/2])
+    sol = GACPI().solve(bvp)
+    assert sol.converged
+    npt.assert_almost_equal(sol.y,ref.y)
+    # Each side is evaluated once unperturbed and once per perturbed state of its own side
+    assert calls['left'] == calls['right'] > 0
@@ -80,5 +80,84 @@ def test_solve():
     npt.assert_almost_equal(sol_csd1.y,y_expected_csd1,decimal=5)
     npt.assert_almost_equal(sol_csd3.y,y_expected_csd3,decimal=5)
 
+    # Test with an analytic Jacobian of the boundary conditions
+    def bcjacfn(ya,yb,p,aux):
+        dbcdya = np.array([[1.0, 0.0],
+                           [0.0, 0.0],
+                           [0.0, 0.0]])
+        dbcdyb = np.array([[0.0, 0.0],
+                           [1.0, 0.0],
+                           [0.0, 0.0]])
+        dbcdp = np.array([[0.0],
+                          [0.0],
+                          [1.0]])
+        return dbcdya, dbcdyb, dbcdp
+
+    bvp_jac = bvpsol.BVP(odefn,bcfn,bc_jac_func=bcjacfn)
+    bvp_jac.solution = bvpsol.Solution(np.linspace(0,1,3),np.array([[0,0.1],[0,2]]),[pi/2])
+    sol_jac3 = solver_fd3.solve(bvp_jac)
+    x_jac3 = sol_jac3.parameters[0]*sol_jac3.x
+    npt.assert_almost_equal(sol_jac3.y,[A*np.sin(x_jac3), A*np.cos(x_jac3)],decimal=5)
+
+    # Test with the two sides of the boundary conditions, of which the numerical
+    # Jacobian only evaluates the ones that the perturbed state enters
+    calls = {'left': 0, 'right': 0}
+    def bcfn_left(ya,p,aux):
+        calls['left'] += 1
+        return np.array([ya[0] - 0])
+
+    def bcfn_right(yb,p,aux):
+        calls['right'] += 1
+        return np.array([yb[0] - 2, p[0] - pi/2])
+
+    full_calls = [0]
+    def bcfn_counted(ya,yb,p,aux):
+        full_calls[0] += 1
+        return bcfn(ya,yb,p,aux)
+
+    bvp_sides = bvpsol.BVP(odefn,bcfn_counted,bc_func_left=bcfn_left,bc_func_right=bcfn_right)
+    bvp_sides.solution = bvpsol.Solution(np.linspace(0,1,3),np.array([[0,0.1],[0,2]]),[pi/2])
+    sol_sides3 = solver_fd3.solve(bvp_sides)
+    npt.assert_almost_equal(sol_sides3.y,sol_jac3.y,decimal=5)
+    # One evaluation of each side and one per state of the first or the last arc
+    assert calls['left'] == calls['right'] > 0
+    assert calls['left'] % 3 == 0
+    # The full boundary conditions give the residual of each iteration and the
+    # parameter column of each Jacobian, but not the unperturbed residual again
+    njacs = calls['left']//3
+    assert full_calls[0] == len(sol_sides3.integrator_stats) + njacs
+
+def test_solve_batched():
+    """Test batched propagation of the arcs against the arc by arc solve"""
+    def odefn(t,X,p,aux):
+        return p[0]*np.array([X[1], -X[0]])
+
+    def odefn_vec(t,X,p,aux):
+        # One column of states per arc
+        return p[0]*np.array([X[1], -X[0]])
+
+    def bcfn(ya,yb,p,aux):
+        return np.array([ya[0] - 0, yb[0] - 2, p[0] - pi/2])
+
+    solver = algorithms.MultipleShooting(derivative_method='fd',cached=False,tolerance=1e-6,number_arcs=4)
+    bvp = bvpsol.BVP(odefn,bcfn)
+    bvp.solution = bvpsol.Solution(np.linspace(0,1,5),np.array([[0,0.1,0.2,0.3,0.4],[0,2,2,2,2]]),[pi/2])
+    sol = solver.solve(bvp)
+    assert sol.converged
+
+    for derivative_method in ['fd','csd']:
+        solver_batched = algorithms.MultipleShooting(derivative_method=derivative_method,cached=False,tolerance=1e-6,number_arcs=4,batched=True)
+        # With the vectorized ODE function and with the ODE function called arc by arc
+        for deriv_func_vec in [odefn_vec, None]:
+            bvp_batched = bvpsol.BVP(odefn,bcfn,deriv_func_vec=deriv_func_vec)
+            bvp_batched.solution = bvpsol.Solution(np.linspace(0,1,5),np.array([[0,0.1,0.2,0.3,0.4],[0,2,2,2,2]]),[pi/2])
+            sol_batched = solver_batched.solve(bvp_batched)
+            assert sol_batched.converged
+            npt.assert_almost_equal(sol_batched.y[:,0],sol.y[:,0],decimal=5)
+            npt.assert_almost_equal(sol_batched.y[:,-1],sol.y[:,-1],decimal=5)
+
+    with pytest.raises(ValueError):
+        algorithms.MultipleShooting(number_arcs=4,propagator='rosenbrock',batched=True)
+
 if __name__ == '__main__':
     test_solve()
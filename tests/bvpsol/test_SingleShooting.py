@@ -5,57 +5,226 @@ import numpy as np
 import numpy.testing as npt
 import pytest
 
-def test_solve():
+def odefn(t,X,p,aux):
+    y = X[0]
+    ydot = X[1]
+    xf = p[0]
+    # y'' + y(x) = 0
+    return xf*np.array([
+        ydot,
+        -y
+    ])
+
+def bcfn(ya,yb,p,aux):
+    # y(0) = 0
+    # y(pi/2) = 2
+    return np.array([
+                ya[0] - 0,
+                yb[0] - 2,
+                p[0]  - pi/2])
+
+def jacfn(t,X,p,aux):
+    xf = p[0]
+    dfdX = xf*np.array([[0.0, 1.0],
+                        [-1.0, 0.0]])
+    dfdp = np.array([[X[1]],
+                     [-X[0]]])
+    return dfdX, dfdp
+
+def bcjacfn(ya,yb,p,aux):
+    dbcdya = np.array([[1.0, 0.0],
+                       [0.0, 0.0],
+                       [0.0, 0.0]])
+    dbcdyb = np.array([[0.0, 0.0],
+                       [1.0, 0.0],
+                       [0.0, 0.0]])
+    dbcdp = np.array([[0.0],
+                      [0.0],
+                      [1.0]])
+    return dbcdya, dbcdyb, dbcdp
+
+def make_bvp(**kwargs):
+    """Returns the BVP y'' + y = 0 with y(0) = 0 and y(pi/2) = 2 and its initial guess"""
+    bvp = bvpsol.BVP(odefn,bcfn,**kwargs)
+    bvp.solution = bvpsol.Solution(np.linspace(0,1,2),np.array([[0,0.1],[0,2]]),[pi/2])
+    return bvp
+
+def assert_analytic(sol):
+    """Compares a solution with the analytic solution y = 2 sin(x)"""
+    x = sol.parameters[0]*sol.x
+    npt.assert_almost_equal(sol.y,[2*np.sin(x), 2*np.cos(x)],decimal=5)
+
+@pytest.mark.parametrize('derivative_method', ['fd', 'csd'])
+def test_solve(derivative_method):
     """Test solver using analytic solution of a BVP"""
+    solver = algorithms.SingleShooting(derivative_method=derivative_method,cached=False,tolerance=1e-6)
+    assert_analytic(solver.solve(make_bvp()))
+
+def test_solve_integrator_stats():
+    """One integrator statistics record per Newton iteration"""
+    solver = algorithms.SingleShooting(derivative_method='csd',cached=False,tolerance=1e-6)
+    sol = solver.solve(make_bvp())
+    assert len(sol.integrator_stats) > 0
+    assert all(stats.nfevals > 0 for stats in sol.integrator_stats)
+
+def test_solve_replay_tolerance():
+    """Replaying the steps of earlier iterations does not change the solution"""
+    solver = algorithms.SingleShooting(derivative_method='csd',cached=False,tolerance=1e-6,replay_tolerance=1e-2)
+    assert_analytic(solver.solve(make_bvp()))
+
+def test_solve_stm_error_control():
+    """Error control on the states only converges like error control on the STM as well"""
+    solver = algorithms.SingleShooting(derivative_method='csd',cached=False,tolerance=1e-6)
+    sol = solver.solve(make_bvp())
+    solver_stm = algorithms.SingleShooting(derivative_method='csd',cached=False,tolerance=1e-6,stm_error_control=True)
+    sol_stm = solver_stm.solve(make_bvp())
+    assert_analytic(sol_stm)
+    assert sol.converged and sol_stm.converged
+    # Same number of Newton iterations
+    assert len(sol.integrator_stats) == len(sol_stm.integrator_stats)
+
+@pytest.mark.parametrize('propagator', ['dop853', 'rosenbrock'])
+def test_solve_propagator(propagator):
+    """Test the 8th order and the stiff propagators"""
+    solver = algorithms.SingleShooting(derivative_method='csd',cached=False,tolerance=1e-6,propagator=propagator)
+    assert_analytic(solver.solve(make_bvp()))
+
+@pytest.mark.parametrize('propagator', ['dopri5', 'rosenbrock'])
+def test_solve_jacobians(propagator):
+    """Test with analytic Jacobians of the ODE function and the boundary conditions"""
+    solver = algorithms.SingleShooting(derivative_method='fd',cached=False,tolerance=1e-6,propagator=propagator)
+    assert_analytic(solver.solve(make_bvp(deriv_jac_func=jacfn,bc_jac_func=bcjacfn)))
+
+def test_solve_deriv_stm_func():
+    """Test with a fused function for the states and the STM"""
+    def stmfn(t,Y,odefn,p,aux):
+        phi = Y[2:].reshape((2,2))
+        return np.r_[odefn(t,Y[:2],p,aux), np.dot(jacfn(t,Y[:2],p,aux)[0],phi).reshape(4)]
+
+    bvp = make_bvp(deriv_jac_func=jacfn,bc_jac_func=bcjacfn)
+    bvp.deriv_stm_func = stmfn
+    solver = algorithms.SingleShooting(derivative_method='fd',cached=False,tolerance=1e-6)
+    assert_analytic(solver.solve(bvp))
+
+@pytest.mark.parametrize('derivative_method', ['fd', 'csd'])
+def test_solve_bc_sides(derivative_method):
+    """Test with the two sides of the boundary conditions, of which the numerical
+    Jacobian only evaluates the perturbed one"""
+    calls = {'left': 0, 'right': 0}
+    def bcfn_left(ya,p,aux):
+        calls['left'] += 1
+        return np.array([ya[0] - 0])
+
+    def bcfn_right(yb,p,aux):
+        calls['right'] += 1
+        return np.array([yb[0] - 2, p[0] - pi/2])
+
+    solver = algorithms.SingleShooting(derivative_method=derivative_method,cached=False,tolerance=1e-6)
+    assert_analytic(solver.solve(make_bvp(bc_func_left=bcfn_left,bc_func_right=bcfn_right)))
+    # One evaluation of each side and one per perturbed state of that side
+    assert calls['left'] == calls['right'] > 0
+    assert calls['left'] % 3 == 0
+
+def test_solve_replay():
+    """Test that small Newton corrections replay the steps of the last propagation"""
+    calls = [0]
     def odefn(t,X,p,aux):
-        y = X[0]
-        ydot = X[1]
-        xf = p[0]
-        # y'' + y(x) = 0
-        return xf*np.array([
-            ydot,
-            -y
-        ])
+        calls[0] += 1
+        # y'' = -exp(y) with a narrow pulse that makes the adaptive steps fail
+        return np.array([X[1], -np.exp(X[0]) + 10*np.exp(-((t-0.5)/0.02)**2)])
 
     def bcfn(ya,yb,p,aux):
-        # y(0) = 0
-        # y(pi/2) = 2
-        return np.array([
-                    ya[0] - 0,
-                    yb[0] - 2,
-                    p[0]  - pi/2])
-
-    solver_fd  = algorithms.SingleShooting(derivative_method='fd',cached=False,tolerance=1e-6)
-    solver_csd = algorithms.SingleShooting(derivative_method='csd',cached=False,tolerance=1e-6)
-    bvp = bvpsol.BVP(odefn,bcfn)
+        return np.array([ya[0], yb[0], p[0] - 1.0])
+
+    solutions, counts = [], []
+    for replay_tolerance in [1e-2, None]:
+        solver = algorithms.SingleShooting(derivative_method='fd',cached=False,tolerance=1e-8,replay_tolerance=replay_tolerance)
+        # Record the number of time stamps given to the propagator
+        propagator = solver.propagator
+        tspans = []
+        stm_calls = [0]
+        def spy(f, tspan, *args, **kwargs):
+            tspans.append(len(tspan))
+            def counted(*fargs):
+                stm_calls[0] += 1
+                return f(*fargs)
+            return propagator(counted, tspan, *args, **kwargs)
+        solver.propagator = spy
+
+        bvp = bvpsol.BVP(odefn,bcfn)
+        bvp.solution = bvpsol.Solution(np.linspace(0,1,2),np.zeros((2,2)),[1.0])
+        calls[0] = 0
+        sol = solver.solve(bvp)
+        assert sol.converged
+        solutions.append(sol)
+        counts.append(calls[0])
+        # Aborted replays are counted in the statistics as well
+        assert sum(stats.nfevals for stats in sol.integrator_stats) == stm_calls[0]
+        if replay_tolerance is None:
+            assert max(tspans) == 2
+        else:
+            # The converged iterate was propagated on a replayed grid
+            assert tspans[-1] > 2
 
-    x = np.linspace(0,1,2)
-    bad_y = np.array([[0,0],[0,2]])
+    npt.assert_almost_equal(solutions[0].y[:,0],solutions[1].y[:,0],decimal=8)
+    npt.assert_almost_equal(solutions[0].y[:,-1],solutions[1].y[:,-1],decimal=6)
+    assert counts[0] < counts[1]
 
-    # Test that raises error
+def test_solve_replay_aborted():
+    """The cost of an aborted replay is counted in the integrator statistics"""
+    def odefn(t,X,p,aux):
+        return np.array([X[1], -np.exp(X[0]) + 10*np.exp(-((t-0.5)/0.02)**2)])
 
-    # bvp.solution = bvpsol.Solution(x,bad_y,[pi/2])
-    # with pytest.raises(np.linalg.linalg.LinAlgError):
-    #     solver_fd.solve(bvp)
+    def bcfn(ya,yb,p,aux):
+        return np.array([ya[0], yb[0], p[0] - 1.0])
 
-    y = np.array([[0,0.1],[0,2]])
-    bvp.solution = bvpsol.Solution(x,y,[pi/2])
+    solver = algorithms.SingleShooting(derivative_method='fd',cached=False,tolerance=1e-8,replay_tolerance=1e-2)
+    propagator = solver.propagator
+    stm_calls = [0]
+    aborted = []
+    def spy(f, tspan, *args, **kwargs):
+        def counted(*fargs):
+            stm_calls[0] += 1
+            return f(*fargs)
+        out = propagator(counted, tspan, *args, **kwargs)
+        if len(tspan) > 2 and not aborted:
+            # Abort the first replay after it is done, as a failed error check would
+            e = RuntimeError('Replay aborted')
+            e.stats = out[-1]
+            aborted.append(e.stats.nfevals)
+            raise e
+        return out
+    solver.propagator = spy
 
-    sol = solver_fd.solve(bvp)
+    bvp = bvpsol.BVP(odefn,bcfn)
+    bvp.solution = bvpsol.Solution(np.linspace(0,1,2),np.zeros((2,2)),[1.0])
+    sol = solver.solve(bvp)
+    assert sol.converged and aborted[0] > 0
+    assert sum(stats.nfevals for stats in sol.integrator_stats) == stm_calls[0]
 
-    # Computing analytic solutions
-    A = 2
-    B = 0
-    x = sol.parameters[0]*sol.x
-    y_expected = [  A*np.sin(x) + B*np.cos(x),
-                    A*np.cos(x) - B*np.sin(x)]
+@pytest.mark.parametrize('propagator', ['dopri5', 'rosenbrock'])
+def test_solve_outside_domain(propagator):
+    """Out-of-domain errors of the real-only functions reject the trial step or keep the last Jacobian"""
+    def odefn(t,X,p,aux):
+        return p[0]*np.array([X[1], -X[0]])
+
+    calls = [0]
+    def odefn_real(t,X,p,aux):
+        # Stands in for a math function that raises ValueError on some trial steps
+        calls[0] += 1
+        if calls[0] % 50 == 0 and t > 0:
+            sqrt(-1.0)
+        return odefn(t,X,p,aux)
 
-    # Test for Finite Difference solver
-    npt.assert_almost_equal(sol.y,y_expected,decimal=5)
+    def bcfn(ya,yb,p,aux):
+        return np.array([ya[0] - 0, yb[0] - 2, p[0] - pi/2])
 
-    # Test for Complex Step solver
-    sol2 = solver_csd.solve(bvp)
-    npt.assert_almost_equal(sol2.y,y_expected,decimal=5)
+    bvp = bvpsol.BVP(odefn,bcfn,real_funcs={'deriv_func': odefn_real},aux_index=[])
+    bvp.solution = bvpsol.Solution(np.linspace(0,1,2),np.array([[0,0.1],[0,2]]),[pi/2])
+    solver = algorithms.SingleShooting(derivative_method='fd',cached=False,tolerance=1e-6,propagator=propagator)
+    sol = solver.solve(bvp)
+    assert sol.converged and calls[0] > 50
+    npt.assert_almost_equal(sol.y[:,0],[0,2],decimal=5)
 
 if __name__ == '__main__':
-    test_solve()
+    test_solve('fd')
@@ -1,4 +1,11 @@
+import dill
+import numpy as np
+import numpy.testing as npt
+import pytest
 import beluga.Beluga as Beluga
+import beluga.bvpsol.algorithms as algorithms
+from beluga.continuation import ContinuationList
+from beluga.optim import NecessaryConditions
 
 def test_brachistochrone(problem_brachistochrone):
     """!
@@ -10,3 +17,51 @@ def test_brachistochrone(problem_brachistochrone):
     # TODO: Add assert statements to actually validate the solution
     # TODO: Validate sol.x, sol.y, and sol.u
     Beluga.run(problem_brachistochrone)
+
+@pytest.mark.parametrize('mode', ['analytical', 'implicit'])
+def test_brachistochrone_control_history(problem_brachistochrone, tmpdir, monkeypatch, mode):
+    """Control history of the converged cases matches the control law at every point"""
+    monkeypatch.chdir(str(tmpdir))
+    problem = problem_brachistochrone
+    problem.mode = 'analytical'
+    problem.steps = ContinuationList()
+    problem.steps.add_step().num_cases(3).terminal('x', 5).terminal('y', 5)
+    with monkeypatch.context() as m:
+        if mode == 'implicit':
+            # Solve dH/du = 0 numerically instead of using the closed-form control law
+            make_ctrl = NecessaryConditions.make_ctrl
+            def make_implicit_ctrl(self, problem, mode):
+                make_ctrl(self, problem, mode)
+                self.control_options = []
+            m.setattr(NecessaryConditions, 'make_ctrl', make_implicit_ctrl)
+        Beluga.run(problem)
+
+    with open(problem.output_file, 'rb') as f:
+        out = dill.load(f)
+    sol = out['solution'][-1][-1]
+    bvp = NecessaryConditions().get_bvp(problem)
+    assert sol.u.shape == (1, len(sol.x))
+    for i in range(len(sol.x)):
+        u = bvp.control_func(sol.x[i], sol.y[:,i], sol.parameters, sol.aux)
+        # The implicit law may differ from the closed-form one by a multiple of 2*pi
+        npt.assert_allclose(np.cos(sol.u[:,i]), np.cos(u), rtol=1e-6, atol=1e-6)
+        npt.assert_allclose(np.sin(sol.u[:,i]), np.sin(u), rtol=1e-6, atol=1e-6)
+
+def test_brachistochrone_numba(problem_brachistochrone, tmpdir, monkeypatch):
+    """Solver with the Numba backend converges to the solution of the Python backend"""
+    numba = pytest.importorskip('numba')
+    monkeypatch.chdir(str(tmpdir))
+    problem = problem_brachistochrone
+    problem.mode = 'analytical'
+    problem.steps = ContinuationList()
+    problem.steps.add_step().num_cases(3).terminal('x', 5).terminal('y', 5)
+
+    solutions = {}
+    for backend in ['python', 'numba']:
+        problem.bvp_solver = algorithms.SingleShooting(derivative_method='fd',tolerance=1e-4,max_iterations=1000,cached=False,backend=backend)
+        problem.output_file = str(tmpdir.join('data_%s.dill' % backend))
+        Beluga.run(problem)
+        with open(problem.output_file, 'rb') as f:
+            solutions[backend] = dill.load(f)['solution'][-1][-1]
+
+    npt.assert_allclose(solutions['numba'].y, solutions['python'].y, rtol=1e-6, atol=1e-8)
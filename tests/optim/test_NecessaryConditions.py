@@ -188,3 +188,459 @@
 #
 # def test_get_bvp():
 #     assert True
+
+import imp
+import io
+import os
+import math
+import sys
+import types
+import numpy as np
+import numpy.testing as npt
+import pytest
+import beluga.optim.Problem
+from beluga.optim import NecessaryConditions
+from beluga.optim.NecessaryConditions import NUMBASUPPORTED
+from beluga.optim.problem import Expression
+
+def brachistochrone(name, mode):
+    problem = beluga.optim.Problem(name)
+    problem.mode = mode
+    problem.independent('t', 's')
+    problem.state('x','v*cos(theta)','m') \
+           .state('y','v*sin(theta)','m') \
+           .state('v','g*sin(theta)','m/s')
+    problem.control('theta','rad')
+    problem.cost['path'] = Expression('1','nd')
+    problem.constraints().initial('x-x_0','m') \
+                        .initial('y-y_0','m') \
+                        .initial('v-v_0','m/s') \
+                        .terminal('x-x_f','m')  \
+                        .terminal('y-y_f','m')
+    problem.constant('g', 9.81, 'm/s^2')
+    return problem
+
+@pytest.mark.parametrize('mode', ['analytical', 'num', 'dae'])
+def test_vectorized_functions(mode):
+    """Vectorized functions match the scalar ones point by point"""
+    bvp = NecessaryConditions().get_bvp(brachistochrone('brachistochrone_vec', mode))
+    data = bvp.problem_data
+    nStates = data['num_states'] + (data['dae_var_num'] if mode == 'dae' else 0)
+
+    rng = np.random.RandomState(0)
+    ya = rng.rand(nStates, 5) + 0.5
+    yb = rng.rand(nStates, 5) + 0.5
+    p = rng.rand(len(data['parameter_list']))
+    aux = bvp.solution.aux
+    aux['const'] = {'g': 9.81}
+    aux['initial'] = aux['terminal'] = dict(zip(data['state_list'], ya[:,0]))
+
+    f = bvp.deriv_func_vec(0, ya, p, aux)
+    bc = bvp.bc_func_vec(ya, yb, p, aux)
+    for k in range(ya.shape[1]):
+        npt.assert_allclose(f[:,k], bvp.deriv_func(0, ya[:,k], p, aux), rtol=1e-12, atol=1e-12)
+        npt.assert_allclose(bc[:,k], bvp.bc_func(ya[:,k], yb[:,k], p, aux), rtol=1e-12, atol=1e-12)
+        if mode != 'dae':
+            npt.assert_allclose(bvp.control_func_vec(0, ya, p, aux)[:,k], bvp.control_func(0, ya[:,k], p, aux), rtol=1e-12)
+
+    # A single point works as well
+    npt.assert_allclose(bvp.bc_func_vec(ya[:,0], yb[:,0], p, aux), bc[:,0])
+
+def test_make_cse():
+    """Shared subexpressions are moved into temporaries"""
+    nc = NecessaryConditions()
+    exprs = ["x-_x0['x']", 'sin(x*y)**2 + sin(x*y)', '-np.imag(x + 1e-100*1j)/1e-100', 'cos(x*y)']
+    temps, reduced = nc.make_cse(exprs)
+
+    # Boundary values are kept, unparsable expressions are returned as they are
+    assert "_x0['x']" in reduced[0]
+    assert reduced[2] == exprs[2]
+
+    values = {'x': 0.3, 'y': 1.7, 'sin': np.sin, 'cos': np.cos, 'np': np, '_x0': {'x': 0.1}}
+    for temp in temps:
+        values[temp['name']] = eval(temp['expr'], values)
+    for (expr, expr_cse) in zip(exprs, reduced):
+        npt.assert_allclose(eval(expr_cse, values), eval(expr, values))
+    assert len(temps) > 0
+
+    nc.cse = False
+    assert nc.make_cse(exprs) == ([], exprs)
+
+@pytest.mark.parametrize('mode', ['analytical', 'num', 'dae'])
+def test_deriv_jac_func(mode):
+    """Generated Jacobians of the ODE function match finite differences"""
+    bvp = NecessaryConditions().get_bvp(brachistochrone('brachistochrone_jac', mode))
+    if mode != 'analytical':
+        # Only available for analytical problems
+        assert bvp.deriv_jac_func is None
+        assert bvp.deriv_stm_func is None
+        return
+
+    data = bvp.problem_data
+    rng = np.random.RandomState(0)
+    y = rng.rand(data['num_states']) + 0.5
+    p = rng.rand(len(data['parameter_list']))
+    aux = bvp.solution.aux
+    aux['const'] = {'g': 9.81}
+    aux['initial'] = aux['terminal'] = dict(zip(data['state_list'], y))
+
+    dfdX, dfdp = bvp.deriv_jac_func(0, y, p, aux)
+    assert dfdX.shape == (len(y), len(y))
+    assert dfdp.shape == (len(y), len(p))
+
+    h = 1e-6
+    for i in range(len(y)):
+        dy = np.zeros(len(y))
+        dy[i] = h
+        fd = (bvp.deriv_func(0, y+dy, p, aux) - bvp.deriv_func(0, y-dy, p, aux))/(2*h)
+        npt.assert_allclose(dfdX[:,i], fd, rtol=1e-6, atol=1e-6)
+    for i in range(len(p)):
+        dp = np.zeros(len(p))
+        dp[i] = h
+        fd = (bvp.deriv_func(0, y, p+dp, aux) - bvp.deriv_func(0, y, p-dp, aux))/(2*h)
+        npt.assert_allclose(dfdp[:,i], fd, rtol=1e-6, atol=1e-6)
+
+    # The fused function returns the rates of the states and of the STM
+    phi = rng.rand(len(y), len(y))
+    dY = bvp.deriv_stm_func(0, np.r_[y, phi.reshape(-1)], None, p, aux)
+    npt.assert_allclose(dY[:len(y)], bvp.deriv_func(0, y, p, aux), rtol=1e-12)
+    npt.assert_allclose(dY[len(y):], np.dot(dfdX, phi).reshape(-1), rtol=1e-10, atol=1e-12)
+
+    # It also takes complex states, e.g. for a complex step of the rates
+    Y = np.r_[y, phi.reshape(-1)].astype(complex)
+    Y[0] += 1e-20j
+    dY = bvp.deriv_stm_func(0, Y, None, p, aux)
+    npt.assert_allclose(np.imag(dY[:len(y)])/1e-20, dfdX[:,0], rtol=1e-6, atol=1e-6)
+
+def test_bc_jac_func():
+    """Generated Jacobians of the boundary conditions match finite differences"""
+    bvp = NecessaryConditions().get_bvp(brachistochrone('brachistochrone_bcjac', 'analytical'))
+    data = bvp.problem_data
+    rng = np.random.RandomState(1)
+    ya = rng.rand(data['num_states']) + 0.5
+    yb = rng.rand(data['num_states']) + 0.5
+    p = rng.rand(len(data['parameter_list']))
+    aux = bvp.solution.aux
+    aux['const'] = {'g': 9.81}
+    aux['initial'] = dict(zip(data['state_list'], rng.rand(len(ya))))
+    aux['terminal'] = dict(zip(data['state_list'], rng.rand(len(yb))))
+
+    dbcdya, dbcdyb, dbcdp = bvp.bc_jac_func(ya, yb, p, aux)
+    nBCs = len(bvp.bc_func(ya, yb, p, aux))
+    assert dbcdya.shape == (nBCs, len(ya))
+    assert dbcdp.shape == (nBCs, len(p))
+
+    h = 1e-6
+    for (jac, y, bc) in [(dbcdya, ya, lambda y: bvp.bc_func(y, yb, p, aux)),
+                         (dbcdyb, yb, lambda y: bvp.bc_func(ya, y, p, aux)),
+                         (dbcdp, p, lambda y: bvp.bc_func(ya, yb, y, aux))]:
+        for i in range(len(y)):
+            dy = np.zeros(len(y))
+            dy[i] = h
+            npt.assert_allclose(jac[:,i], (bc(y+dy) - bc(y-dy))/(2*h), rtol=1e-6, atol=1e-6)
+
+@pytest.mark.parametrize('mode', ['analytical', 'num'])
+def test_real_variant(mode):
+    """Real-only and flat aux functions match the complex-safe ones"""
+    bvp = NecessaryConditions().get_bvp(brachistochrone('brachistochrone_real', mode))
+    real_bvp = bvp.real_variant()
+    if mode != 'analytical':
+        # Numerical costate rates need complex numbers
+        assert real_bvp is bvp
+        return
+
+    assert real_bvp.deriv_func is not bvp.deriv_func
+    assert real_bvp.solution is bvp.solution
+    assert real_bvp.deriv_func.__globals__['sin'] is math.sin
+
+    data = bvp.problem_data
+    rng = np.random.RandomState(2)
+    ya = rng.rand(data['num_states']) + 0.5
+    yb = rng.rand(data['num_states']) + 0.5
+    p = rng.rand(len(data['parameter_list']))
+    aux = bvp.solution.aux
+    aux['const'] = {'g': 9.81}
+    aux['initial'] = aux['terminal'] = dict(zip(data['state_list'], ya))
+
+    # The variants take the aux values as a flat tuple
+    assert bvp.pack_aux(aux) is aux
+    flat_aux = real_bvp.pack_aux(aux)
+    assert isinstance(flat_aux, tuple)
+    with pytest.raises(KeyError, match="'const', 'g'"):
+        real_bvp.pack_aux(dict(aux, const={}))
+    flat_bvp = bvp.flat_variant()
+    for variant in [real_bvp, flat_bvp]:
+        npt.assert_allclose(variant.deriv_func(0, ya, p, flat_aux), bvp.deriv_func(0, ya, p, aux), rtol=1e-12)
+        npt.assert_allclose(variant.bc_func(ya, yb, p, flat_aux), bvp.bc_func(ya, yb, p, aux), rtol=1e-12)
+        npt.assert_allclose(np.r_[variant.bc_func_left(ya, p, flat_aux), variant.bc_func_right(yb, p, flat_aux)],
+                            bvp.bc_func(ya, yb, p, aux), rtol=1e-12)
+        for (variant_jac, jac) in zip(variant.bc_jac_func(ya, yb, p, flat_aux), bvp.bc_jac_func(ya, yb, p, aux)):
+            npt.assert_allclose(variant_jac, jac, rtol=1e-12)
+
+def test_hoisting():
+    """Unused quantities are dropped and constant subexpressions are evaluated once per solve"""
+    def problem(name):
+        problem = brachistochrone(name, 'analytical')
+        problem.constant('k', 2.0, 'nd')
+        problem.quantity('gk', 'g*sqrt(k)/k')
+        problem.quantity('unused', 'x*y')
+        # Uses the quantity without changing the dynamics
+        problem.states()[2].process_eqn = 'gk*sqrt(k)*sin(theta)'
+        return problem
+
+    bvp = NecessaryConditions().get_bvp(problem('brachistochrone_hoist'))
+    ref_bvp = NecessaryConditions(hoist=False).get_bvp(problem('brachistochrone_nohoist'))
+    data = bvp.problem_data
+    assert len(data['aux_hoisted']) > 0
+    assert [qty['name'] for qty in data['deriv_quantities']] == ['gk']
+    assert len(ref_bvp.problem_data['aux_hoisted']) == 0
+
+    rng = np.random.RandomState(3)
+    ya = rng.rand(data['num_states']) + 0.5
+    yb = rng.rand(data['num_states']) + 0.5
+    p = rng.rand(len(data['parameter_list']))
+    aux = bvp.solution.aux
+    aux['const'] = {'g': 9.81, 'k': 2.0}
+    aux['initial'] = aux['terminal'] = dict(zip(data['state_list'], ya))
+
+    flat_bvp = bvp.real_variant()
+    flat_aux = flat_bvp.pack_aux(aux)
+    assert len(flat_aux) == len(bvp.aux_index) + len(data['aux_hoisted'])
+    for variant, variant_aux in [(bvp, aux), (flat_bvp, flat_aux)]:
+        npt.assert_allclose(variant.deriv_func(0, ya, p, variant_aux), ref_bvp.deriv_func(0, ya, p, aux), rtol=1e-12)
+        npt.assert_allclose(variant.bc_func(ya, yb, p, variant_aux), ref_bvp.bc_func(ya, yb, p, aux), rtol=1e-12)
+        for (jac, ref_jac) in zip(variant.deriv_jac_func(0, ya, p, variant_aux), ref_bvp.deriv_jac_func(0, ya, p, aux)):
+            npt.assert_allclose(jac, ref_jac, rtol=1e-12)
+
+def test_cached_modules(tmpdir):
+    """Generated code is written to content-addressed files and reused"""
+    cache_dir = str(tmpdir)
+    bvp = NecessaryConditions(cache_dir=cache_dir).get_bvp(brachistochrone('brachistochrone_cached', 'analytical'))
+    files = sorted(f for f in os.listdir(cache_dir) if f.endswith('.py'))
+    assert any(f.startswith('deriv_func_') for f in files)
+    assert bvp.deriv_func.__code__.co_filename.startswith(cache_dir)
+
+    # The same problem maps to the same files
+    mtimes = dict((f, os.path.getmtime(os.path.join(cache_dir, f))) for f in files)
+    bvp2 = NecessaryConditions(cache_dir=cache_dir).get_bvp(brachistochrone('brachistochrone_cached', 'analytical'))
+    assert sorted(f for f in os.listdir(cache_dir) if f.endswith('.py')) == files
+    assert mtimes == dict((f, os.path.getmtime(os.path.join(cache_dir, f))) for f in files)
+
+    y = np.ones(bvp.problem_data['num_states'])
+    aux = bvp.solution.aux
+    aux['const'] = {'g': 9.81}
+    aux['initial'] = aux['terminal'] = dict(zip(bvp.problem_data['state_list'], y))
+    p = np.ones(len(bvp.problem_data['parameter_list']))
+    npt.assert_allclose(bvp2.deriv_func(0, y, p, aux), bvp.deriv_func(0, y, p, aux))
+
+def test_cached_problem_data(tmpdir, monkeypatch):
+    """Derived problem data is reused until the problem definition changes"""
+    cache_dir = str(tmpdir)
+    bvp = NecessaryConditions(cache_dir=cache_dir).get_bvp(brachistochrone('brachistochrone_data', 'analytical'))
+    assert len([f for f in os.listdir(cache_dir) if f.startswith('bvp_')]) == 1
+
+    nc = NecessaryConditions(cache_dir=cache_dir)
+    nc.make_problem_data = None  # Not called for a cached problem
+    bvp2 = nc.get_bvp(brachistochrone('brachistochrone_data', 'analytical'))
+    assert bvp2.problem_data['deriv_list'] == bvp.problem_data['deriv_list']
+    assert bvp2.deriv_jac_func is not None
+
+    y = np.ones(bvp.problem_data['num_states'])
+    p = np.ones(len(bvp.problem_data['parameter_list']))
+    aux = bvp.solution.aux
+    aux['const'] = {'g': 9.81}
+    aux['initial'] = aux['terminal'] = dict(zip(bvp.problem_data['state_list'], y))
+    npt.assert_allclose(bvp2.deriv_func(0, y, p, aux), bvp.deriv_func(0, y, p, aux))
+
+    # Any change to the definition invalidates the cached data
+    problem = brachistochrone('brachistochrone_data', 'analytical')
+    problem.states()[2].process_eqn = '2*g*sin(theta)'
+    assert nc.problem_hash(problem, 'analytical') != nc.problem_hash(brachistochrone('brachistochrone_data', 'analytical'), 'analytical')
+    assert nc.problem_hash(problem, 'analytical') != nc.problem_hash(problem, 'num')
+    bvp3 = NecessaryConditions(cache_dir=cache_dir).get_bvp(problem)
+    assert len([f for f in os.listdir(cache_dir) if f.startswith('bvp_')]) == 2
+    assert bvp3.problem_data['deriv_list'][2] != bvp.problem_data['deriv_list'][2]
+
+    # So does a change to the source of beluga.optim, e.g. of State.make_costate
+    nc_module = sys.modules['beluga.optim.NecessaryConditions']
+    state_source = os.path.join(os.path.dirname(nc_module.__file__), 'problem', 'State.py')
+    problem_hash = nc.problem_hash(problem, 'analytical')
+    real_open = open
+    def edited_open(filename, *args):
+        f = real_open(filename, *args)
+        if os.path.abspath(filename) == state_source:
+            return io.BytesIO(f.read() + b'# edited')
+        return f
+    monkeypatch.setattr(nc_module, '_source_hash', None)
+    monkeypatch.setattr('builtins.open', edited_open)
+    assert nc.problem_hash(problem, 'analytical') != problem_hash
+
+def gravity(v):
+    return 9.81
+
+def brachistochrone_function(name):
+    problem = brachistochrone(name, 'analytical')
+    problem.states()[2].process_eqn = 'gravity(v)*sin(theta)'
+    return problem
+
+def test_cached_functions(tmpdir):
+    """Custom functions missing from the input module give the same error with and without cached data"""
+    cache_dir = str(tmpdir)
+    bvp = NecessaryConditions(cache_dir=cache_dir).get_bvp(brachistochrone_function('brachistochrone_function'))
+    assert bvp.solution.aux['function']['gravity'] is gravity
+
+    for nc in [NecessaryConditions(cache_dir=cache_dir), NecessaryConditions(cached=False)]:
+        problem = brachistochrone_function('brachistochrone_function')
+        problem.input_module = types.ModuleType('no_functions')
+        with pytest.raises(ValueError):
+            nc.get_bvp(problem)
+
+def test_prune_cache(tmpdir):
+    """Cache entries older than cache_max_age are deleted when a new problem is derived"""
+    cache_dir = str(tmpdir)
+    old = ['bvp_0123456789abcdef.dat', 'deriv_func_0123456789abcdef.py', 'bc_func_0123456789abcdef.py.42.tmp',
+           os.path.join('__pycache__', 'deriv_func_0123456789abcdef.cpython-311.pyc')]
+    other = ['notes.txt', 'joblib_0123456789abcdef']
+    os.mkdir(os.path.join(cache_dir, '__pycache__'))
+    for f in old + other:
+        open(os.path.join(cache_dir, f), 'w').close()
+        os.utime(os.path.join(cache_dir, f), (0, 0))
+
+    NecessaryConditions(cache_dir=cache_dir, cache_max_age=3600).get_bvp(brachistochrone('brachistochrone_pruned', 'analytical'))
+    files = os.listdir(cache_dir)
+    assert not any(os.path.exists(os.path.join(cache_dir, f)) for f in old)
+    assert all(f in files for f in other)
+    # The new entries are kept
+    assert len([f for f in files if f.startswith('bvp_')]) == 1
+
+def test_numba_functions():
+    """Functions rendered for Numba match the real-only ones, also when run as plain Python"""
+    nc = NecessaryConditions(backend='numba')
+    bvp = nc.get_bvp(brachistochrone('brachistochrone_numba', 'analytical'))
+    real_bvp = bvp.real_variant()
+    if not NUMBASUPPORTED:
+        # Falls back to the Python functions
+        assert real_bvp.deriv_func is nc.compiled_real.deriv_func
+
+    module = imp.new_module('brachistochrone_numba_python')
+    for func in ['deriv_func', 'bc_func', 'compute_control', 'deriv_stm_func']:
+        nc.compile_function(nc.template_prefix+func+'.py.mu', module=module,
+                            math_module='beluga.utils.realmath', flat_aux=True, numba=True)
+
+    data = bvp.problem_data
+    rng = np.random.RandomState(4)
+    ya = rng.rand(data['num_states']) + 0.5
+    yb = rng.rand(data['num_states']) + 0.5
+    p = rng.rand(len(data['parameter_list']))
+    aux = bvp.solution.aux
+    aux['const'] = {'g': 9.81}
+    aux['initial'] = aux['terminal'] = dict(zip(data['state_list'], ya))
+    flat_aux = real_bvp.pack_aux(aux)
+
+    Y = np.r_[ya, rng.rand(len(ya)**2)]
+    for funcs in [module, real_bvp]:
+        npt.assert_allclose(funcs.deriv_func(0, ya, p, flat_aux), bvp.deriv_func(0, ya, p, aux), rtol=1e-12)
+        npt.assert_allclose(funcs.bc_func(ya, yb, p, flat_aux), bvp.bc_func(ya, yb, p, aux), rtol=1e-12)
+        npt.assert_allclose(funcs.deriv_stm_func(0, Y, None, p, flat_aux), bvp.deriv_stm_func(0, Y, None, p, aux), rtol=1e-12)
+
+def test_numba_compiled():
+    """Functions compiled with Numba match the real-only Python functions"""
+    numba = pytest.importorskip('numba')
+    nc = NecessaryConditions(backend='numba')
+    bvp = nc.get_bvp(brachistochrone('brachistochrone_njit', 'analytical'))
+    real_bvp = bvp.real_variant()
+    for name in ['deriv_func', 'bc_func', 'control_func']:
+        assert isinstance(getattr(real_bvp, name), numba.core.registry.CPUDispatcher)
+
+    data = bvp.problem_data
+    rng = np.random.RandomState(6)
+    aux = bvp.solution.aux
+    aux['const'] = {'g': 9.81}
+    aux['initial'] = aux['terminal'] = dict(zip(data['state_list'], rng.rand(data['num_states']) + 0.5))
+    flat_aux = real_bvp.pack_aux(aux)
+    p = rng.rand(len(data['parameter_list']))
+    python = nc.compiled_real
+    for _ in range(5):
+        ya = rng.rand(data['num_states']) + 0.5
+        yb = rng.rand(data['num_states']) + 0.5
+        Y = np.r_[ya, rng.rand(len(ya)**2)]
+        npt.assert_allclose(real_bvp.deriv_func(0.0, ya, p, flat_aux), python.deriv_func(0.0, ya, p, flat_aux), rtol=1e-12)
+        npt.assert_allclose(real_bvp.bc_func(ya, yb, p, flat_aux), python.bc_func(ya, yb, p, flat_aux), rtol=1e-12)
+        npt.assert_allclose(real_bvp.control_func(0.0, ya, p, flat_aux), python.compute_control(0.0, ya, p, flat_aux), rtol=1e-12)
+        npt.assert_allclose(real_bvp.deriv_stm_func(0.0, Y, None, p, flat_aux), python.deriv_stm_func(0.0, Y, None, p, flat_aux), rtol=1e-12)
+
+def test_implicit_control():
+    """Without a closed-form control law, the Newton solver finds the same controls"""
+    nc = NecessaryConditions()
+    make_ctrl = nc.make_ctrl
+    def make_implicit_ctrl(problem, mode):
+        make_ctrl(problem, mode)
+        nc.control_options = []
+    nc.make_ctrl = make_implicit_ctrl
+    bvp = nc.get_bvp(brachistochrone('brachistochrone_implicit', 'analytical'))
+    ref_bvp = NecessaryConditions().get_bvp(brachistochrone('brachistochrone_explicit', 'analytical'))
+    data = bvp.problem_data
+    assert data['control_options'] == [] and data['control_hessian']
+
+    rng = np.random.RandomState(5)
+    y = rng.rand(data['num_states'], 5) + 0.5
+    p = rng.rand(len(data['parameter_list']))
+    aux = bvp.solution.aux
+    aux['const'] = {'g': 9.81}
+    aux['initial'] = aux['terminal'] = dict(zip(data['state_list'], y[:,0]))
+
+    # Newton's method finds a stationary point of H, the closed-form law its minimum
+    u_ref = ref_bvp.control_func(0, y[:,0], p, aux)
+    bvp.control_func.solver.guess = np.array(u_ref) + 0.1
+    for k in range(y.shape[1]):
+        u = bvp.control_func(0, y[:,k], p, aux)
+        npt.assert_allclose(np.cos(u), np.cos(ref_bvp.control_func(0, y[:,k], p, aux)), rtol=1e-8, atol=1e-8)
+        npt.assert_allclose(np.sin(u), np.sin(ref_bvp.control_func(0, y[:,k], p, aux)), rtol=1e-8, atol=1e-8)
+    assert bvp.control_func.solver.fallback_solves == 0
+
+    # The vectorized solver has no warm start and may find the maximum, theta + pi
+    u_vec = bvp.control_func_vec(0, y, p, aux)[0]
+    u_ref = np.array([ref_bvp.control_func(0, y[:,k], p, aux)[0] for k in range(y.shape[1])])
+    npt.assert_allclose(np.cos(2*u_vec), np.cos(2*u_ref), rtol=1e-6, atol=1e-6)
+    npt.assert_allclose(np.sin(2*u_vec), np.sin(2*u_ref), rtol=1e-6, atol=1e-6)
+
+def three_options(name, mode):
+    """Problem with the control options u = -1, 0 and 2, of which 2 minimizes H for lamX > 0 and 0 for lamX < 0"""
+    problem = beluga.optim.Problem(name)
+    problem.mode = mode
+    problem.independent('t', 's')
+    problem.state('x','u**4/4 - u**3/3 - u**2','m') \
+           .state('y','5*x','m')
+    problem.control('u','rad')
+    problem.cost['path'] = Expression('1','nd')
+    problem.constraints().initial('x-x_0','m') \
+                        .initial('y-y_0','m') \
+                        .terminal('x-x_f','m')
+    return problem
+
+@pytest.mark.parametrize('mode', ['analytical', 'num'])
+def test_branch_tracking(mode):
+    """Evaluating only the last winning control options gives the same controls as the full scan"""
+    bvp = NecessaryConditions(track_branches=True).get_bvp(three_options('three_options_tracked', mode))
+    ref_bvp = NecessaryConditions().get_bvp(three_options('three_options_scanned', mode))
+    data = bvp.problem_data
+    assert len(data['control_options']) == 3 and data['track_branches']
+    assert not ref_bvp.problem_data['track_branches']
+    # Two options are not worth tracking
+    assert not NecessaryConditions(track_branches=True).get_bvp(brachistochrone('brachistochrone_tracked', mode)).problem_data['track_branches']
+
+    p = np.ones(len(data['parameter_list']))
+    aux = bvp.solution.aux
+    aux['const'] = {}
+    aux['initial'] = aux['terminal'] = dict((state, 0.0) for state in data['state_list'])
+
+    # Sweep lamX through zero, where the winner switches from u = 2 to u = 0, and back
+    controls = []
+    for lamX in np.r_[np.linspace(1, -1, 101), np.linspace(-1, 1, 101)]:
+        y = np.array([-0.6, 0.2, lamX, 0.3, 1.0])
+        u = bvp.control_func(0, y, p, aux)
+        npt.assert_allclose(u, ref_bvp.control_func(0, y, p, aux))
+        controls.append(u[0])
+    assert set(controls) >= set([0, 2])
+    branches = bvp.control_func.branches
+    assert branches.tracked_solves > 2*branches.full_scans
@@ -0,0 +1,24 @@
+import numpy as np
+from beluga.utils import BranchTracker
+
+def test_branch_tracker():
+    """The winner is kept while it beats the runner-up and stays away from the other options"""
+    tracker = BranchTracker(rescan_interval=3)
+    assert tracker.select() is None
+
+    tracker.record([2.0, 1.0, 5.0, 3.0])
+    assert tracker.select() == (1, 0)
+    # Checked against the runner-up at the current state
+    assert tracker.keep(1.5, 1.8)
+    assert not tracker.keep(1.5, 1.4)
+    # Within half of the margin to the best of the other options
+    assert not tracker.keep(0.0, 1.8)
+    assert tracker.keep(1.9, 2.0) and tracker.keep(1.0, 2.0)
+    assert tracker.select() is None
+
+    # Without a margin to the options that are not evaluated every call scans
+    tracker.record([np.nan, 3.0, 4.0])
+    assert tracker.select() is None
+    tracker.record([1.0, 1.0, 1.0])
+    assert tracker.select() is None
+    assert tracker.full_scans == 3 and tracker.tracked_solves == 3
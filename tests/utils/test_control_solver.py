@@ -0,0 +1,41 @@
+import numpy as np
+import numpy.testing as npt
+from beluga.utils import ControlSolver
+
+def test_control_solver_newton():
+    """Newton's method solves dH/du = 0 and is warm started from the nearest state"""
+    # H = (u - X[0])**2/2 + u**4/4
+    dHdu = lambda u: [u[0] - X[0] + u[0]**3]
+    d2Hdu2 = lambda u: [1.0 + 3*u[0]**2]
+
+    solver = ControlSolver([0.1])
+    for X in [np.array([1.0]), np.array([-5.0]), np.array([1.01])]:
+        u = solver.solve(X, dHdu, d2Hdu2)
+        npt.assert_allclose(dHdu(u), 0, atol=1e-9)
+    assert solver.newton_solves == 3 and solver.fallback_solves == 0
+    # The last state is the nearest one
+    npt.assert_allclose(solver.warm_start(np.array([1.02])), u)
+
+    # Complex-step calls are solved but do not become warm starts
+    X = np.array([3.0 + 1e-20j])
+    npt.assert_allclose(np.real(dHdu(solver.solve(X, dHdu, d2Hdu2))), 0, atol=1e-9)
+    assert len(solver.states) == 3
+    npt.assert_allclose(solver.warm_start(np.array([3.0])), u)
+
+def test_control_solver_fallback():
+    """Without a Hessian, or if Newton's method fails, fsolve is used"""
+    dHdu = lambda u: [np.tanh(10*u[0]) - 0.5]
+
+    solver = ControlSolver([0.1])
+    u = solver.solve(np.zeros(1), dHdu)
+    npt.assert_allclose(dHdu(u), 0, atol=1e-9)
+    assert solver.fallback_solves == 1
+
+    # Singular Hessian
+    u = solver.solve(np.zeros(1), dHdu, lambda u: [0.0])
+    npt.assert_allclose(dHdu(u), 0, atol=1e-9)
+    assert solver.fallback_solves == 2
+
+    solver = ControlSolver([0.1], max_iterations=1)
+    solver.solve(np.zeros(1), dHdu, lambda u: [10/np.cosh(10*u[0])**2])
+    assert solver.newton_solves == 0 and solver.fallback_solves == 1
@@ -0,0 +1,48 @@
+import numpy as np
+import numpy.testing as npt
+from beluga.utils import Propagator
+from beluga.utils.propagators import dop853, dopri5
+
+def odefn(t,x,p,aux):
+    k  = [-0.5, -0.2]
+    return np.array([k[0]*x[0],k[1]*x[1]])
+
+def expected(t1, y0):
+    k  = [-0.5, -0.2]
+    return np.array([y*np.exp(k_*t1) for (y,k_) in zip(y0,k)]).T
+
+def test_dop853():
+    """Test dop853() against analytical solution"""
+    y0 = np.array([10.0,-50.0])
+    [t1,x1] = dop853(odefn,[0,1.0],y0,[],{})
+    npt.assert_almost_equal(x1,expected(t1,y0))
+
+    [t1,x1] = dop853(odefn,[1.0,0.0],y0,[],{})
+    assert t1[-1] == 0.0
+    npt.assert_almost_equal(x1,expected(t1-1.0,y0))
+
+def test_dop853_dense_output():
+    """Test continuous extension from dop853() between steps"""
+    y0 = np.array([10.0,-50.0])
+    ode45 = Propagator(solver='dop853')
+    [t1,x1,dense] = ode45(odefn,[0,2.0],y0,[],{},dense_output=True)
+    npt.assert_almost_equal(dense(t1),x1)
+
+    t2 = np.linspace(0,2.0,101)
+    npt.assert_almost_equal(dense(t2),expected(t2,y0))
+
+def test_dop853_steps():
+    """Test that dop853() needs fewer evaluations than dopri5() at tight tolerances"""
+    nfevals = [0]
+    def oscillator(t,x):
+        nfevals[0] += 1
+        return np.array([x[1], -x[0]])
+
+    y0 = np.array([0.0,1.0])
+    [t1,x1] = dop853(oscillator,[0,20.0],y0,reltol=1e-10,abstol=1e-10)
+    npt.assert_almost_equal(x1[-1],[np.sin(20.0),np.cos(20.0)],decimal=8)
+    n853 = nfevals[0]
+
+    nfevals[0] = 0
+    dopri5(oscillator,[0,20.0],y0,reltol=1e-10,abstol=1e-10)
+    assert 2*n853 < nfevals[0]
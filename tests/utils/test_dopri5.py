@@ -0,0 +1,153 @@
+import numpy as np
+import numpy.testing as npt
+import pytest
+from math import *
+from beluga.utils import Propagator, IntegratorStats
+from beluga.utils.propagators import dopri5
+
+def odefn(t,x,p,aux):
+    k  = [-0.5, -0.2]
+    return np.array([k[0]*x[0],k[1]*x[1]])
+
+def expected(t1, y0):
+    k  = [-0.5, -0.2]
+    return np.array([y*np.exp(k_*t1) for (y,k_) in zip(y0,k)]).T
+
+def test_dopri5():
+    """Test dopri5() against analytical solution"""
+    y0 = np.array([10,-50])
+    tspan = np.array([0, 1.0])
+    [t1,x1] = dopri5(odefn,tspan,y0,[],{})
+    npt.assert_almost_equal(x1,expected(t1,y0))
+
+def test_dopri5_reverse():
+    """Test backward propagation with dopri5()"""
+    y0 = np.array([10.0,-50.0])
+    [t1,x1] = dopri5(odefn,[1.0, 0.0],y0,[],{})
+    assert t1[-1] == 0.0
+    npt.assert_almost_equal(x1,expected(t1-1.0,y0))
+
+def test_dopri5_fixed_step():
+    """Test that dopri5() steps on given time stamps"""
+    y0 = np.array([10.0,-50.0])
+    tspan = np.linspace(0,1,21)
+    [t1,x1] = dopri5(odefn,tspan,y0,[],{})
+    npt.assert_array_equal(t1,tspan)
+    npt.assert_almost_equal(x1,expected(t1,y0))
+
+    # Steps too long for the tolerances are only reported with gridcheck
+    [t2,x2] = dopri5(odefn,[0,1,5],y0,[],{},abstol=1e-10,reltol=1e-10)
+    npt.assert_array_equal(t2,[0,1,5])
+    dopri5(odefn,tspan,y0,[],{},abstol=1e-5,reltol=1e-5,gridcheck=True)
+    with pytest.raises(RuntimeError) as excinfo:
+        dopri5(odefn,[0,1,5],y0,[],{},abstol=1e-10,reltol=1e-10,gridcheck=True)
+    # The error carries the cost of the aborted propagation
+    assert excinfo.value.stats.nfevals == 7 and excinfo.value.stats.nrejected == 1
+
+    # Propagator adds the arcs that were finished before the aborted one
+    ode45 = Propagator(solver='dopri5')
+    with pytest.raises(RuntimeError) as excinfo:
+        ode45(odefn,[tspan,[0,1,5]],[y0,y0],[],{},abstol=1e-10,reltol=1e-10,gridcheck=True,return_stats=True)
+    assert excinfo.value.stats.nfevals > 7 and excinfo.value.stats.npropagations == 2
+
+def test_dopri5_propagator():
+    """Test solver selection through the Propagator class"""
+    ode45 = Propagator(solver='dopri5')
+    y0 = np.array([10.0,-50.0])
+    [t1,x1] = ode45(odefn,[0,1.0],y0,[],{})
+    npt.assert_almost_equal(x1,expected(t1,y0))
+
+    tset,xset = ode45(odefn,[[0,1.0],[1.0,2.0]],[y0,2*y0],[],{})
+    npt.assert_almost_equal(xset[1],expected(tset[1]-1.0,2*y0))
+
+def test_dopri5_dense_output():
+    """Test continuous extension from dopri5() between steps"""
+    y0 = np.array([10.0,-50.0])
+    [t1,x1,dense] = dopri5(odefn,[0,1.0],y0,[],{},outputsave=4,dense_output=True)
+    npt.assert_almost_equal(dense(t1),x1)
+
+    t2 = np.linspace(0,1.0,101)
+    npt.assert_almost_equal(dense(t2),expected(t2,y0))
+    npt.assert_almost_equal(dense(0.5),expected(0.5,y0))
+
+def test_dopri5_errorsel():
+    """Test error control on a subset of the components"""
+    def fast(t,x):
+        return np.array([-0.5*x[0], -20.0*x[1]])
+
+    y0 = np.array([10.0,-50.0])
+    [t1,x1] = dopri5(fast,[0,1.0],y0)
+    [t2,x2] = dopri5(fast,[0,1.0],y0,errorsel=slice(0,1))
+    assert len(t2) < len(t1)
+    npt.assert_almost_equal(x2[:,0],10.0*np.exp(-0.5*t2))
+
+def test_dopri5_stats():
+    """Test statistics record returned by dopri5()"""
+    y0 = np.array([10.0,-50.0])
+    [t1,x1,stats] = dopri5(odefn,[0,1.0],y0,[],{},return_stats=True)
+    assert stats.naccepted == len(t1) - 1
+    assert stats.nfevals == 1 + 6*(stats.naccepted + stats.nrejected)
+    npt.assert_almost_equal(stats.min_step, np.min(np.diff(t1)))
+    npt.assert_almost_equal(stats.max_step, np.max(np.diff(t1)))
+
+    ode45 = Propagator(solver='dopri5')
+    tset,xset,statsset = ode45(odefn,[[0,1.0],[1.0,3.0]],[y0,2*y0],[],{},return_stats=True)
+    total = IntegratorStats.total(statsset)
+    assert total.npropagations == 2
+    assert total.naccepted == len(tset[0]) + len(tset[1]) - 2
+    assert total.max_step == statsset[1].max_step
+
+def test_dopri5_events():
+    """Test location of terminal and non-terminal events"""
+    def ballistic(t,x):
+        return np.array([x[1], -9.81])
+
+    def apex(t,x):
+        return x[1]
+
+    def impact(t,x):
+        return x[0]
+    impact.terminal = True
+    impact.direction = -1
+
+    [t1,x1,te,xe] = dopri5(ballistic,[0,10.0],np.array([0.0,10.0]),events=[apex,impact])
+    npt.assert_almost_equal(te[0],[10.0/9.81])
+    npt.assert_almost_equal(xe[0][0],[10.0**2/(2*9.81), 0.0])
+    npt.assert_almost_equal(te[1],[20.0/9.81])
+    assert t1[-1] == te[1][0]
+    npt.assert_almost_equal(x1[-1],[0.0,-10.0])
+
+def test_dopri5_guards():
+    """Test that diverging propagations are aborted"""
+    nfevals = [0]
+    def blowup(t,x):
+        nfevals[0] += 1
+        return x**2
+
+    with pytest.raises(RuntimeError):
+        dopri5(blowup,[0,2.0],np.array([1.0]))
+    unbounded = nfevals[0]
+
+    nfevals[0] = 0
+    with pytest.raises(RuntimeError):
+        dopri5(blowup,[0,2.0],np.array([1.0]),maxstate=1e3)
+    assert 2*nfevals[0] < unbounded
+
+    nfevals[0] = 0
+    def singular(t,x):
+        nfevals[0] += 1
+        return np.sqrt(1.0-t) + 0*x
+
+    with pytest.raises(RuntimeError):
+        dopri5(singular,[0,2.0],np.array([1.0]))
+    assert nfevals[0] < 200
+
+    # Isolated non-finite trial steps on a long propagation are retried each time
+    nfevals[0] = 0
+    def spiky(t,x):
+        nfevals[0] += 1
+        return np.array([np.nan]) if nfevals[0] % 50 == 0 else -0.1*x
+
+    t1, x1 = dopri5(spiky,[0,30.0],np.array([1.0]),maxstep=0.1)
+    assert nfevals[0] > 50*10
+    npt.assert_almost_equal(x1[-1],[exp(-3.0)])
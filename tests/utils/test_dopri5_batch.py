@@ -0,0 +1,79 @@
+import numpy as np
+import numpy.testing as npt
+import pytest
+from beluga.utils import Propagator
+from beluga.utils.propagators import dopri5, dopri5_batch
+from beluga.utils.propagators.dopri5_batch import columnwise
+
+k = np.array([-0.5, -0.2])
+
+def odefn(t,x,p,aux):
+    return k*x
+
+def odefn_stacked(t,X,p,aux):
+    # One column of states per trajectory
+    return k[:,np.newaxis]*X
+
+def test_dopri5_batch():
+    """Test dopri5_batch() against analytical solution and dopri5()"""
+    y0 = np.array([[10.0,-50.0],[1.0,2.0],[-3.0,0.5]])
+    tspan = [[0,1.0],[0,2.0],[1.0,0]]
+    tset,yset = dopri5_batch(odefn_stacked,tspan,y0,[],{})
+
+    for (ts,t1,x1,y) in zip(tspan,tset,yset,y0):
+        assert t1[0] == ts[0] and t1[-1] == ts[-1]
+        npt.assert_almost_equal(x1, y*np.exp(np.outer(t1-ts[0],k)))
+
+        # Per-trajectory step control reproduces the single trajectory propagation
+        t2,x2 = dopri5(odefn,ts,y,[],{})
+        npt.assert_almost_equal(t1,t2)
+        npt.assert_almost_equal(x1,x2)
+
+def test_dopri5_batch_columnwise():
+    """Test batched propagation of an ODE that handles one trajectory at a time"""
+    y0 = [np.array([10.0,-50.0]),np.array([1.0,2.0])]
+    ode45 = Propagator(solver='dopri5',batched=True)
+    tset,yset = ode45(columnwise(odefn),[[0,1.0],[1.0,2.0]],y0,[],{})
+    npt.assert_almost_equal(yset[1][-1], y0[1]*np.exp(k))
+
+    with pytest.raises(Exception):
+        Propagator(solver='rosenbrock',batched=True)
+
+def test_dopri5_batch_guards():
+    """Test the time span, non-finite and state bound checks of dopri5_batch()"""
+    y0 = np.array([[10.0,-50.0],[1.0,2.0]])
+    # Fixed time stamps are not supported
+    with pytest.raises(ValueError):
+        dopri5_batch(odefn_stacked,[[0,0.5,1.0],[0,0.5,1.0]],y0,[],{})
+
+    # Trial steps with NaN in the last trajectory are retried
+    calls = [0]
+    def odefn_spiky(t,X,p,aux):
+        calls[0] += 1
+        out = odefn_stacked(t,X,p,aux)
+        if calls[0] % 50 == 0:
+            out[:,-1] = np.nan
+        return out
+
+    tset,yset,statsset = dopri5_batch(odefn_spiky,[[0,30.0],[0,30.0]],y0,[],{},maxstep=0.1,return_stats=True)
+    assert statsset[1].nrejected > 0
+    npt.assert_almost_equal(yset[1][-1], y0[1]*np.exp(30*k))
+
+    # Propagation is aborted if the trajectory stays non-finite
+    def odefn_domain(t,X,p,aux):
+        return np.where(t > 1.5, np.nan, 1.0)*odefn_stacked(t,X,p,aux)
+
+    with pytest.raises(RuntimeError):
+        dopri5_batch(odefn_domain,[[0,1.0],[0,2.0]],y0,[],{})
+
+    with pytest.raises(RuntimeError):
+        dopri5_batch(odefn_stacked,[[0,1.0],[0,-10.0]],y0,[],{},maxstate=100.0)
+
+def test_dopri5_batch_dense_output():
+    """Test continuous extension of each trajectory from dopri5_batch()"""
+    y0 = np.array([[10.0,-50.0],[1.0,2.0]])
+    tset,yset,denseset = dopri5_batch(odefn_stacked,[[0,1.0],[2.0,0]],y0,[],{},dense_output=True)
+    for (t1,x1,dense,y) in zip(tset,yset,denseset,y0):
+        npt.assert_almost_equal(dense(t1),x1)
+        t2 = np.linspace(t1[0],t1[-1],51)
+        npt.assert_almost_equal(dense(t2), y*np.exp(np.outer(t2-t1[0],k)))
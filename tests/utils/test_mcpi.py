@@ -14,3 +14,33 @@ def test_mcpi():
     [t1,x1] = mcpi(odefn,tspan,y0,[],{}, N = 5, tol=1e-5)
     x1_expected = np.array([y*np.exp(k_*t1) for (y,k_) in zip(y0,k)]).T
     npt.assert_almost_equal(x1,x1_expected,decimal=5)
+
+def test_mcpi_vectorized():
+    """Test vectorized, segmented mcpi() with dense output against analytical solution"""
+    calls = [0]
+    def odefn(t,X):
+        calls[0] += 1
+        # One column of states per node
+        return np.array([X[1],-X[0]])
+
+    y0 = np.array([0.0,1.0])
+    tspan = [0.0, 4*pi]
+    t,y,dense,stats = mcpi(odefn,tspan,y0,tol=1e-10,vectorized=True,dense_output=True,return_stats=True)
+    npt.assert_almost_equal(t[[0,-1]],tspan)
+    npt.assert_almost_equal(y,np.c_[np.sin(t),np.cos(t)],decimal=8)
+    assert stats.naccepted > 1
+    assert stats.npropagations == 1
+    # One call per Picard iteration
+    assert calls[0] < stats.nfevals
+
+    ts = np.linspace(0,4*pi,57)
+    npt.assert_almost_equal(dense(ts),np.c_[np.sin(ts),np.cos(ts)],decimal=8)
+
+def test_mcpi_fixed_grid():
+    """Test mcpi() output on the given time stamps"""
+    def odefn(t,x):
+        return -x
+    tspan = np.linspace(0,3,7)
+    t,y = mcpi(odefn,tspan,np.array([2.0]),tol=1e-10)
+    npt.assert_almost_equal(t,tspan)
+    npt.assert_almost_equal(y[:,0],2*np.exp(-tspan),decimal=8)
@@ -0,0 +1,36 @@
+import numpy as np
+import numpy.testing as npt
+from scipy.linalg import expm
+from beluga.utils import Propagator
+from beluga.utils.propagators import rosenbrock
+
+def odefn(t,x,p,aux):
+    k  = [-0.5, -0.2]
+    return np.array([k[0]*x[0],k[1]*x[1]])
+
+def test_rosenbrock():
+    """Test rosenbrock() against analytical solution"""
+    y0 = np.array([10.0,-50.0])
+    [t1,x1] = rosenbrock(odefn,[0,1.0],y0,[],{},abstol=1e-8,reltol=1e-8)
+    x1_expected = np.array([y0[0]*np.exp(-0.5*t1), y0[1]*np.exp(-0.2*t1)]).T
+    npt.assert_almost_equal(x1,x1_expected,decimal=6)
+
+def test_rosenbrock_stiff():
+    """Test stiff propagation of states and STM with a given Jacobian"""
+    A = np.array([[0,1.0],[-1e4,-10001.0]])
+    def stmfn(t,y):
+        return np.concatenate((np.dot(A,y[:2]), np.dot(A,y[2:].reshape((2,2))).reshape(4)))
+
+    y0 = np.concatenate(([1.0,0.0], np.eye(2).reshape(4)))
+    ode45 = Propagator(solver='rosenbrock')
+    [t1,y1,dense] = ode45(stmfn,[0,1.0],y0,jacobian=lambda t,y: A,stm=2,dense_output=True)
+    npt.assert_almost_equal(y1[-1,2:].reshape((2,2)),expm(A),decimal=5)
+    npt.assert_almost_equal(dense(0.5)[:2],np.dot(expm(0.5*A),y0[:2]),decimal=5)
+
+    # Explicit propagators are limited by stability for this problem
+    [t2,y2] = Propagator(solver='dopri5')(stmfn,[0,1.0],y0)
+    assert 10*len(t1) < len(t2)
+
+    # Without the Jacobian and the STM structure
+    [t3,y3] = ode45(stmfn,[0,1.0],y0)
+    npt.assert_almost_equal(y3[-1],y1[-1])